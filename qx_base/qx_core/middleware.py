@@ -1,90 +1,282 @@
-import re
+import os
+import json
+import time
+import queue
+import atexit
 import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from urllib.parse import parse_qsl
 from django.utils.deprecation import MiddlewareMixin
 from django.conf import settings
 from .signature import ApiSignature
-from .tools import param_sort
+from .tools import iter_param_sort
+from .storage.codecs import json_loads
+from .storage.local import NonceCache
 from ..qx_rest.response import (
     SignErrJsonResponse, ApiErrorResponse,
     Api500ErrorResponse,
 )
+from ..qx_rest.caches import CacheInvalidation
 
 logger = logging.getLogger(__name__)
 
 
+class RequestBodyTooLarge(Exception):
+    pass
+
+
 class SignatureCheckMiddleware(MiddlewareMixin):
     '''
     Api Signature check
+    ---
+    IGNORE_CHECK_SIGN_PATH: 不检查的路径, 以*结尾时按前缀匹配
+    SIGN_BODY_MAX_SIZE: 需要签名的json body最大长度, 默认1M
+    SIGN_REPLAY_CHECK: 防重放, header Sign-Timestamp(秒)和Sign-Nonce,
+        作为_timestamp, _nonce参数参与签名, 默认关闭
+    SIGN_REPLAY_WINDOW: timestamp允许的误差(秒), 默认300
     '''
 
+    NONCE_MAX_LENGTH = 64
+
+    def __init__(self, get_response=None):
+        super().__init__(get_response)
+        paths = getattr(settings, 'IGNORE_CHECK_SIGN_PATH', [])
+        self.ignore_paths = frozenset(
+            path for path in paths if not path.endswith('*'))
+        self.ignore_prefixes = tuple(
+            path[:-1] for path in paths if path.endswith('*'))
+        self.body_max_size = getattr(
+            settings, 'SIGN_BODY_MAX_SIZE', 1024 * 1024)
+        self.replay_check = getattr(settings, 'SIGN_REPLAY_CHECK', False)
+        if self.replay_check:
+            self.replay_window = getattr(settings, 'SIGN_REPLAY_WINDOW', 300)
+            self.nonce_cache = NonceCache(
+                'sign', expired=self.replay_window)
+
+    def get_replay_params(self, request) -> dict:
+        """
+        return: 参与签名的_timestamp, _nonce, 无效时返回None
+        """
+        timestamp = request.META.get('HTTP_SIGN_TIMESTAMP', '')
+        nonce = request.META.get('HTTP_SIGN_NONCE', '')
+        if not timestamp.isdigit() or not nonce or \
+                len(nonce) > self.NONCE_MAX_LENGTH:
+            return None
+        if abs(time.time() - int(timestamp)) > self.replay_window:
+            return None
+        return {'_timestamp': timestamp, '_nonce': nonce}
+
+    def is_ignored(self, path) -> bool:
+        if path in self.ignore_paths:
+            return True
+        return bool(self.ignore_prefixes) and \
+            path.startswith(self.ignore_prefixes)
+
+    def get_sign_params(self, request) -> tuple:
+        """
+        return: (params, pop_keys)
+        """
+        if request.method in ['GET', 'DELETE']:
+            return dict(parse_qsl(request.META['QUERY_STRING'])), []
+        if request.method == 'POST' and\
+                request.content_type == "multipart/form-data":
+            return request.POST.dict(), ['file']
+        try:
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        if length > self.body_max_size:
+            raise RequestBodyTooLarge()
+        body = request.body
+        if len(body) > self.body_max_size:
+            raise RequestBodyTooLarge()
+        try:
+            params = json_loads(body)
+        except ValueError:
+            # orjson不支持的格式(NaN, 超过64位的整数等)
+            params = json.loads(body.decode())
+        if not isinstance(params, dict):
+            params = {}
+        return params, []
+
     def process_request(self, request):  # noqa
-        p = re.compile(r'/api/.*')
         # 临时排除
         if request.user.is_authenticated or\
                 request.META.get('HTTP_MYAUTHORIZATION') or\
                 request.META.get('HTTP_MYANONYMOUS'):
-            pass
-        elif request.path in settings.IGNORE_CHECK_SIGN_PATH:
-            pass
-        elif p.match(request.path) and not settings.DEBUG:
-            signature = request.META.get('HTTP_SIGN')
-            if signature:
-                if request.method in ['GET', 'DELETE']:
-                    query_string = request.META['QUERY_STRING']
-                    json_str = param_sort(
-                        query_string, pop_keys=[])
-                else:
-                    if request.method == 'POST' and\
-                            request.content_type == "multipart/form-data":
-                        json_str = param_sort(
-                            request.POST.dict(), pop_keys=['file'])
-                    else:
-                        try:
-                            body = request.body.decode()
-                        except Exception:
-                            return ApiErrorResponse("param error")
-                        json_str = param_sort(
-                            body, _json=True)
-                try:
-                    if not ApiSignature().verify(signature, json_str):
-                        return SignErrJsonResponse()
-                except Exception as ex:
-                    logger.error(ex, exc_info=True)
-                    return SignErrJsonResponse()
-            elif not signature:
+            return
+        path = request.path
+        if self.is_ignored(path) or not path.startswith('/api/') or\
+                settings.DEBUG:
+            return
+        signature = request.META.get('HTTP_SIGN')
+        if not signature:
+            return SignErrJsonResponse()
+        if self.replay_check:
+            if (replay_params := self.get_replay_params(request)) is None:
+                return SignErrJsonResponse()
+        try:
+            params, pop_keys = self.get_sign_params(request)
+        except RequestBodyTooLarge:
+            return ApiErrorResponse("body too large")
+        except Exception:
+            return ApiErrorResponse("param error")
+        if self.replay_check:
+            params = dict(params, **replay_params)
+        try:
+            if not ApiSignature().verify_parts(
+                    signature, iter_param_sort(params, pop_keys),
+                    key_id=request.META.get('HTTP_SIGN_KEY'),
+                    scheme=request.META.get('HTTP_SIGN_ALG')):
                 return SignErrJsonResponse()
+            # 签名通过后再记录nonce
+            if self.replay_check and not self.nonce_cache.add(
+                    replay_params['_nonce'], replay_params['_timestamp']):
+                return SignErrJsonResponse()
+        except Exception as ex:
+            logger.error(ex, exc_info=True)
+            return SignErrJsonResponse()
+
+
+class CaptureStream():
+    """
+    包装request stream, 读取时保留前max_size字节, 不额外读取body
+    """
+
+    def __init__(self, stream, max_size):
+        self.stream = stream
+        self.max_size = max_size
+        self.captured = bytearray()
+
+    def capture(self, data):
+        if data and len(self.captured) < self.max_size:
+            self.captured += data[:self.max_size - len(self.captured)]
+        return data
+
+    def read(self, *args, **kwargs):
+        return self.capture(self.stream.read(*args, **kwargs))
+
+    def readline(self, *args, **kwargs):
+        return self.capture(self.stream.readline(*args, **kwargs))
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class QueueLogger():
+    """
+    通过QueueHandler写日志, 后台线程QueueListener转发到原logger的handlers,
+    请求线程不等待日志IO, 每个进程一个listener
+    """
+
+    def __init__(self, target):
+        self.target = target
+        self.queue = queue.SimpleQueue()
+        self.logger = logging.getLogger("{}.queue".format(target.name))
+        self.logger.propagate = False
+        self.logger.addHandler(QueueHandler(self.queue))
+        self._listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._listener = QueueListener(self.queue, self)
+            self._listener.start()
+            self._pid = os.getpid()
+            atexit.register(self._listener.stop)
+
+    def handle(self, record):
+        """
+        QueueListener回调, 在后台线程中执行
+        """
+        record.name = self.target.name
+        self.target.handle(record)
+
+    def warning(self, msg, *args, **kwargs):
+        self.start()
+        self.logger.warning(msg, *args, **kwargs)
+
+
+ERROR_LOG_QUEUE_LOGGER = QueueLogger(logger)
 
 
 class ErrorLogMiddleware(MiddlewareMixin):
     '''
     api error print to log
+    ---
+    ERROR_LOG_BODY_MAX_SIZE: 记录的body最大长度, 默认4096
+    ERROR_LOG_QUEUE: 通过队列在后台线程写日志, 默认True
     '''
 
+    CONTENT_TYPES = ['application/json', 'text/plain']
+
+    def __init__(self, get_response=None):
+        super().__init__(get_response)
+        self.body_max_size = getattr(
+            settings, 'ERROR_LOG_BODY_MAX_SIZE', 4096)
+        self.logger = ERROR_LOG_QUEUE_LOGGER \
+            if getattr(settings, 'ERROR_LOG_QUEUE', True) else logger
+
+    def need_log(self, request) -> bool:
+        return request.content_type in self.CONTENT_TYPES and \
+            request.path.startswith('/api/')
+
+    def get_body(self, request) -> bytes:
+        """
+        已读取的body或读取时保留的部分, 不会为了记录日志读取body
+        """
+        if (body := getattr(request, '_body', None)) is not None:
+            return bytes(memoryview(body)[:self.body_max_size])
+        if isinstance(stream := getattr(request, '_stream', None),
+                      CaptureStream):
+            return bytes(stream.captured)
+        return b''
+
     def __call__(self, request):
         ret = super().__call__(request)
         try:
-            if ret.status_code >= 500 and \
-                    request.content_type in ['application/json', 'text/plain']:
-                p = re.compile(r'/api/.*')
-                if p.match(request.path):
-                    logger.warning("ErrorLog: {}, {}, {}, {}, {}".format(
-                        request.headers, request.path, request.method,
-                        self._initial_http_body, ret.status_code))
-                    return Api500ErrorResponse()
+            if ret.status_code >= 500 and self.need_log(request):
+                self.logger.warning(
+                    "ErrorLog: %s, %s, %s, %s, %s", dict(request.headers),
+                    request.path, request.method, self.get_body(request),
+                    ret.status_code)
+                return Api500ErrorResponse()
         except Exception:
             logger.exception("ErrorLogMiddleware")
         return ret
 
     def process_request(self, request):
-        if request.content_type in ['application/json', 'text/plain']:
-            self._initial_http_body = request.body
+        if request.content_type in self.CONTENT_TYPES and \
+                hasattr(request, '_stream') and \
+                not getattr(request, '_read_started', False):
+            request._stream = CaptureStream(
+                request._stream, self.body_max_size)
 
     def process_response(self, request, response):  # noqa
-        if request.content_type in ['application/json', 'text/plain']:
-            p = re.compile(r'/api/.*')
-            if p.match(request.path):
-                if response.status_code >= 400 and response.status_code < 500:
-                    logger.warning("ErrorLog: {}, {}, {}, {}".format(
-                        request.path, request.method,
-                        self._initial_http_body, response.content))
+        if 400 <= response.status_code < 500 and self.need_log(request):
+            content = b'' if response.streaming else \
+                response.content[:self.body_max_size]
+            self.logger.warning(
+                "ErrorLog: %s, %s, %s, %s", request.path, request.method,
+                self.get_body(request), content)
         return response
+
+
+class CacheInvalidationMiddleware(MiddlewareMixin):
+    '''
+    合并请求内model保存产生的接口缓存清理, 请求结束后执行一次
+    ---
+    清理计划按线程记录, 只在同步模式运行, ASGI下由django在线程中执行
+    '''
+
+    async_capable = False
+
+    def __call__(self, request):
+        with CacheInvalidation.batch():
+            return super().__call__(request)
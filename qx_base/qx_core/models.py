@@ -11,16 +11,29 @@ def get_model_id(model):
         model).id
 
 
+def load_objects(model, ids, select_related=[]) -> dict:
+    """
+    通过id批量获取对象, model支持cache_get_many时从缓存获取
+    return: {id: ins}
+    """
+    if not select_related and hasattr(model, 'cache_get_many') and \
+            model.objects_cache_fields.get('object') == ['id']:
+        return model.cache_get_many(ids)
+    return {
+        ins.id: ins
+        for ins in list(model.objects.select_related(
+            *select_related).filter(id__in=ids))
+    }
+
+
 def load_queryset_type_object(queryset, field, model, _type='',
                               select_related=[]):
     ids = []
     for ins in queryset:
         ids.append(getattr(ins, field))
     return {
-        "{}_{}".format(ins.id, _type): ins
-        for ins in list(
-            model.objects.select_related(
-                *select_related).filter(id__in=ids))
+        "{}_{}".format(_id, _type): ins
+        for _id, ins in load_objects(model, ids, select_related).items()
     }
 
 
@@ -39,11 +52,7 @@ def load_set_queryset_object(queryset, model, field_map: dict,
         for field_id in field_map.keys()
         if getattr(ins, field_id)
     ]
-    data = {
-        ins.id: ins
-        for ins in list(model.objects.select_related(
-            *select_related).filter(id__in=ids))
-    }
+    data = load_objects(model, ids, select_related)
     for ins in queryset:
         for field_id, set_field in field_map.items():
             setattr(ins, set_field, data.get(getattr(ins, field_id)))
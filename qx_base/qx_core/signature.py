@@ -1,17 +1,37 @@
 import six
+import hmac
 import base64
 import hashlib
+import functools
 from Crypto.Cipher import AES
-from Crypto.PublicKey import RSA
-from Crypto.Signature import PKCS1_v1_5
+from Crypto.PublicKey import RSA, ECC
+from Crypto.Signature import PKCS1_v1_5, eddsa
 from Crypto.Hash import SHA256
 from django.conf import settings
 
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives.serialization import (
+        load_pem_private_key, load_pem_public_key,
+    )
+except ImportError:  # pragma: no cover
+    load_pem_public_key = None
+
 
 def encode_md5(data_str: str) -> str:
     return hashlib.md5(data_str).hexdigest()
 
 
+@functools.lru_cache(maxsize=32)
+def load_rsa_scheme(key, decode=True):
+    """
+    解析RSA密钥并创建PKCS1_v1_5对象, 按密钥缓存, 每个进程只解析一次
+    """
+    if decode:
+        key = base64.b64decode(key)
+    return PKCS1_v1_5.new(RSA.importKey(key))
+
+
 class Signature(object):
     def __init__(self, key: str):
         self.key = key
@@ -32,34 +52,289 @@ class Signature(object):
         return encode_md5(self.encrypt(raw))  # noqa
 
     def rsa_sign(self, data: str, decode=True) -> str:
-        if decode:
-            pri_key_str = base64.b64decode(self.key)
-        else:
-            pri_key_str = self.key
-        pri_key = RSA.importKey(pri_key_str)
-        signer = PKCS1_v1_5.new(pri_key)
+        signer = load_rsa_scheme(self.key, decode)
         signature = signer.sign(SHA256.new(data.encode()))
         sign = base64.encodebytes(signature).decode().replace("\n", "")
         return sign
 
     def rsa_verify(self, sign: str, data: str, decode=True) -> bool:
-        if decode:
-            pub_key_str = base64.b64decode(self.key)
-        else:
-            pub_key_str = self.key
-        pub_key = RSA.importKey(pub_key_str)
-        verifier = PKCS1_v1_5.new(pub_key)
+        verifier = load_rsa_scheme(self.key, decode)
         data = SHA256.new(data.encode())
         return verifier.verify(data, base64.b64decode(sign))
 
 
+def b64encode(data: bytes) -> str:
+    return base64.b64encode(data).decode()
+
+
+class SignatureScheme():
+    """
+    签名算法, 通过header Sign-Alg或密钥配置选择
+    ---
+    name: 算法名
+    key: 验签密钥, private_key: 签名密钥(对称算法与key相同)
+
+    example:
+
+        class HmacSHA512Scheme(SignatureScheme):
+            name = 'hmac-sha512'
+
+            def sign(self, key, data):
+                return b64encode(hmac.new(
+                    key.encode(), data, hashlib.sha512).digest())
+
+            def verify(self, key, sign, data):
+                return hmac.compare_digest(sign, self.sign(key, data))
+
+        register_signature_scheme(HmacSHA512Scheme())
+    """
+
+    name = None
+
+    def sign(self, private_key: str, data: bytes) -> str:
+        raise NotImplementedError
+
+    def verify(self, key: str, sign: str, data: bytes) -> bool:
+        raise NotImplementedError
+
+    def verify_parts(self, key: str, sign: str, parts: list) -> bool:
+        """
+        parts: 分段的待签名数据, 支持增量hash的算法不拼接
+        """
+        return self.verify(key, sign, b''.join(parts))
+
+
+class RSAScheme(SignatureScheme):
+    """
+    RSA PKCS#1 v1.5 + SHA256
+    """
+
+    name = 'rsa'
+
+    def sign(self, private_key, data):
+        return b64encode(
+            load_rsa_scheme(private_key, False).sign(SHA256.new(data)))
+
+    def verify(self, key, sign, data):
+        return load_rsa_scheme(key, False).verify(
+            SHA256.new(data), base64.b64decode(sign))
+
+    def verify_parts(self, key, sign, parts):
+        digest = SHA256.new()
+        for part in parts:
+            digest.update(part)
+        return load_rsa_scheme(key, False).verify(
+            digest, base64.b64decode(sign))
+
+
+class HmacSHA256Scheme(SignatureScheme):
+    """
+    HMAC-SHA256, 客户端和服务端使用相同的密钥
+    """
+
+    name = 'hmac-sha256'
+
+    def sign(self, private_key, data):
+        return b64encode(hmac.new(
+            private_key.encode(), data, hashlib.sha256).digest())
+
+    def verify(self, key, sign, data):
+        return hmac.compare_digest(
+            sign.encode(), self.sign(key, data).encode())
+
+    def verify_parts(self, key, sign, parts):
+        mac = hmac.new(key.encode(), digestmod=hashlib.sha256)
+        for part in parts:
+            mac.update(part)
+        return hmac.compare_digest(
+            sign.encode(), b64encode(mac.digest()).encode())
+
+
+class CryptographyEd25519():
+    """
+    cryptography实现, 与eddsa接口一致
+    """
+
+    def __init__(self, key):
+        if isinstance(key, str):
+            key = key.encode()
+        if b'PRIVATE' in key:
+            self.private_key = load_pem_private_key(key, None)
+            self.public_key = self.private_key.public_key()
+        else:
+            self.private_key = None
+            self.public_key = load_pem_public_key(key)
+
+    def sign(self, data):
+        return self.private_key.sign(data)
+
+    def verify(self, data, signature):
+        try:
+            self.public_key.verify(signature, data)
+        except InvalidSignature:
+            raise ValueError("The signature is not authentic")
+
+
+@functools.lru_cache(maxsize=32)
+def load_ed25519_scheme(key):
+    """
+    解析PEM格式的Ed25519密钥, 按密钥缓存
+    安装cryptography时使用cryptography, 否则使用PyCryptodome
+    """
+    if load_pem_public_key is not None:
+        return CryptographyEd25519(key)
+    return eddsa.new(ECC.import_key(key), 'rfc8032')
+
+
+class Ed25519Scheme(SignatureScheme):
+    """
+    Ed25519, 密钥为PEM格式
+    """
+
+    name = 'ed25519'
+
+    def sign(self, private_key, data):
+        return b64encode(load_ed25519_scheme(private_key).sign(data))
+
+    def verify(self, key, sign, data):
+        try:
+            load_ed25519_scheme(key).verify(data, base64.b64decode(sign))
+        except ValueError:
+            return False
+        return True
+
+
+SIGNATURE_SCHEMES = {}
+
+
+def register_signature_scheme(scheme: SignatureScheme):
+    SIGNATURE_SCHEMES[scheme.name] = scheme
+
+
+for _scheme in [RSAScheme(), HmacSHA256Scheme(), Ed25519Scheme()]:
+    register_signature_scheme(_scheme)
+
+
+class SignatureKey():
+    """
+    签名密钥
+    ---
+    key_id: header Sign-Key
+    scheme: 算法名
+    key: 验签密钥
+    private_key: 签名密钥, 对称算法默认与key相同
+    """
+
+    def __init__(self, key_id, scheme, key, private_key=None):
+        self.key_id = key_id
+        self.scheme = scheme
+        self.key = key
+        if private_key is None and scheme.startswith('hmac'):
+            private_key = key
+        self.private_key = private_key
+
+    def get_scheme(self) -> SignatureScheme:
+        return SIGNATURE_SCHEMES[self.scheme]
+
+    def sign(self, data: bytes) -> str:
+        return self.get_scheme().sign(self.private_key, data)
+
+    def verify(self, sign: str, data: bytes) -> bool:
+        return self.get_scheme().verify(self.key, sign, data)
+
+    def verify_parts(self, sign: str, parts: list) -> bool:
+        return self.get_scheme().verify_parts(self.key, sign, parts)
+
+
 class ApiSignature():
+    """
+    接口签名, 支持多个算法和多个同时生效的密钥
+    ---
+    default: SIGNATURE_PUBLIC_KEY/SIGNATURE_PRIVATE_KEY, rsa
+    settings.SIGNATURE_KEYS: {key_id: {'scheme':, 'key':, 'private_key':}}
+
+    选择密钥:
+        key_id(header Sign-Key): 使用对应的密钥, scheme需要一致
+        scheme(header Sign-Alg): 依次尝试该算法的所有密钥, 用于密钥轮换
+        都没有: default
+    """
+
+    DEFAULT_KEY_ID = 'default'
+
     public_key = settings.SIGNATURE_PUBLIC_KEY
     private_key = settings.SIGNATURE_PRIVATE_KEY
+    keys = None
+
+    @classmethod
+    def get_keys(cls) -> dict:
+        if cls.keys is None:
+            keys = {
+                cls.DEFAULT_KEY_ID: SignatureKey(
+                    cls.DEFAULT_KEY_ID, RSAScheme.name,
+                    cls.public_key, cls.private_key),
+            }
+            for key_id, conf in getattr(
+                    settings, 'SIGNATURE_KEYS', {}).items():
+                if conf['scheme'] not in SIGNATURE_SCHEMES:
+                    raise ValueError("signature scheme error: {}".format(
+                        conf['scheme']))
+                keys[key_id] = SignatureKey(
+                    key_id, conf['scheme'], conf['key'],
+                    conf.get('private_key'))
+            cls.keys = keys
+        return cls.keys
+
+    def get_verify_keys(self, key_id=None, scheme=None) -> list:
+        keys = self.get_keys()
+        if key_id:
+            key = keys.get(key_id)
+            if key is None or (scheme and key.scheme != scheme):
+                return []
+            return [key]
+        if scheme:
+            return [key for key in keys.values() if key.scheme == scheme]
+        return [keys[self.DEFAULT_KEY_ID]]
+
+    def signature(self, json_str: str, key_id=None) -> str:
+        key = self.get_keys()[key_id or self.DEFAULT_KEY_ID]
+        return key.sign(json_str.encode())
+
+    def verify(self, sign: str, json_str: str, key_id=None,
+               scheme=None) -> bool:
+        data = json_str.encode()
+        for key in self.get_verify_keys(key_id, scheme):
+            if key.verify(sign, data):
+                return True
+        return False
 
-    def signature(self, json_str: str) -> str:
-        return Signature(self.private_key).rsa_sign(json_str, decode=False)
+    def verify_parts(self, sign: str, parts, key_id=None,
+                     scheme=None) -> bool:
+        """
+        parts: 分段的待签名数据, 例如iter_param_sort的结果
+        """
+        keys = self.get_verify_keys(key_id, scheme)
+        if len(keys) > 1:
+            parts = list(parts)
+        for key in keys:
+            if key.verify_parts(sign, parts):
+                return True
+        return False
 
-    def verify(self, sign: str, json_str: str) -> bool:
-        return Signature(self.public_key).rsa_verify(
-            sign, json_str, decode=False)
+    @classmethod
+    def reload(cls, public_key=None, private_key=None):
+        """
+        密钥轮换, 默认重新读取settings, 并预先解析新密钥
+        """
+        cls.public_key = public_key or settings.SIGNATURE_PUBLIC_KEY
+        cls.private_key = private_key or settings.SIGNATURE_PRIVATE_KEY
+        cls.keys = None
+        load_rsa_scheme.cache_clear()
+        load_ed25519_scheme.cache_clear()
+        for key in cls.get_keys().values():
+            for val in [key.key, key.private_key]:
+                if not val:
+                    continue
+                if key.scheme == RSAScheme.name:
+                    load_rsa_scheme(val, False)
+                elif key.scheme == Ed25519Scheme.name:
+                    load_ed25519_scheme(val)
@@ -1,2 +1,4 @@
 from .redis import *  # noqa
-from .caches import ProxyCache  # noqa
+from .caches import ProxyCache, AsyncProxyCache  # noqa
+from .local import LocalCache  # noqa
+from .codecs import Codec, register_codec  # noqa
@@ -1,29 +1,31 @@
-import json
-import datetime
-import pickle
-import ast
-from django.core.serializers.json import DjangoJSONEncoder
-from django.utils import timezone
-from .redis import OriginRedisClient
+import time
+import inspect
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections
+from . import codecs
+from .codecs import ApiJSONEncoder, RawJSON  # noqa
+from .redis import OriginRedisClient, BaseRedisClient, OriginAioRedisClient
 
-
-class ApiJSONEncoder(DjangoJSONEncoder):
-
-    def default(self, o):
-        if isinstance(o, datetime.datetime):
-            o = timezone.localtime(o)
-        return super().default(o)
+logger = logging.getLogger(__name__)
 
 
 class ProxyCache():
 
-    def __init__(self, key, ts, args=[], convert='json'):
+    # 软过期后台刷新线程池, settings.PROXY_CACHE_REFRESH_WORKERS
+    _refresh_executor = None
+    _refresh_executor_lock = threading.Lock()
+
+    def __init__(self, key, ts, args=[], convert='json', tags=[]):
         """
         Cache Data
             key: cache key
             ts: cache time
             args: cache key params
-            convert: json|pickle|object
+            convert: json|pickle|object|raw|msgpack, 见codecs.register_codec
+            tags: 写入时登记到tag集合, 通过clear_by_tag删除
         """
         self.client = OriginRedisClient().get_conn()
         self.key = key
@@ -31,29 +33,15 @@ class ProxyCache():
             self.key = self.key.format(*args)
         self.ts = ts
         self.convert = convert
+        self.tags = tags
 
     @classmethod
     def loads(cls, data, convert):
-        if convert == 'json':
-            return json.loads(data.decode())
-        elif convert == 'object':
-            return pickle.loads(data)
-        elif convert == 'pickle':
-            data = ast.literal_eval(data.decode())
-            return pickle.loads(data)
-        else:
-            raise NotImplementedError
+        return codecs.loads(data, convert)
 
     @classmethod
     def dumps(cls, data, convert):
-        if convert == 'json':
-            return json.dumps(data, cls=ApiJSONEncoder)
-        elif convert == 'object':
-            return pickle.dumps(data)
-        elif convert == 'pickle':
-            return str(pickle.dumps(data))
-        else:
-            raise NotImplementedError
+        return codecs.dumps(data, convert)
 
     def get_or_cache(self, callback, *args, **kwargs):
         if (data := self.get()) is not None:
@@ -63,6 +51,90 @@ class ProxyCache():
             self.set(data)
         return data
 
+    def get_or_lock(self, callback, *args, soft_ts=0, lock_ts=10, wait_ts=2,
+                    **kwargs):
+        """
+        单进程重建缓存, 防止缓存失效时大量请求同时回源
+            soft_ts: 软过期时间(秒), 超过后获得锁的请求提交后台刷新,
+                     所有请求立即返回旧数据, 刷新失败时保留旧数据
+            lock_ts: 重建锁超时时间
+            wait_ts: 未获得锁时等待其他进程重建的最长时间
+        """
+        pipe = self.client.pipeline(transaction=False)
+        pipe.get(self.key)
+        pipe.ttl(self.key)
+        data, ttl = pipe.execute()
+        if data is not None:
+            data = self.loads(data, self.convert)
+            if not soft_ts or not self.ts or ttl < 0 or \
+                    self.ts - ttl < soft_ts:
+                return data
+            lock = self.get_lock(lock_ts)
+            if not lock.acquire(blocking=False):
+                return data
+            try:
+                self.get_refresh_executor().submit(
+                    self._refresh, lock, callback, *args, **kwargs)
+            except RuntimeError:
+                # 解释器退出时不能提交
+                self._release(lock)
+            return data
+
+        lock = self.get_lock(lock_ts)
+        deadline = time.monotonic() + wait_ts
+        while not lock.acquire(blocking=False):
+            if time.monotonic() > deadline:
+                return callback(*args, **kwargs)
+            time.sleep(0.05)
+            if (data := self.get()) is not None:
+                return data
+        try:
+            return self._rebuild(callback, *args, **kwargs)
+        finally:
+            self._release(lock)
+
+    def get_lock(self, lock_ts):
+        return self.client.lock(
+            "qx_base:lock:{}".format(self.key), timeout=lock_ts,
+            thread_local=False)
+
+    @classmethod
+    def get_refresh_executor(cls) -> ThreadPoolExecutor:
+        if cls._refresh_executor is None:
+            with cls._refresh_executor_lock:
+                if cls._refresh_executor is None:
+                    cls._refresh_executor = ThreadPoolExecutor(
+                        max_workers=getattr(
+                            settings, 'PROXY_CACHE_REFRESH_WORKERS', 4),
+                        thread_name_prefix='proxy-cache-refresh')
+        return cls._refresh_executor
+
+    def _refresh(self, lock, callback, *args, **kwargs):
+        """
+        后台刷新软过期的缓存, 失败时保留旧数据等待下次刷新
+        """
+        try:
+            self._rebuild(callback, *args, **kwargs)
+        except Exception:
+            logger.exception('refresh cache error: %s', self.key)
+        finally:
+            self._release(lock)
+            close_old_connections()
+
+    def _rebuild(self, callback, *args, **kwargs):
+        data = callback(*args, **kwargs)
+        if data:
+            self.set(data)
+        return data
+
+    @staticmethod
+    def _release(lock):
+        try:
+            lock.release()
+        except Exception:
+            # 锁已超时被其他进程获取
+            pass
+
     def get(self):
         data = self.client.get(self.key)
         if data:
@@ -73,10 +145,48 @@ class ProxyCache():
         if data is None:
             return
         data = self.dumps(data, self.convert)
+        client = self.client
+        if self.tags:
+            client = self.client.pipeline(transaction=False)
         if self.ts:
-            self.client.set(self.key, data, self.ts)
+            client.set(self.key, data, self.ts)
         else:
-            self.client.set(self.key, data)
+            client.set(self.key, data)
+        if self.tags:
+            for tag in self.tags:
+                BaseRedisClient.add_tag(client, tag, self.key, self.ts)
+            client.execute()
+
+    @classmethod
+    def get_many(cls, keys, convert='json') -> list:
+        """
+        一次mget获取多个key, 未命中为None
+        """
+        if not keys:
+            return []
+        client = OriginRedisClient().get_conn()
+        return [
+            cls.loads(data, convert) if data else None
+            for data in client.mget(keys)
+        ]
+
+    @classmethod
+    def set_many(cls, data: dict, ts, convert='json'):
+        """
+        一次pipeline写入多个key
+            data: {key: value}
+        """
+        if not data:
+            return
+        pipe = OriginRedisClient().get_conn().pipeline(transaction=False)
+        for key, value in data.items():
+            if value is None:
+                continue
+            if ts:
+                pipe.set(key, cls.dumps(value, convert), ts)
+            else:
+                pipe.set(key, cls.dumps(value, convert))
+        pipe.execute()
 
     def delete(self):
         self.client.delete(self.key)
@@ -84,3 +194,94 @@ class ProxyCache():
     def delete_keys(self):
         self.client.clear_by_pattern(self.key)
         return True
+
+
+class AsyncProxyCache():
+    """
+    ProxyCache的asyncio版本, 使用redis.asyncio, 参数和序列化方式相同
+
+    example:
+
+        proxy = AsyncProxyCache(key, 60, convert='model')
+        user = await proxy.get_or_cache(load_user, user_id)
+    """
+
+    def __init__(self, key, ts, args=[], convert='json', tags=[]):
+        self.client = OriginAioRedisClient().get_conn()
+        self.key = key
+        if args:
+            self.key = self.key.format(*args)
+        self.ts = ts
+        self.convert = convert
+        self.tags = tags
+
+    @classmethod
+    def loads(cls, data, convert):
+        return codecs.loads(data, convert)
+
+    @classmethod
+    def dumps(cls, data, convert):
+        return codecs.dumps(data, convert)
+
+    async def get_or_cache(self, callback, *args, **kwargs):
+        """
+        callback: 普通函数或async函数
+        """
+        if (data := await self.get()) is not None:
+            return data
+        data = callback(*args, **kwargs)
+        if inspect.isawaitable(data):
+            data = await data
+        if data:
+            await self.set(data)
+        return data
+
+    async def get(self):
+        data = await self.client.get(self.key)
+        if data:
+            return self.loads(data, self.convert)
+        return data
+
+    async def set(self, data):
+        if data is None:
+            return
+        data = self.dumps(data, self.convert)
+        pipe = self.client.pipeline(transaction=False)
+        if self.ts:
+            pipe.set(self.key, data, self.ts)
+        else:
+            pipe.set(self.key, data)
+        for tag in self.tags:
+            BaseRedisClient.add_tag(pipe, tag, self.key, self.ts)
+        await pipe.execute()
+
+    @classmethod
+    async def get_many(cls, keys, convert='json') -> list:
+        if not keys:
+            return []
+        client = OriginAioRedisClient().get_conn()
+        return [
+            cls.loads(data, convert) if data else None
+            for data in await client.mget(keys)
+        ]
+
+    @classmethod
+    async def set_many(cls, data: dict, ts, convert='json'):
+        if not data:
+            return
+        pipe = OriginAioRedisClient().get_conn().pipeline(transaction=False)
+        for key, value in data.items():
+            if value is None:
+                continue
+            if ts:
+                pipe.set(key, cls.dumps(value, convert), ts)
+            else:
+                pipe.set(key, cls.dumps(value, convert))
+        await pipe.execute()
+
+    async def delete(self):
+        await self.client.delete(self.key)
+
+    async def delete_keys(self):
+        await OriginAioRedisClient().clear_by_pattern(self.key)
+        return True
@@ -0,0 +1,443 @@
+import ast
+import json
+import zlib
+import uuid
+import pickle
+import decimal
+import hashlib
+import datetime
+from django.apps import apps
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:  # pragma: no cover
+    lz4_frame = None
+
+
+class ApiJSONEncoder(DjangoJSONEncoder):
+
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            o = timezone.localtime(o)
+        return super().default(o)
+
+
+API_JSON_ENCODER = ApiJSONEncoder()
+
+
+def json_dumps(data) -> bytes:
+    """
+    json编码, 安装orjson时使用orjson, 输出格式与ApiJSONEncoder一致
+    """
+    if orjson is not None:
+        return orjson.dumps(
+            data, default=API_JSON_ENCODER.default,
+            option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, cls=ApiJSONEncoder).encode()
+
+
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class RawJSON(bytes):
+    """
+    已编码的json数据, 直接写入response, 不再序列化
+    """
+
+    @classmethod
+    def dumps(cls, data) -> 'RawJSON':
+        if isinstance(data, bytes):
+            return cls(data)
+        return cls(json_dumps(data))
+
+
+class Codec():
+    """
+    ProxyCache序列化方式
+    ---
+    name: ProxyCache convert参数
+    id: 写入header的编号(1-7)
+    legacy: 旧版本已支持的格式, PROXY_CACHE_LEGACY_FORMAT开启时
+            写入没有header的旧格式, 兼容滚动发布中的旧进程
+
+    example:
+
+        class YamlCodec(Codec):
+            name = 'yaml'
+            id = 6
+
+            def dumps(self, data):
+                return yaml.dump(data).encode()
+
+            def loads(self, data):
+                return yaml.safe_load(data)
+
+        register_codec(YamlCodec())
+    """
+
+    name = None
+    id = None
+    legacy = False
+
+    def dumps(self, data) -> bytes:
+        raise NotImplementedError
+
+    def loads(self, data):
+        raise NotImplementedError
+
+    def legacy_dumps(self, data) -> bytes:
+        """
+        写入没有header的旧数据
+        """
+        return self.dumps(data)
+
+    def legacy_loads(self, data):
+        """
+        读取没有header的旧数据
+        """
+        return self.loads(data)
+
+
+class JSONCodec(Codec):
+
+    name = 'json'
+    id = 1
+    legacy = True
+
+    def dumps(self, data):
+        return json_dumps(data)
+
+    def loads(self, data):
+        return json_loads(data)
+
+
+class RawCodec(JSONCodec):
+
+    name = 'raw'
+    id = 2
+    legacy = False
+
+    def dumps(self, data):
+        return RawJSON.dumps(data)
+
+    def loads(self, data):
+        return RawJSON(data)
+
+
+class PickleCodec(Codec):
+
+    name = 'object'
+    id = 3
+    legacy = True
+
+    def dumps(self, data):
+        return pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+
+    def loads(self, data):
+        return pickle.loads(data)
+
+
+class LegacyPickleCodec(PickleCodec):
+    """
+    旧版本存储str(pickle.dumps(data)), 新数据与object相同
+    """
+
+    name = 'pickle'
+
+    def legacy_dumps(self, data):
+        return str(pickle.dumps(data)).encode()
+
+    def legacy_loads(self, data):
+        return pickle.loads(ast.literal_eval(data.decode()))
+
+
+class MsgpackCodec(Codec):
+    """
+    msgpack, 支持datetime, date, time, Decimal, UUID
+    """
+
+    name = 'msgpack'
+    id = 4
+
+    EXT_DATETIME = 1
+    EXT_DATE = 2
+    EXT_TIME = 3
+    EXT_DECIMAL = 4
+    EXT_UUID = 5
+
+    def dumps(self, data):
+        return msgpack.packb(data, default=self.encode_ext,
+                             use_bin_type=True)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, ext_hook=self.decode_ext, raw=False,
+                               strict_map_key=False)
+
+    @classmethod
+    def encode_ext(cls, o):
+        if isinstance(o, datetime.datetime):
+            return msgpack.ExtType(cls.EXT_DATETIME, o.isoformat().encode())
+        elif isinstance(o, datetime.date):
+            return msgpack.ExtType(cls.EXT_DATE, o.isoformat().encode())
+        elif isinstance(o, datetime.time):
+            return msgpack.ExtType(cls.EXT_TIME, o.isoformat().encode())
+        elif isinstance(o, decimal.Decimal):
+            return msgpack.ExtType(cls.EXT_DECIMAL, str(o).encode())
+        elif isinstance(o, uuid.UUID):
+            return msgpack.ExtType(cls.EXT_UUID, o.bytes)
+        raise TypeError("Object of type {} is not msgpack serializable"
+                        .format(type(o).__name__))
+
+    @classmethod
+    def decode_ext(cls, code, data):
+        if code == cls.EXT_DATETIME:
+            return datetime.datetime.fromisoformat(data.decode())
+        elif code == cls.EXT_DATE:
+            return datetime.date.fromisoformat(data.decode())
+        elif code == cls.EXT_TIME:
+            return datetime.time.fromisoformat(data.decode())
+        elif code == cls.EXT_DECIMAL:
+            return decimal.Decimal(data.decode())
+        elif code == cls.EXT_UUID:
+            return uuid.UUID(bytes=data)
+        return msgpack.ExtType(code, data)
+
+
+class ModelCodec(PickleCodec):
+    """
+    model实例快照, 只存储concrete字段值, 通过Model.from_db还原
+    ---
+    data: model实例或实例列表(queryset)
+    存储: (app_label.model_name, schema hash, db, many, rows),
+          row为按字段声明顺序的值tuple, 有延迟加载字段时为{attname: value}
+    字段变化后schema hash不一致, 返回None重新查询
+    """
+
+    name = 'model'
+    id = 5
+    # 旧版本以object(pickle)写入同样的key
+    legacy = True
+
+    _schema_hashes = {}
+
+    @classmethod
+    def schema_hash(cls, model) -> str:
+        if (val := cls._schema_hashes.get(model)) is None:
+            schema = ','.join(
+                '{}:{}'.format(field.attname, field.get_internal_type())
+                for field in model._meta.concrete_fields)
+            val = hashlib.md5(schema.encode()).hexdigest()[:8]
+            cls._schema_hashes[model] = val
+        return val
+
+    @staticmethod
+    def get_row(ins):
+        fields = ins._meta.concrete_fields
+        deferred = ins.get_deferred_fields()
+        if deferred:
+            return {
+                field.attname: getattr(ins, field.attname)
+                for field in fields
+                if field.attname not in deferred
+            }
+        return tuple(getattr(ins, field.attname) for field in fields)
+
+    def dumps(self, data):
+        many = not hasattr(data, '_meta')
+        objs = list(data) if many else [data]
+        if objs:
+            model = objs[0].__class__
+            db = objs[0]._state.db
+        else:
+            model, db = None, None
+        snapshot = (
+            model._meta.label_lower if model else None,
+            self.schema_hash(model) if model else None,
+            db,
+            many,
+            [self.get_row(ins) for ins in objs],
+        )
+        return super().dumps(snapshot)
+
+    def loads(self, data):
+        label, schema_hash, db, many, rows = super().loads(data)
+        if label is None:
+            return []
+        try:
+            model = apps.get_model(label)
+        except LookupError:
+            return None
+        if schema_hash != self.schema_hash(model):
+            return None
+        attnames = [field.attname for field in model._meta.concrete_fields]
+        objs = []
+        for row in rows:
+            if isinstance(row, dict):
+                objs.append(model.from_db(db, list(row), list(row.values())))
+            else:
+                objs.append(model.from_db(db, attnames, row))
+        return objs if many else objs[0]
+
+    def legacy_dumps(self, data):
+        if not hasattr(data, '_meta'):
+            data = list(data)
+        return pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+
+    def legacy_loads(self, data):
+        return pickle.loads(data)
+
+
+class Compressor():
+    """
+    压缩方式, flag写入header的3-4位
+    """
+
+    name = None
+    flag = None
+
+    def compress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data: bytes) -> bytes:
+        raise NotImplementedError
+
+
+class ZlibCompressor(Compressor):
+
+    name = 'zlib'
+    flag = 0x08
+
+    def compress(self, data):
+        return zlib.compress(data)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class ZstdCompressor(Compressor):
+
+    name = 'zstd'
+    flag = 0x10
+
+    def compress(self, data):
+        return zstandard.ZstdCompressor().compress(data)
+
+    def decompress(self, data):
+        return zstandard.ZstdDecompressor().decompress(data)
+
+
+class Lz4Compressor(Compressor):
+
+    name = 'lz4'
+    flag = 0x18
+
+    def compress(self, data):
+        return lz4_frame.compress(data)
+
+    def decompress(self, data):
+        return lz4_frame.decompress(data)
+
+
+CODECS = {}
+CODEC_IDS = {}
+COMPRESSORS = {}
+COMPRESSOR_FLAGS = {}
+
+# header: 0x01-0x1f, 低3位codec, 3-4位压缩方式.
+# 旧数据以json字符(>=0x20)或pickle协议头(0x80)开头, 不会冲突
+HEADER_MAX = 0x1f
+CODEC_MASK = 0x07
+COMPRESSOR_MASK = 0x18
+
+
+def register_codec(codec: Codec):
+    if not codec.id or codec.id & ~CODEC_MASK:
+        raise ValueError("codec id must be in 1-7")
+    CODECS[codec.name] = codec
+    CODEC_IDS.setdefault(codec.id, codec)
+
+
+def register_compressor(compressor: Compressor):
+    COMPRESSORS[compressor.name] = compressor
+    COMPRESSOR_FLAGS[compressor.flag] = compressor
+
+
+for _codec in [JSONCodec(), RawCodec(), PickleCodec(), LegacyPickleCodec(),
+               MsgpackCodec(), ModelCodec()]:
+    register_codec(_codec)
+for _compressor in [ZlibCompressor(), ZstdCompressor(), Lz4Compressor()]:
+    register_compressor(_compressor)
+
+
+def get_codec(name) -> Codec:
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise NotImplementedError
+
+
+def get_compressor():
+    """
+    settings.PROXY_CACHE_COMPRESS: zlib|zstd|lz4
+    """
+    name = getattr(settings, 'PROXY_CACHE_COMPRESS', None)
+    if not name:
+        return None
+    return COMPRESSORS[name]
+
+
+def dumps(data, convert) -> bytes:
+    """
+    header + (压缩)数据, 超过PROXY_CACHE_COMPRESS_MIN_SIZE时压缩
+    ---
+    settings.PROXY_CACHE_LEGACY_FORMAT(默认True): json|object|pickle|model
+    写入旧格式且不压缩, 所有进程升级后关闭
+    """
+    codec = get_codec(convert)
+    if codec.legacy and getattr(
+            settings, 'PROXY_CACHE_LEGACY_FORMAT', True):
+        return codec.legacy_dumps(data)
+    payload = codec.dumps(data)
+    header = codec.id
+    compressor = get_compressor()
+    if compressor and len(payload) >= getattr(
+            settings, 'PROXY_CACHE_COMPRESS_MIN_SIZE', 1024):
+        compressed = compressor.compress(payload)
+        if len(compressed) < len(payload):
+            payload = compressed
+            header |= compressor.flag
+    return bytes([header]) + payload
+
+
+def loads(data: bytes, convert):
+    header = data[0] if data else None
+    if header is None or header > HEADER_MAX:
+        return get_codec(convert).legacy_loads(data)
+    codec = CODEC_IDS[header & CODEC_MASK]
+    if convert in CODECS and CODECS[convert].id == codec.id:
+        codec = CODECS[convert]
+    payload = data[1:]
+    if flag := header & COMPRESSOR_MASK:
+        payload = COMPRESSOR_FLAGS[flag].decompress(payload)
+    return codec.loads(payload)
@@ -0,0 +1,226 @@
+import os
+import json
+import time
+import fnmatch
+import logging
+import threading
+from collections import OrderedDict
+from .redis import RedisClient
+
+logger = logging.getLogger(__name__)
+
+
+LOCAL_CACHE_CHANNEL = "qx_base:localcache:invalidate"
+
+
+class LocalCache():
+    """
+    进程内LRU缓存, 作为redis前的一级缓存
+    ---
+    maxsize: 最大key数量
+    timeout: 默认缓存时间(秒)
+    broadcast: 是否订阅redis失效广播
+
+    example:
+
+        cache = LocalCache(maxsize=1000, timeout=5)
+        cache.set('key', data)
+        cache.get('key')
+        LocalCache.invalidate('key*', is_pattern=True)
+    """
+
+    def __init__(self, maxsize=1000, timeout=60, broadcast=True):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.broadcast = broadcast
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        LocalCacheSubscriber.register(self)
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expired, value = item
+            if expired < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        if value is None:
+            return
+        if self.broadcast:
+            LocalCacheSubscriber.start()
+        expired = time.monotonic() + (timeout or self.timeout)
+        with self._lock:
+            self._data[key] = (expired, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def delete_pattern(self, key_pattern):
+        if not key_pattern.endswith('*'):
+            key_pattern = "{}*".format(key_pattern)
+        with self._lock:
+            if '*' not in key_pattern[:-1]:
+                prefix = key_pattern[:-1]
+                keys = [key for key in self._data if key.startswith(prefix)]
+            else:
+                keys = fnmatch.filter(self._data.keys(), key_pattern)
+            for key in keys:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    @staticmethod
+    def evict(key, is_pattern=False):
+        """
+        删除当前进程所有一级缓存的key
+        """
+        for cache in LocalCacheSubscriber.caches:
+            if is_pattern:
+                cache.delete_pattern(key)
+            else:
+                cache.delete(key)
+
+    @staticmethod
+    def invalidate(key, is_pattern=False, client=None):
+        """
+        删除当前进程的key并广播到其他进程
+            client: redis client或pipeline, 可与删除命令合并发送
+        """
+        LocalCache.evict(key, is_pattern)
+        if client is None:
+            client = RedisClient().get_conn()
+        client.publish(
+            LOCAL_CACHE_CHANNEL, LocalCache.message(key, is_pattern))
+
+    @staticmethod
+    def message(key, is_pattern=False) -> str:
+        return json.dumps([key, is_pattern])
+
+
+class LocalCacheSubscriber():
+    """
+    订阅redis失效广播, 每个进程一个后台线程
+    """
+
+    caches = []
+    _thread = None
+    _pid = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def register(cls, cache):
+        cls.caches.append(cache)
+
+    @classmethod
+    def start(cls):
+        if cls._pid == os.getpid():
+            return
+        with cls._lock:
+            if cls._pid == os.getpid():
+                return
+            # fork后清理父进程继承的数据
+            for cache in cls.caches:
+                cache.clear()
+            try:
+                pubsub = RedisClient().get_conn().pubsub(
+                    ignore_subscribe_messages=True)
+                pubsub.subscribe(**{LOCAL_CACHE_CHANNEL: cls.on_message})
+                cls._thread = pubsub.run_in_thread(
+                    sleep_time=1, daemon=True,
+                    exception_handler=cls.on_exception)
+                cls._pid = os.getpid()
+            except Exception:
+                logger.exception("LocalCacheSubscriber start")
+
+    @classmethod
+    def on_message(cls, message):
+        try:
+            key, is_pattern = json.loads(message['data'])
+        except Exception:
+            logger.exception("LocalCacheSubscriber message")
+            return
+        LocalCache.evict(key, is_pattern)
+
+    @classmethod
+    def on_exception(cls, ex, pubsub, thread):
+        # 订阅中断期间无法收到广播, 清空一级缓存
+        logger.warning("LocalCacheSubscriber error: {}".format(ex))
+        for cache in cls.caches:
+            cache.clear()
+        time.sleep(1)
+
+
+class NonceCache():
+    """
+    防重放nonce记录, 按时间段存储到redis set
+    ---
+    name: 名称
+    expired: nonce有效时间(秒), 与timestamp允许的误差一致
+
+    nonce按请求timestamp分段, 每段一个redis set, 过期时间3个时间段.
+    每次检查只有一次SADD(返回0即重复), 一次往返;
+    每个进程在时间段第一次写入时同一pipeline中设置EXPIRE.
+    nonce是否使用过只能由redis确认, 进程内不做预判.
+
+    example:
+
+        cache = NonceCache('sign', expired=300)
+        if not cache.add(nonce, timestamp):
+            # 重复请求
+    """
+
+    def __init__(self, name, expired=5 * 60):
+        self.name = name
+        self.expired = expired
+        # 已设置过期时间的时间段
+        self._buckets = set()
+        self._lock = threading.Lock()
+
+    def get_key_name(self, bucket) -> str:
+        return "qx_base:nonce:{}:{}".format(self.name, bucket)
+
+    def need_expire(self, bucket) -> bool:
+        """
+        时间段在当前进程第一次写入, 只保留当前前后时间段的记录
+        """
+        if bucket in self._buckets:
+            return False
+        with self._lock:
+            if bucket in self._buckets:
+                return False
+            current = int(time.time()) // self.expired
+            self._buckets = {
+                key for key in self._buckets if abs(key - current) <= 1}
+            self._buckets.add(bucket)
+            return True
+
+    def add(self, nonce, timestamp) -> bool:
+        """
+        return: True新的nonce, False重复
+        """
+        bucket = int(timestamp) // self.expired
+        name = self.get_key_name(bucket)
+        client = RedisClient().get_conn()
+        if self.need_expire(bucket):
+            pipe = client.pipeline(transaction=False)
+            pipe.sadd(name, nonce)
+            pipe.expire(name, self.expired * 3)
+            added = pipe.execute()[0]
+        else:
+            added = client.sadd(name, nonce)
+        return bool(added)
@@ -1,23 +1,270 @@
+import time
+import uuid
 import typing
+import threading
 import redis
-import aioredis
+import redis.asyncio
+import redis.asyncio.cluster
 import logging
 import json
 import decimal
 from django.conf import settings
 from django.utils import timezone
+from redis.cluster import RedisCluster, ClusterNode
 from ..tools import Singleton, AioSingleton
+from .routing import ShardedRedis, AioShardedRedis, QxRedisCluster
 
 logger = logging.getLogger(__name__)
 
 
+class PoolStatsMixin():
+    """
+    连接池统计: 已创建/使用中的连接数, 获取连接的等待时间和超时次数
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._stats_lock = threading.Lock()
+        self.wait_count = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.timeout_count = 0
+        super().__init__(*args, **kwargs)
+
+    def get_connection(self, command_name, *keys, **options):
+        start = time.monotonic()
+        try:
+            return super().get_connection(command_name, *keys, **options)
+        except redis.ConnectionError:
+            with self._stats_lock:
+                self.timeout_count += 1
+            raise
+        finally:
+            elapsed = time.monotonic() - start
+            with self._stats_lock:
+                self.wait_count += 1
+                self.wait_time += elapsed
+                self.max_wait_time = max(self.max_wait_time, elapsed)
+
+    def stats(self) -> dict:
+        created, in_use = self.get_connection_counts()
+        with self._stats_lock:
+            return {
+                'max_connections': self.max_connections,
+                'created': created,
+                'in_use': in_use,
+                'wait_count': self.wait_count,
+                'wait_time': self.wait_time,
+                'max_wait_time': self.max_wait_time,
+                'timeout_count': self.timeout_count,
+            }
+
+
+class StatsConnectionPool(PoolStatsMixin, redis.ConnectionPool):
+
+    def get_connection_counts(self):
+        with self._lock:
+            return self._created_connections, len(self._in_use_connections)
+
+
+class StatsBlockingConnectionPool(PoolStatsMixin,
+                                  redis.BlockingConnectionPool):
+
+    def get_connection_counts(self):
+        created = len(self._connections)
+        available = [conn for conn in list(self.pool.queue) if conn]
+        return created, created - len(available)
+
+
+class RawPipeline(redis.client.Pipeline):
+
+    def parse_response(self, connection, command_name, **options):
+        options[redis.client.NEVER_DECODE] = []
+        return super().parse_response(connection, command_name, **options)
+
+
+class RawRedis(redis.Redis):
+    """
+    不解码返回值, 与decode_responses的client共用连接池
+    """
+
+    def parse_response(self, connection, command_name, **options):
+        options[redis.client.NEVER_DECODE] = []
+        return super().parse_response(connection, command_name, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return RawPipeline(
+            self.connection_pool, self.response_callbacks, transaction,
+            shard_hint)
+
+
+class RedisPool(metaclass=Singleton):
+    """
+    RedisClient和OriginRedisClient共用的连接池
+    ---
+    settings.REDIS_POOL_OPTIONS:
+        max_connections: 最大连接数
+        blocking: 连接用完时等待, 否则直接报错
+        timeout: blocking时等待连接的最长时间(秒)
+        socket_timeout, socket_connect_timeout: 读写, 连接超时(秒)
+        socket_keepalive: tcp keepalive
+        health_check_interval: 连接空闲超过该时间(秒)时先PING检查
+        retry_on_timeout: 超时后重试一次
+
+    settings.REDIS_MODE:
+        single: 默认, 使用REDIS_HOST
+        sharded: 一致性hash分片到REDIS_NODES
+        cluster: redis cluster, REDIS_NODES为启动节点
+    settings.REDIS_NODES: [{
+        'host': '127.0.0.1', 'port': 6379, 'password': '', 'db': 0,
+        'replicas': [{'host': '127.0.0.1', 'port': 6380}],
+    }]
+    settings.REDIS_READ_FROM_REPLICAS: 读命令发送到从库
+    """
+
+    default_options = {
+        'max_connections': None,
+        'blocking': False,
+        'timeout': 20,
+        'socket_timeout': None,
+        'socket_connect_timeout': None,
+        'socket_keepalive': False,
+        'health_check_interval': 0,
+        'retry_on_timeout': False,
+    }
+
+    def __init__(self):
+        logger.debug("RedisPool Init")
+        self.mode = getattr(settings, 'REDIS_MODE', 'single')
+        self.read_from_replicas = getattr(
+            settings, 'REDIS_READ_FROM_REPLICAS', False)
+        self.options = dict(self.default_options)
+        self.options.update(getattr(settings, 'REDIS_POOL_OPTIONS', {}))
+        self.nodes = getattr(settings, 'REDIS_NODES', None) or [{
+            'host': settings.REDIS_HOST,
+            'port': settings.REDIS_PORT,
+            'password': settings.REDIS_PASSWORD,
+        }]
+        if self.mode == 'single':
+            self.nodes = self.nodes[:1]
+        self.clients = {}
+        self.node_pools = []
+        if self.mode == 'cluster':
+            self.pool = None
+            return
+        for node in self.nodes:
+            self.node_pools.append((
+                "{}:{}".format(node['host'], node['port']),
+                self.make_pool(node),
+                [self.make_pool(dict(node, **replica))
+                 for replica in node.get('replicas', [])],
+            ))
+        self.pool = self.node_pools[0][1]
+
+    def make_pool(self, node):
+        options = dict(self.options)
+        blocking = options.pop('blocking')
+        timeout = options.pop('timeout')
+        kwargs = dict(
+            host=node['host'],
+            port=node['port'],
+            password=node.get('password'),
+            decode_responses=True,
+            db=node.get('db', 0),
+            **options
+        )
+        if blocking:
+            kwargs['max_connections'] = kwargs['max_connections'] or 50
+            return StatsBlockingConnectionPool(timeout=timeout, **kwargs)
+        kwargs['max_connections'] = kwargs['max_connections'] or 2 ** 31
+        return StatsConnectionPool(**kwargs)
+
+    @property
+    def multi_node(self) -> bool:
+        """
+        key可能分布在多个节点, 多key命令和lua脚本需要按节点拆分
+        """
+        return self.mode == 'cluster' or len(self.node_pools) > 1
+
+    def get_conn(self, redis_class=redis.Redis):
+        if (client := self.clients.get(redis_class)) is not None:
+            return client
+        if self.mode == 'cluster':
+            options = dict(self.options)
+            for key in ['blocking', 'timeout']:
+                options.pop(key)
+            options['max_connections'] = options['max_connections'] or \
+                2 ** 31
+            node = self.nodes[0]
+            client = QxRedisCluster(
+                startup_nodes=[
+                    ClusterNode(item['host'], item['port'])
+                    for item in self.nodes],
+                password=node.get('password'),
+                decode_responses=redis_class is not RawRedis,
+                read_from_replicas=self.read_from_replicas,
+                **options)
+        elif len(self.node_pools) == 1 and not (
+                self.read_from_replicas and self.node_pools[0][2]):
+            return redis_class(connection_pool=self.pool)
+        else:
+            client = ShardedRedis([
+                (name, redis_class(connection_pool=pool),
+                 [redis_class(connection_pool=replica)
+                  for replica in replicas])
+                for name, pool, replicas in self.node_pools
+            ], self.read_from_replicas)
+        self.clients[redis_class] = client
+        return client
+
+    def stats(self) -> dict:
+        data = {}
+        for name, pool, replicas in self.node_pools:
+            data[name] = pool.stats()
+            for replica in replicas:
+                kwargs = replica.connection_kwargs
+                data["{}:{}".format(kwargs['host'], kwargs['port'])] = \
+                    replica.stats()
+        return data
+
+
 class BaseRedisClient():
     '''
     Get redis pool client
     '''
 
+    redis_class = redis.Redis
+
+    def __init__(self):
+        logger.debug("RedisClient Init")
+        self.pool = RedisPool().pool
+
     def get_conn(self) -> "redis.Redis":
-        return redis.Redis(connection_pool=self.pool)
+        return RedisPool().get_conn(self.redis_class)
+
+    def get_node_conns(self) -> list:
+        """
+        所有主节点client, 用于scan等需要在每个节点执行的命令
+        """
+        client = self.get_conn()
+        if hasattr(client, 'get_node_conns'):
+            return client.get_node_conns()
+        return [client]
+
+    @property
+    def multi_node(self) -> bool:
+        return RedisPool().multi_node
+
+    def pool_stats(self) -> dict:
+        if self.pool is None:
+            # cluster连接池由RedisCluster按节点管理
+            return {}
+        return self.pool.stats()
+
+    def all_pool_stats(self) -> dict:
+        """
+        return: {host:port: stats}
+        """
+        return RedisPool().stats()
 
     def clear_by_pattern(self, key_pattern: str) -> bool:
         if not key_pattern.endswith('*'):
@@ -25,63 +272,177 @@ class BaseRedisClient():
         else:
             key = key_pattern
         client = self.get_conn()
-        cur = '0'
+        for node_client in self.get_node_conns():
+            cur = '0'
+            while True:
+                cur, data = node_client.scan(cur, key, 50000)
+                self._unlink(client, data)
+                if int(cur) == 0:
+                    break
+        return True
+
+    @staticmethod
+    def tag_key(tag: str) -> str:
+        # {tag}: cluster和分片时与清理用的临时key在同一节点
+        return "qx_base:ztag:{{{}}}".format(tag)
+
+    @staticmethod
+    def add_tag(pipe, tag: str, key: str, ts: int):
+        """
+        登记key到tag集合(zset, score为key的过期时间),
+        同时删除已过期的成员, 集合大小不超过有效key数量
+            pipe: 同步或asyncio pipeline
+        """
+        tag_key = BaseRedisClient.tag_key(tag)
+        now = time.time()
+        pipe.zadd(tag_key, {key: now + ts if ts else '+inf'})
+        pipe.zremrangebyscore(tag_key, '-inf', now)
+        if ts:
+            pipe.expire(tag_key, ts)
+        else:
+            pipe.persist(tag_key)
+
+    def clear_by_tag(self, tag: str) -> bool:
+        """
+        删除tag集合中的所有key, 耗时只与tag中key数量相关
+        """
+        return self.clear_tag_key(self.tag_key(tag))
+
+    def clear_tag_key(self, tag_key: str) -> bool:
+        client = self.get_conn()
+        # 先改名, 清理期间新写入的key进入新的tag集合
+        tmp_key = "{}:clearing:{}".format(tag_key, uuid.uuid4().hex)
+        try:
+            client.rename(tag_key, tmp_key)
+        except redis.ResponseError:
+            # tag不存在
+            return True
+        cur = 0
         while True:
-            cur, data = client.scan(cur, key, 50000)
-            if len(data) > 30:
-                for _key in data:
-                    client.delete(_key)
-            else:
-                if data:
-                    client.delete(*data)
+            cur, data = client.zscan(tmp_key, cur, count=1000)
+            self._unlink(client, [key for key, _ in data])
             if int(cur) == 0:
                 break
+        client.unlink(tmp_key)
         return True
 
+    @staticmethod
+    def _unlink(client, keys, batch=1000):
+        if not keys:
+            return
+        if isinstance(client, RedisCluster):
+            # cluster按slot拆分执行
+            for start in range(0, len(keys), batch):
+                client.unlink(*keys[start:start + batch])
+            return
+        pipe = client.pipeline(transaction=False)
+        for start in range(0, len(keys), batch):
+            pipe.unlink(*keys[start:start + batch])
+        pipe.execute()
 
-class RedisClient(BaseRedisClient, metaclass=Singleton):
 
-    def __init__(self):
-        logger.debug("RedisClient Init")
-        self.pool = redis.ConnectionPool(
-            host=settings.REDIS_HOST,
-            port=settings.REDIS_PORT,
-            password=settings.REDIS_PASSWORD,
-            decode_responses=True,
-            db=0
-        )
+class RedisClient(BaseRedisClient, metaclass=Singleton):
+    pass
 
 
 class OriginRedisClient(BaseRedisClient, metaclass=Singleton):
 
+    redis_class = RawRedis
+
+
+class AioRedisPool(metaclass=AioSingleton):
+    """
+    redis.asyncio连接池, 每个event loop一个, 配置与RedisPool相同
+    sharded模式和从库读取使用AioShardedRedis, 与同步client的分片一致.
+    redis.asyncio的hiredis解析不支持按命令关闭解码, 解码和不解码各一个连接池
+    """
+
     def __init__(self):
-        logger.debug("RedisClient Init")
-        self.pool = redis.ConnectionPool(
-            host=settings.REDIS_HOST,
-            port=settings.REDIS_PORT,
-            password=settings.REDIS_PASSWORD,
-            decode_responses=False,
-            db=0
+        logger.debug("AioRedisPool Init")
+        sync_pool = RedisPool()
+        self.mode = sync_pool.mode
+        self.options = dict(sync_pool.options)
+        self.nodes = sync_pool.nodes
+        self.read_from_replicas = sync_pool.read_from_replicas
+        self.clients = {}
+
+    def make_client(self, decode_responses):
+        if self.mode == 'cluster':
+            options = dict(self.options)
+            for key in ['blocking', 'timeout']:
+                options.pop(key)
+            node = self.nodes[0]
+            options['max_connections'] = options['max_connections'] or \
+                2 ** 31
+            return redis.asyncio.RedisCluster(
+                startup_nodes=[
+                    redis.asyncio.cluster.ClusterNode(
+                        item['host'], item['port'])
+                    for item in self.nodes],
+                password=node.get('password'),
+                decode_responses=decode_responses,
+                read_from_replicas=self.read_from_replicas,
+                **options)
+        nodes = [
+            ("{}:{}".format(node['host'], node['port']),
+             self.make_node_client(node, decode_responses),
+             [self.make_node_client(dict(node, **replica), decode_responses)
+              for replica in node.get('replicas', [])])
+            for node in self.nodes
+        ]
+        if len(nodes) == 1 and not (self.read_from_replicas and nodes[0][2]):
+            return nodes[0][1]
+        return AioShardedRedis(nodes, self.read_from_replicas)
+
+    def make_node_client(self, node, decode_responses):
+        options = dict(self.options)
+        blocking = options.pop('blocking')
+        timeout = options.pop('timeout')
+        kwargs = dict(
+            host=node['host'],
+            port=node['port'],
+            password=node.get('password'),
+            decode_responses=decode_responses,
+            db=node.get('db', 0),
+            **options
         )
+        if blocking:
+            kwargs['max_connections'] = kwargs['max_connections'] or 50
+            pool = redis.asyncio.BlockingConnectionPool(
+                timeout=timeout, **kwargs)
+        else:
+            pool = redis.asyncio.ConnectionPool(**kwargs)
+        return redis.asyncio.Redis(connection_pool=pool)
 
+    def get_conn(self, decode_responses=True):
+        if (client := self.clients.get(decode_responses)) is None:
+            client = self.make_client(decode_responses)
+            self.clients[decode_responses] = client
+        return client
 
-class OriginAioRedisClient(metaclass=AioSingleton):
+    async def aclose(self):
+        """
+        断开所有连接, event loop关闭时调用
+        """
+        clients = list(self.clients.values())
+        self.clients = {}
+        for client in clients:
+            if isinstance(client, (redis.asyncio.RedisCluster,
+                                   AioShardedRedis)):
+                await client.close()
+            else:
+                await client.connection_pool.disconnect()
+
+
+class BaseAioRedisClient():
     '''
     Get aio redis pool client
     '''
 
-    async def __init__(self):
-        logger.debug("AioRedisClient Init")
-        self.redis = await aioredis.create_redis_pool(
-            'redis://:{password}@{host}:{port}/{db}'.format(
-                host=settings.REDIS_HOST,
-                port=settings.REDIS_PORT,
-                password=settings.REDIS_PASSWORD,
-                db=0
-            ))
+    decode_responses = True
 
-    def get_conn(self) -> "redis.Redis":
-        return self.redis
+    def get_conn(self) -> "redis.asyncio.Redis":
+        return AioRedisPool().get_conn(self.decode_responses)
 
     async def clear_by_pattern(self, key_pattern: str) -> bool:
         if not key_pattern.endswith('*'):
@@ -89,19 +450,65 @@ class OriginAioRedisClient(metaclass=AioSingleton):
         else:
             key = key_pattern
         client = self.get_conn()
+        if isinstance(client, redis.asyncio.RedisCluster):
+            # scan_iter遍历所有主节点
+            keys = []
+            async for _key in client.scan_iter(match=key, count=50000):
+                keys.append(_key)
+                if len(keys) >= 1000:
+                    await self._unlink(client, keys)
+                    keys = []
+            await self._unlink(client, keys)
+            return True
         cur = '0'
         while True:
             cur, data = await client.scan(cur, key, 50000)
-            if len(data) > 30:
-                for _key in data:
-                    await client.delete(_key)
-            else:
-                if data:
-                    await client.delete(*data)
+            await self._unlink(client, data)
             if int(cur) == 0:
                 break
         return True
 
+    async def clear_by_tag(self, tag: str) -> bool:
+        return await self.clear_tag_key(BaseRedisClient.tag_key(tag))
+
+    async def clear_tag_key(self, tag_key: str) -> bool:
+        client = self.get_conn()
+        tmp_key = "{}:clearing:{}".format(tag_key, uuid.uuid4().hex)
+        try:
+            await client.rename(tag_key, tmp_key)
+        except redis.ResponseError:
+            return True
+        cur = 0
+        while True:
+            cur, data = await client.zscan(tmp_key, cur, count=1000)
+            await self._unlink(client, [key for key, _ in data])
+            if int(cur) == 0:
+                break
+        await client.unlink(tmp_key)
+        return True
+
+    @staticmethod
+    async def _unlink(client, keys, batch=1000):
+        if not keys:
+            return
+        if isinstance(client, redis.asyncio.RedisCluster):
+            for start in range(0, len(keys), batch):
+                await client.unlink(*keys[start:start + batch])
+            return
+        pipe = client.pipeline(transaction=False)
+        for start in range(0, len(keys), batch):
+            pipe.unlink(*keys[start:start + batch])
+        await pipe.execute()
+
+
+class AioRedisClient(BaseAioRedisClient, metaclass=AioSingleton):
+    pass
+
+
+class OriginAioRedisClient(BaseAioRedisClient, metaclass=AioSingleton):
+
+    decode_responses = False
+
 
 class RedisExpiredHash():
     """
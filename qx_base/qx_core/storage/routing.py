@@ -0,0 +1,415 @@
+import bisect
+import asyncio
+import hashlib
+import random
+from redis.cluster import RedisCluster
+from redis.commands.core import Script, AsyncScript
+
+
+def key_hash_tag(key) -> bytes:
+    """
+    与redis cluster一致, key中包含{tag}时只用tag计算分片
+    """
+    if isinstance(key, str):
+        key = key.encode()
+    start = key.find(b'{')
+    if start > -1:
+        end = key.find(b'}', start + 1)
+        if end > start + 1:
+            return key[start + 1:end]
+    return key
+
+
+class HashRing():
+    """
+    一致性hash, 增减节点时只迁移相邻区间的key
+    """
+
+    def __init__(self, names, replicas=160):
+        self.names = names
+        self._ring = []
+        for index, name in enumerate(names):
+            for i in range(replicas):
+                self._ring.append(
+                    (self.hash("{}:{}".format(name, i).encode()), index))
+        self._ring.sort()
+        self._hashes = [val for val, _ in self._ring]
+
+    @staticmethod
+    def hash(data: bytes) -> int:
+        return int.from_bytes(hashlib.md5(data).digest()[:8], 'big')
+
+    def get_index(self, key) -> int:
+        pos = bisect.bisect(self._hashes, self.hash(key_hash_tag(key)))
+        if pos == len(self._ring):
+            pos = 0
+        return self._ring[pos][1]
+
+
+class ShardedRedis():
+    """
+    按key分片到多个redis节点, 读命令可以发送到从库
+    ---
+    nodes: [(name, primary client, [replica clients]), ...]
+
+    单key命令按第一个参数路由, mget/delete/unlink/exists按节点拆分,
+    lua脚本按第一个key路由(多个key需要使用相同的{tag}),
+    publish/pubsub使用第一个节点, scan依次遍历每个节点
+    """
+
+    READ_COMMANDS = {
+        'get', 'mget', 'exists', 'ttl', 'pttl', 'type', 'strlen',
+        'hget', 'hmget', 'hgetall', 'hexists', 'hlen', 'hkeys', 'hvals',
+        'smembers', 'sismember', 'scard',
+        'zrange', 'zrevrange', 'zrangebyscore', 'zrevrangebyscore',
+        'zscore', 'zcard', 'zcount', 'zrank', 'zrevrank',
+        'lrange', 'llen', 'lindex',
+    }
+    MULTI_KEY_COMMANDS = {'delete', 'unlink', 'exists', 'touch'}
+    ALL_NODE_COMMANDS = {'flushall', 'flushdb'}
+
+    def __init__(self, nodes, read_from_replicas=False):
+        self.nodes = nodes
+        self.read_from_replicas = read_from_replicas
+        self.ring = HashRing([name for name, _, _ in nodes])
+        self.connection_pool = nodes[0][1].connection_pool
+
+    def get_node_index(self, key) -> int:
+        if len(self.nodes) == 1:
+            return 0
+        return self.ring.get_index(key)
+
+    def get_client(self, key, read=False):
+        _, primary, replicas = self.nodes[self.get_node_index(key)]
+        if read and self.read_from_replicas and replicas:
+            return random.choice(replicas)
+        return primary
+
+    def get_node_conns(self) -> list:
+        return [primary for _, primary, _ in self.nodes]
+
+    def split_keys(self, keys) -> dict:
+        """
+        return: {node index: [(position, key), ...]}
+        """
+        data = {}
+        for position, key in enumerate(keys):
+            data.setdefault(self.get_node_index(key), []).append(
+                (position, key))
+        return data
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name in self.MULTI_KEY_COMMANDS:
+            def command(*keys):
+                return sum(
+                    getattr(self.nodes[index][1], name)(
+                        *[key for _, key in items])
+                    for index, items in self.split_keys(keys).items())
+        elif name in self.ALL_NODE_COMMANDS:
+            def command(*args, **kwargs):
+                return all([
+                    getattr(client, name)(*args, **kwargs)
+                    for client in self.get_node_conns()])
+        else:
+            read = name in self.READ_COMMANDS
+
+            def command(*args, **kwargs):
+                key = args[0] if args else kwargs['name']
+                return getattr(self.get_client(key, read), name)(
+                    *args, **kwargs)
+        return command
+
+    def mget(self, keys, *args):
+        keys = list(keys) + list(args)
+        values = [None] * len(keys)
+        for index, items in self.split_keys(keys).items():
+            _, primary, replicas = self.nodes[index]
+            client = random.choice(replicas) \
+                if self.read_from_replicas and replicas else primary
+            data = client.mget([key for _, key in items])
+            for (position, _), val in zip(items, data):
+                values[position] = val
+        return values
+
+    def get_encoder(self):
+        return self.connection_pool.get_encoder()
+
+    def register_script(self, script):
+        return Script(self, script)
+
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        client = self.get_client(keys_and_args[0]) if numkeys \
+            else self.nodes[0][1]
+        return client.evalsha(sha, numkeys, *keys_and_args)
+
+    def eval(self, script, numkeys, *keys_and_args):
+        client = self.get_client(keys_and_args[0]) if numkeys \
+            else self.nodes[0][1]
+        return client.eval(script, numkeys, *keys_and_args)
+
+    def script_load(self, script):
+        shas = [client.script_load(script)
+                for client in self.get_node_conns()]
+        return shas[0]
+
+    def publish(self, channel, message):
+        return self.nodes[0][1].publish(channel, message)
+
+    def pubsub(self, **kwargs):
+        return self.nodes[0][1].pubsub(**kwargs)
+
+    def lock(self, name, **kwargs):
+        return self.get_client(name).lock(name, **kwargs)
+
+    def split_cursor(self, cursor) -> tuple:
+        """
+        scan cursor = 节点cursor * 节点数 + 节点序号
+        return: (节点序号, 节点cursor)
+        """
+        return int(cursor) % len(self.nodes), int(cursor) // len(self.nodes)
+
+    def join_cursor(self, index, cursor) -> int:
+        """
+        节点遍历结束时从下一个节点开始, 全部结束返回0
+        """
+        if int(cursor):
+            return int(cursor) * len(self.nodes) + index
+        return index + 1 if index + 1 < len(self.nodes) else 0
+
+    def scan(self, cursor=0, match=None, count=None, _type=None, **kwargs):
+        index, cursor = self.split_cursor(cursor)
+        cursor, keys = self.nodes[index][1].scan(
+            cursor, match, count, _type, **kwargs)
+        return self.join_cursor(index, cursor), keys
+
+    def scan_iter(self, match=None, count=None, _type=None, **kwargs):
+        for client in self.get_node_conns():
+            yield from client.scan_iter(match, count, _type, **kwargs)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return ShardedPipeline(self, transaction)
+
+
+class AioShardedRedis(ShardedRedis):
+    """
+    ShardedRedis的redis.asyncio版本, 路由规则相同
+    ---
+    nodes: [(name, primary client, [replica clients]), ...]
+    """
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name in self.MULTI_KEY_COMMANDS:
+            async def command(*keys):
+                return sum(await asyncio.gather(*[
+                    getattr(self.nodes[index][1], name)(
+                        *[key for _, key in items])
+                    for index, items in self.split_keys(keys).items()]))
+        elif name in self.ALL_NODE_COMMANDS:
+            async def command(*args, **kwargs):
+                return all(await asyncio.gather(*[
+                    getattr(client, name)(*args, **kwargs)
+                    for client in self.get_node_conns()]))
+        else:
+            read = name in self.READ_COMMANDS
+
+            async def command(*args, **kwargs):
+                key = args[0] if args else kwargs['name']
+                return await getattr(self.get_client(key, read), name)(
+                    *args, **kwargs)
+        return command
+
+    async def mget(self, keys, *args):
+        keys = list(keys) + list(args)
+        values = [None] * len(keys)
+        groups = list(self.split_keys(keys).items())
+        results = await asyncio.gather(*[
+            self.get_client(items[0][1], read=True).mget(
+                [key for _, key in items])
+            for _, items in groups])
+        for (_, items), data in zip(groups, results):
+            for (position, _), val in zip(items, data):
+                values[position] = val
+        return values
+
+    def register_script(self, script):
+        return AsyncScript(self, script)
+
+    async def evalsha(self, sha, numkeys, *keys_and_args):
+        client = self.get_client(keys_and_args[0]) if numkeys \
+            else self.nodes[0][1]
+        return await client.evalsha(sha, numkeys, *keys_and_args)
+
+    async def eval(self, script, numkeys, *keys_and_args):
+        client = self.get_client(keys_and_args[0]) if numkeys \
+            else self.nodes[0][1]
+        return await client.eval(script, numkeys, *keys_and_args)
+
+    async def script_load(self, script):
+        shas = await asyncio.gather(*[
+            client.script_load(script) for client in self.get_node_conns()])
+        return shas[0]
+
+    async def publish(self, channel, message):
+        return await self.nodes[0][1].publish(channel, message)
+
+    async def scan(self, cursor=0, match=None, count=None, _type=None,
+                   **kwargs):
+        index, cursor = self.split_cursor(cursor)
+        cursor, keys = await self.nodes[index][1].scan(
+            cursor, match, count, _type, **kwargs)
+        return self.join_cursor(index, cursor), keys
+
+    async def scan_iter(self, match=None, count=None, _type=None, **kwargs):
+        for client in self.get_node_conns():
+            async for key in client.scan_iter(match, count, _type, **kwargs):
+                yield key
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return AioShardedPipeline(self, transaction)
+
+    async def close(self):
+        """
+        断开所有节点的连接
+        """
+        for _, primary, replicas in self.nodes:
+            for client in [primary] + replicas:
+                await client.connection_pool.disconnect()
+
+
+class ShardedPipeline():
+    """
+    按节点拆分为多个pipeline执行, 按命令顺序返回结果
+    transaction只在单个节点内有效
+    """
+
+    def __init__(self, router, transaction=True):
+        self.router = router
+        self.transaction = transaction
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    def __len__(self):
+        return len(self.commands)
+
+    def reset(self):
+        self.commands = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return command
+
+    def execute(self, raise_on_error=True):
+        pipes, plan = self.split_commands()
+        results = {
+            index: pipe.execute(raise_on_error=raise_on_error)
+            for index, pipe in pipes.items()
+        }
+        return self.merge_results(plan, results)
+
+    def split_commands(self) -> tuple:
+        """
+        return: ({节点序号: pipeline}, 每个命令在节点pipeline中的位置)
+        """
+        router = self.router
+        pipes = {}
+        plan = []
+
+        def add(index, name, args, kwargs):
+            if index not in pipes:
+                pipes[index] = router.nodes[index][1].pipeline(
+                    transaction=self.transaction)
+            getattr(pipes[index], name)(*args, **kwargs)
+            return index, len(pipes[index]) - 1
+
+        for name, args, kwargs in self.commands:
+            if name == 'mget':
+                keys = list(args[0]) + list(args[1:]) \
+                    if not isinstance(args[0], (str, bytes)) else list(args)
+                parts = [
+                    (add(index, name, ([key for _, key in items],), {}),
+                     [position for position, _ in items])
+                    for index, items in router.split_keys(keys).items()]
+                plan.append(('mget', len(keys), parts))
+            elif name in router.MULTI_KEY_COMMANDS:
+                parts = [
+                    add(index, name, [key for _, key in items], {})
+                    for index, items in router.split_keys(args).items()]
+                plan.append(('sum', None, parts))
+            else:
+                key = args[0] if args else kwargs['name']
+                parts = [add(router.get_node_index(key), name, args, kwargs)]
+                plan.append(('one', None, parts))
+        self.reset()
+        return pipes, plan
+
+    @staticmethod
+    def merge_results(plan, results) -> list:
+        """
+        按命令顺序合并各节点的结果
+        """
+        data = []
+        for kind, size, parts in plan:
+            if kind == 'mget':
+                values = [None] * size
+                for (index, pos), positions in parts:
+                    for position, val in zip(positions, results[index][pos]):
+                        values[position] = val
+                data.append(values)
+            elif kind == 'sum':
+                data.append(sum(results[index][pos] for index, pos in parts))
+            else:
+                index, pos = parts[0]
+                data.append(results[index][pos])
+        return data
+
+
+class AioShardedPipeline(ShardedPipeline):
+    """
+    ShardedPipeline的redis.asyncio版本, 各节点pipeline并发执行
+    """
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    async def execute(self, raise_on_error=True):
+        pipes, plan = self.split_commands()
+        indexes = list(pipes)
+        data = await asyncio.gather(*[
+            pipes[index].execute(raise_on_error=raise_on_error)
+            for index in indexes])
+        return self.merge_results(plan, dict(zip(indexes, data)))
+
+
+class QxRedisCluster(RedisCluster):
+    """
+    redis cluster, 多key命令使用非原子的拆分方式
+    """
+
+    def mget(self, keys, *args):
+        return self.mget_nonatomic(keys, *args)
+
+    def pipeline(self, transaction=None, shard_hint=None):
+        return super().pipeline()
+
+    def get_node_conns(self) -> list:
+        return [
+            self.get_redis_connection(node)
+            for node in self.get_primaries()
+        ]
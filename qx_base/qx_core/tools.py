@@ -1,4 +1,7 @@
 import json
+import asyncio
+import logging
+import weakref
 import hashlib
 import urllib
 from collections import OrderedDict
@@ -7,6 +10,8 @@ from django.utils import timezone
 
 tz = timezone.get_default_timezone()
 
+logger = logging.getLogger(__name__)
+
 
 class Singleton(type):
     _instances = {}
@@ -19,13 +24,54 @@ class Singleton(type):
 
 
 class AioSingleton(type):
-    _instances = {}
+    """
+    每个event loop一个实例, asyncio对象不能跨loop使用
+    实例引用了loop(连接池等), loop关闭时调用实例的aclose()并删除,
+    否则loop和连接不会被回收
+    """
+    _instances = weakref.WeakKeyDictionary()
 
-    async def __call__(cls, *args, **kwargs):
-        if cls not in cls._instances:
-            cls._instances[cls] = await super(
-                Singleton, cls).__call__(*args, **kwargs)
-        return cls._instances[cls]
+    def __call__(cls, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        if (instances := AioSingleton._instances.get(loop)) is None:
+            instances = AioSingleton._instances[loop] = {}
+            AioSingleton.hook_close(loop)
+        if cls not in instances:
+            instances[cls] = super(
+                AioSingleton, cls).__call__(*args, **kwargs)
+        return instances[cls]
+
+    @staticmethod
+    def hook_close(loop):
+        """
+        loop.close()前在该loop中关闭实例(asyncio.run, async_to_sync等)
+        """
+        close = loop.close
+
+        def _close():
+            loop.__dict__.pop('close', None)
+            if not loop.is_closed() and not loop.is_running():
+                loop.run_until_complete(AioSingleton.aclose_loop(loop))
+            close()
+        try:
+            loop.close = _close
+        except AttributeError:  # pragma: no cover
+            # 不支持设置属性的loop(uvloop), 需要调用aclose_loop
+            logger.warning("event loop close hook not supported")
+
+    @staticmethod
+    async def aclose_loop(loop=None):
+        """
+        关闭并删除loop的所有实例
+        """
+        loop = loop or asyncio.get_running_loop()
+        instances = AioSingleton._instances.pop(loop, {})
+        for ins in instances.values():
+            if hasattr(ins, 'aclose'):
+                try:
+                    await ins.aclose()
+                except Exception:
+                    logger.exception('aclose error')
 
 
 def param_sort(params: dict, pop_keys=[], _json=False) -> str:
@@ -57,6 +103,25 @@ def param_sort(params: dict, pop_keys=[], _json=False) -> str:
     return urllib.parse.urlencode(ordered_query_dict)
 
 
+def iter_param_sort(params: dict, pop_keys=[]):
+    """
+    与param_sort(dict)结果相同, 按参数逐个生成bytes, 用于增量计算hash
+    """
+    quote_plus = urllib.parse.quote_plus
+    items = sorted(
+        (key, val) for key, val in params.items()
+        if key not in pop_keys and not isinstance(val, (dict, list)))
+    sep = ''
+    for key, val in items:
+        if not isinstance(key, bytes):
+            key = str(key)
+        if not isinstance(val, bytes):
+            val = str(val)
+        yield '{}{}={}'.format(
+            sep, quote_plus(key), quote_plus(val)).encode()
+        sep = '&'
+
+
 def encode_md5(data_str: str) -> str:
     return hashlib.md5(data_str).hexdigest()
 
@@ -1,11 +1,28 @@
+import time
 import urllib
 import hashlib
+import functools
+import weakref
+import threading
+from contextlib import contextmanager
 from collections import OrderedDict
-from ..qx_core.storage import ProxyCache, RedisClient
+from django.conf import settings
+from django.db import transaction
+from ..qx_core.storage import ProxyCache, RedisClient, LocalCache
+from ..qx_core.storage.local import LOCAL_CACHE_CHANNEL
+from ..qx_core.storage.codecs import RawJSON
 
 
 VIEWSET_CACHE_CONFIG = {}
 
+# 接口一级缓存(进程内), 通过cache_config的local_timeout开启
+REST_LOCAL_CACHE = LocalCache(
+    maxsize=getattr(settings, 'REST_CACHE_LOCAL_SIZE', 1000))
+# 缓存版本号(进程内), 通过redis广播失效
+REST_VERSION_CACHE = LocalCache(
+    maxsize=getattr(settings, 'REST_CACHE_VERSION_SIZE', 10000),
+    timeout=getattr(settings, 'REST_CACHE_VERSION_TIMEOUT', 10))
+
 
 class RestCacheKey():
 
@@ -19,29 +36,73 @@ class RestCacheKey():
     def clear_cache_keys(cls, action: str) -> bool:
         key = "viewset:{}:{}*".format(
             RestCacheKey._get_cls_name(cls), action)
-        RedisClient().clear_by_pattern(key)
-        return True
+        return RestCacheKey.clear_cache(key, is_pattern=True)
 
     @staticmethod
     def clear_cache_key(cls, action: str, obj_id: str) -> bool:
         key = "viewset:{}:{}:{}".format(
             RestCacheKey._get_cls_name(cls), action, obj_id)
-        client = RedisClient().get_conn()
-        client.delete(key)
-        return True
+        return RestCacheKey.clear_cache(key)
 
     @staticmethod
     def clear_cache(key, is_pattern=False) -> bool:
-        if is_pattern:
-            RedisClient().clear_by_pattern(key)
-        else:
-            RedisClient().get_conn().delete(key)
+        CacheInvalidation([(key, is_pattern)]).execute()
+        return True
+
+    @staticmethod
+    def get_key_config(key: str) -> tuple:
+        """
+        接口缓存key前缀对应的tag和action配置, 非接口缓存返回None
+        """
+        tag = key.rstrip('*')
+        if '*' in tag:
+            return None, None
+        names = tag.split(':')
+        if len(names) < 3 or names[0] != 'viewset':
+            return None, None
+        cfg = VIEWSET_CACHE_CONFIG.get(names[1], {}).get(names[2])
+        if not cfg:
+            return None, None
+        return tag, cfg
+
+    @staticmethod
+    def get_cache_tag(key: str) -> str:
+        return RestCacheKey.get_key_config(key)[0]
+
+    @staticmethod
+    def version_key(namespace: str) -> str:
+        return "qx_base:version:{}".format(namespace)
+
+    @staticmethod
+    def incr_cache_version(namespace: str, timeout: int) -> bool:
+        """
+        增加缓存版本号, 旧版本缓存等待超时
+        """
+        plan = CacheInvalidation()
+        plan.versions[RestCacheKey.version_key(namespace)] = timeout
+        plan.execute()
         return True
 
+    @staticmethod
+    def get_cache_version(namespaces: list) -> str:
+        """
+        批量获取版本号, 优先读取进程内缓存
+        """
+        keys = [RestCacheKey.version_key(name) for name in namespaces]
+        versions = [REST_VERSION_CACHE.get(key) for key in keys]
+        miss = [key for key, val in zip(keys, versions) if val is None]
+        if miss:
+            data = dict(zip(miss, RedisClient().get_conn().mget(miss)))
+            for index, key in enumerate(keys):
+                if versions[index] is None:
+                    versions[index] = data[key] or '0'
+                    REST_VERSION_CACHE.set(key, versions[index])
+        return '.'.join(versions)
+
     @staticmethod
     def clear_action_cache(keys) -> bool:
-        for key, is_pattern in keys:
-            RestCacheKey.clear_cache(key, is_pattern)
+        CacheInvalidation(keys).execute()
+        return True
 
     @staticmethod
     def get_chache_key(cls, action: str) -> str:
@@ -72,10 +133,282 @@ class RestCacheKey():
                 key = "{}".format(
                     RestCacheKey._cache_keys(cls, action))
         if code:
+            if cfg.get('versioned'):
+                namespaces = [RestCacheKey._cache_keys(cls, action)]
+                if key != namespaces[0]:
+                    namespaces.append(key)
+                key = "{}:v{}".format(
+                    key, RestCacheKey.get_cache_version(namespaces))
             key = "{}:{}".format(key, code)
         return key
 
 
+class CacheInvalidation():
+    """
+    缓存清理计划, 合并去重后一次请求redis执行
+    ---
+        plan = CacheInvalidation()
+        plan.add([(key1, False), (key2, True)])
+        plan.add(...)
+        plan.execute()
+
+    普通key、tag集合和版本号通过一个lua脚本执行(多节点时按节点拆分),
+    非接口缓存的通配key仍通过scan删除
+
+    事务提交后执行, 并合并同一事务或batch内的清理:
+
+        CacheInvalidation.defer(keys, keys_async)
+        # 其他缓存维护(如query id列表), 按加入顺序在清理后执行
+        CacheInvalidation.defer([], callbacks=[func])
+
+        with CacheInvalidation.batch():
+            for ins in queryset:
+                ins.save()
+    """
+
+    _pending = threading.local()
+    # 已清理过旧缓存的action: {viewset:cls:action: 到期时间}(进程内)
+    _legacy_cleared = {}
+    # 只有接口缓存和版本号使用进程内缓存, 需要广播
+    local_prefixes = ('viewset:', 'qx_base:version:')
+
+    script = """
+    local n_del = tonumber(ARGV[1])
+    local n_tag = tonumber(ARGV[2])
+    local n_ver = tonumber(ARGV[3])
+    local function unlink(keys)
+        for i = 1, #keys, 1000 do
+            redis.call('UNLINK', unpack(keys, i, math.min(i + 999, #keys)))
+        end
+    end
+    local keys = {}
+    for i = 1, n_del do
+        keys[#keys + 1] = KEYS[i]
+    end
+    for i = n_del + 1, n_del + n_tag do
+        unlink(redis.call('ZRANGE', KEYS[i], 0, -1))
+        keys[#keys + 1] = KEYS[i]
+    end
+    unlink(keys)
+    for i = 1, n_ver do
+        local key = KEYS[n_del + n_tag + i]
+        redis.call('SET', key, ARGV[4], 'NX')
+        redis.call('INCR', key)
+        redis.call('EXPIRE', key, ARGV[5 + i])
+    end
+    for i = 6 + n_ver, #ARGV do
+        redis.call('PUBLISH', ARGV[5], ARGV[i])
+    end
+    return 1
+    """
+
+    def __init__(self, keys=[]):
+        self.clear()
+        self.add(keys)
+
+    def clear(self):
+        self.keys = {}
+        self.tags = {}
+        self.versions = {}
+        self.patterns = {}
+        self.messages = {}
+        self.callbacks = []
+
+    def add(self, keys):
+        """
+        keys: [(key, is_pattern), ...]
+        """
+        for key, is_pattern in keys:
+            if is_pattern:
+                tag, cfg = RestCacheKey.get_key_config(key)
+                if cfg and cfg.get('versioned'):
+                    version_key = RestCacheKey.version_key(tag)
+                    self.versions[version_key] = cfg['timeout']
+                    self.messages[(version_key, False)] = None
+                elif cfg:
+                    self.tags[RedisClient.tag_key(tag)] = tag
+                else:
+                    self.patterns[key] = None
+            else:
+                self.keys[key] = None
+            if key.startswith(self.local_prefixes):
+                self.messages[(key, bool(is_pattern))] = None
+        return self
+
+    def __bool__(self):
+        return bool(self.keys or self.tags or self.versions or
+                    self.patterns or self.messages or self.callbacks)
+
+    def execute(self) -> bool:
+        if not self:
+            return True
+        for key, is_pattern in self.messages:
+            LocalCache.evict(key, is_pattern)
+        # 以毫秒时间初始化版本号, 版本号过期后重建不会与旧版本重复
+        seed = int(time.time() * 1000)
+        if RedisClient().multi_node:
+            self.execute_multi_node(seed)
+        else:
+            keys = list(self.keys) + list(self.tags) + list(self.versions)
+            args = [
+                len(self.keys), len(self.tags), len(self.versions),
+                seed, LOCAL_CACHE_CHANNEL,
+            ]
+            args.extend(self.versions.values())
+            args.extend(LocalCache.message(key, is_pattern)
+                        for key, is_pattern in self.messages)
+            RedisClient().get_conn().register_script(self.script)(
+                keys=keys, args=args)
+        for key in list(self.patterns) + self.legacy_patterns():
+            RedisClient().clear_by_pattern(key)
+        callbacks = self.callbacks
+        self.clear()
+        for func in callbacks:
+            func()
+        return True
+
+    def legacy_patterns(self) -> list:
+        """
+        使用tag集合之前写入的接口缓存不在tag中,
+        settings.REST_CACHE_LEGACY_CLEAR开启时(默认), 每个viewset:cls:action
+        在缓存时间内第一次清理时通过scan删除一次, redis中记录已清理(同样过期).
+        旧缓存全部过期后(部署后超过缓存时间)关闭
+        """
+        if not getattr(settings, 'REST_CACHE_LEGACY_CLEAR', True):
+            return []
+        patterns = []
+        now = time.monotonic()
+        for tag in self.tags.values():
+            _, cfg = RestCacheKey.get_key_config(tag or '')
+            if not cfg:
+                continue
+            action = ':'.join(tag.split(':')[:3])
+            if self._legacy_cleared.get(action, 0) > now:
+                continue
+            marker = "qx_base:legacy_cleared:{}".format(action)
+            if RedisClient().get_conn().set(
+                    marker, 1, nx=True, ex=cfg['timeout']):
+                patterns.append("{}*".format(action))
+            self._legacy_cleared[action] = now + cfg['timeout']
+        return patterns
+
+    def execute_multi_node(self, seed):
+        """
+        key分布在多个节点时不能使用一个lua脚本, 按节点拆分的pipeline执行
+        """
+        client = RedisClient().get_conn()
+        RedisClient._unlink(client, list(self.keys))
+        for tag_key in self.tags:
+            RedisClient().clear_tag_key(tag_key)
+        pipe = client.pipeline(transaction=False)
+        for key, timeout in self.versions.items():
+            pipe.set(key, seed, nx=True)
+            pipe.incr(key)
+            pipe.expire(key, timeout)
+        pipe.execute()
+        for key, is_pattern in self.messages:
+            client.publish(
+                LOCAL_CACHE_CHANNEL, LocalCache.message(key, is_pattern))
+
+    @classmethod
+    def get_pending(cls):
+        """
+        当前线程待执行的清理
+            plan: 已提交, batch结束后执行
+            transactions: {(db alias, savepoint ids): 事务中的清理},
+                          提交后加入plan
+        """
+        pending = cls._pending
+        if not hasattr(pending, 'plan'):
+            pending.plan = cls()
+            pending.keys_async = {}
+            pending.depth = 0
+            pending.transactions = {}
+        return pending
+
+    @classmethod
+    def defer(cls, keys, keys_async=[], using=None, callbacks=[]):
+        """
+        事务提交后清理, 在batch中时batch结束后清理
+            keys_async: 通过celery异步清理的key
+            using: 数据库, 每个数据库和savepoint分别记录, 回滚时丢弃
+            callbacks: 清理后执行的函数
+        """
+        connection = transaction.get_connection(using)
+        if not connection.in_atomic_block:
+            cls.stage(keys, keys_async, callbacks)
+            return
+        pending = cls.get_pending()
+        key = (connection.alias, tuple(connection.savepoint_ids))
+        txn = pending.transactions.get(key)
+        # 只有django持有on_commit回调, 回滚丢弃回调后弱引用失效, 重新登记
+        if txn is None or txn['callback']() is None:
+            cls.discard_rollback(pending)
+            txn = {'keys': {}, 'keys_async': {}, 'callbacks': []}
+            callback = functools.partial(cls.commit, key, txn)
+            txn['callback'] = weakref.ref(callback)
+            pending.transactions[key] = txn
+            transaction.on_commit(callback, using)
+        txn['keys'].update(dict.fromkeys(map(tuple, keys)))
+        txn['keys_async'].update(dict.fromkeys(map(tuple, keys_async)))
+        txn['callbacks'].extend(callbacks)
+
+    @staticmethod
+    def discard_rollback(pending):
+        """
+        删除已回滚(回调已丢弃)的事务记录
+        """
+        for key, txn in list(pending.transactions.items()):
+            if txn['callback']() is None:
+                del pending.transactions[key]
+
+    @classmethod
+    def commit(cls, key, txn):
+        pending = cls.get_pending()
+        if pending.transactions.get(key) is txn:
+            del pending.transactions[key]
+        cls.discard_rollback(pending)
+        cls.stage(txn['keys'], txn['keys_async'], txn['callbacks'])
+
+    @classmethod
+    def stage(cls, keys, keys_async=[], callbacks=[]):
+        """
+        加入清理计划, 不在batch中时立即执行
+        """
+        pending = cls.get_pending()
+        pending.plan.add(keys)
+        pending.plan.callbacks.extend(callbacks)
+        pending.keys_async.update(dict.fromkeys(map(tuple, keys_async)))
+        if not pending.depth:
+            cls.flush()
+
+    @classmethod
+    def flush(cls):
+        pending = cls.get_pending()
+        keys_async = list(pending.keys_async)
+        pending.keys_async = {}
+        pending.plan.execute()
+        if keys_async:
+            from .tasks import async_clear_cache_task
+            async_clear_cache_task.apply_async(args=[keys_async])
+
+    @classmethod
+    @contextmanager
+    def batch(cls):
+        """
+        合并batch内已提交的清理, 结束时执行一次;
+        batch结束时仍未提交的事务, 提交后再执行
+        """
+        pending = cls.get_pending()
+        pending.depth += 1
+        try:
+            yield pending
+        finally:
+            pending.depth -= 1
+            if not pending.depth:
+                cls.flush()
+
+
 class RestCacheMeta(type):
     """
     api缓存
@@ -88,6 +421,11 @@ class RestCacheMeta(type):
             'timeout': 24 * 60, # 缓存时间
             'by_user': bool, # 通过登录用户缓存
             'is_paginate': bool, # 是否分页
+            'local_timeout': 0, # 进程内一级缓存时间(秒), 0不开启
+            'encoded': bool, # 缓存编码后的json, 命中时不再序列化
+            'single_flight': bool, # 缓存失效时只有一个请求回源
+            'soft_timeout': 0, # 软过期时间(秒), 过期后刷新, 期间返回旧数据
+            'versioned': bool, # 查询参数缓存key带版本号, 清理时只增加版本号
         },
     }
     """
@@ -101,6 +439,8 @@ class RestCacheMeta(type):
             cls.get_cache_key = RestCacheMeta.get_cache_key
             cls.get_data_by_redis = RestCacheMeta.get_data_by_redis
             cls.set_data_to_redis = RestCacheMeta.set_data_to_redis
+            cls.get_or_set_data = RestCacheMeta.get_or_set_data
+            cls.get_cache_tags = RestCacheMeta.get_cache_tags
             cls.get_query_params_encode = RestCacheMeta.get_query_params_encode
             """
             Config rest retrieve mixin cache
@@ -154,6 +494,11 @@ class RestCacheMeta(type):
                 'by_user': False,
                 'is_paginate': None,
                 'detail_field': None,
+                'local_timeout': 0,
+                'encoded': False,
+                'single_flight': False,
+                'soft_timeout': 0,
+                'versioned': False,
             }
         else:
             return {
@@ -164,6 +509,11 @@ class RestCacheMeta(type):
                 'by_user': False,
                 'is_paginate': True,
                 'detail_field': None,
+                'local_timeout': 0,
+                'encoded': False,
+                'single_flight': False,
+                'soft_timeout': 0,
+                'versioned': False,
             }
 
     @staticmethod
@@ -202,11 +552,8 @@ class RestCacheMeta(type):
             return self._default_list(request, *args, **kwargs)
         else:
             key, ts = self.get_cache_key(request)
-            data = self.get_data_by_redis(key, ts)
-            if not data:
-                data = self._default_list(request, *args, **kwargs)
-                self.set_data_to_redis(key, ts, data)
-            return data
+            return self.get_or_set_data(
+                key, ts, self._default_list, request, *args, **kwargs)
 
     def _cache_retrieve(self, request, *args, **kwargs):
         is_cache = self.action in list(self.cache_config.keys())
@@ -214,20 +561,80 @@ class RestCacheMeta(type):
             return self._default_retrieve(request, *args, **kwargs)
         else:
             key, ts = self.get_cache_key(request)
+            return self.get_or_set_data(
+                key, ts, self._default_retrieve, request, *args, **kwargs)
+
+    def get_or_set_data(self, key, ts, callback, *args, **kwargs):
+        cfg = self.cache_config.get(self.action, {})
+        if key is None or not (
+                cfg.get('single_flight') or cfg.get('soft_timeout')):
             data = self.get_data_by_redis(key, ts)
             if not data:
-                data = self._default_retrieve(request, *args, **kwargs)
-                self.set_data_to_redis(key, ts, data)
+                data = callback(*args, **kwargs)
+                data = self.set_data_to_redis(key, ts, data)
+            return data
+
+        local_ts = cfg.get('local_timeout')
+        if local_ts and (data := REST_LOCAL_CACHE.get(key)) is not None:
+            return data
+        convert = 'raw' if cfg.get('encoded') else 'json'
+
+        def _callback():
+            data = callback(*args, **kwargs)
+            if convert == 'raw' and data is not None:
+                data = RawJSON.dumps(data)
             return data
 
+        data = ProxyCache(
+            key, ts, convert=convert, tags=self.get_cache_tags(key)
+        ).get_or_lock(_callback, soft_ts=cfg.get('soft_timeout'))
+        if local_ts and data:
+            REST_LOCAL_CACHE.set(key, data, local_ts)
+        return data
+
     def get_data_by_redis(self, key, ts):
         if key is not None:
-            return ProxyCache(key, ts).get()
+            cfg = self.cache_config.get(self.action, {})
+            local_ts = cfg.get('local_timeout')
+            if local_ts and (data := REST_LOCAL_CACHE.get(key)) is not None:
+                return data
+            convert = 'raw' if cfg.get('encoded') else 'json'
+            data = ProxyCache(key, ts, convert=convert).get()
+            if local_ts and data:
+                REST_LOCAL_CACHE.set(key, data, local_ts)
+            return data
         return None
 
     def set_data_to_redis(self, key, ts, data):
+        """
+        return: 缓存的数据, encoded时为RawJSON
+        """
         if key is not None:
-            ProxyCache(key, ts).set(data)
+            cfg = self.cache_config.get(self.action, {})
+            convert = 'raw' if cfg.get('encoded') else 'json'
+            if convert == 'raw' and data is not None:
+                data = RawJSON.dumps(data)
+            ProxyCache(
+                key, ts, convert=convert, tags=self.get_cache_tags(key)
+            ).set(data)
+            local_ts = cfg.get('local_timeout')
+            if local_ts and data:
+                REST_LOCAL_CACHE.set(key, data, local_ts)
+        return data
+
+    def get_cache_tags(self, key) -> list:
+        """
+        缓存key所属tag: viewset:cls:action 和 查询参数前缀
+        """
+        cfg = self.cache_config.get(self.action, {})
+        if cfg.get('versioned'):
+            return []
+        tags = [RestCacheKey._cache_keys(self, self.action)]
+        if cfg.get('cache_fields'):
+            prefix = key.rsplit(':', 1)[0]
+            if prefix != tags[0]:
+                tags.append(prefix)
+        return tags
 
     def get_cache_key(self, request) -> str:
         cfg = self.cache_config.get(self.action)
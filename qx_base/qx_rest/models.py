@@ -1,20 +1,161 @@
 import logging
+import decimal
+import functools
 from django.db import models
+from django.core import checks
+from django.core.exceptions import FieldDoesNotExist
 from ..qx_core.models import AbstractBaseModel
-from .caches import RestCacheKey, VIEWSET_CACHE_CONFIG, ProxyCache
-from .tasks import async_clear_cache_task
+from ..qx_core.storage import RedisClient
+from .caches import (
+    RestCacheKey, VIEWSET_CACHE_CONFIG, ProxyCache, CacheInvalidation,
+)
 
 
 logger = logging.getLogger(__name__)
 
 
-def _empty_func():
-    pass
+class RestQuerySet(models.QuerySet):
+    """
+    批量操作同步清理RestModelMixin和CacheModelMixin缓存:
+        update, delete, bulk_create, bulk_update
+    按行汇总缓存key, 去重后事务提交时一次清理
+    """
+
+    def _has_cache(self) -> bool:
+        """
+        model没有需要清理的缓存时, 批量操作不查询数据
+        """
+        model = self.model
+        return (issubclass(model, RestModelMixin) and
+                bool(model.cache_config)) or \
+            issubclass(model, CacheModelMixin)
+
+    def _get_cache_objs(self, queryset):
+        fields = self._get_cache_fields()
+        if fields is not None:
+            queryset = queryset.only(*fields)
+        return self._load_relate_values(list(queryset))
+
+    def _load_relate_values(self, objs):
+        """
+        关联字段(a__b)每个字段一次values_list查询, 不逐行载入关联对象
+        """
+        model = self.model
+        if not objs or not issubclass(model, RestModelMixin):
+            return objs
+        lookups = [
+            lookup for lookup in model._get_cache_lookups() or []
+            if '__' in lookup]
+        pks = [ins.pk for ins in objs if ins.pk is not None]
+        if not lookups or not pks:
+            return objs
+        values = {ins.pk: {} for ins in objs}
+        queryset = model._base_manager.using(self.db).filter(pk__in=pks)
+        for lookup in lookups:
+            for pk, val in queryset.values_list('pk', lookup):
+                values[pk][lookup] = val
+        for ins in objs:
+            if ins.pk is not None:
+                ins._cache_relate_values = values[ins.pk]
+        return objs
+
+    def _get_cache_fields(self):
+        """
+        缓存key需要的字段, None时载入全部字段
+        """
+        model = self.model
+        fields = {'pk'}
+        if issubclass(model, RestModelMixin):
+            _fields = model._get_cache_fields()
+            if _fields is None:
+                return None
+            fields |= _fields
+        if issubclass(model, CacheModelMixin):
+            fields |= set(model.objects_cache_fields.get('object', []))
+            fields |= set(model.objects_cache_fields.get('query', []))
+        return fields
+
+    def _get_clear_cache_keys(self, objs, method):
+        keys = []
+        keys_async = []
+        if not objs:
+            return keys, keys_async
+        ins = objs[0]
+        if isinstance(ins, RestModelMixin) and ins.cache_config:
+            keys, keys_async = ins._get_clear_cache_keys(objs, method)
+        if isinstance(ins, CacheModelMixin):
+            keys.extend(ins._get_model_cache_keys(objs))
+        return keys, keys_async
+
+    def _clear_cache(self, keys, keys_async):
+        if keys or keys_async:
+            CacheInvalidation.defer(keys, keys_async, self.db)
+
+    def _reload_cache_objs(self, objs):
+        return self._get_cache_objs(
+            self.model._base_manager.using(self.db).filter(
+                pk__in=[ins.pk for ins in objs]))
+
+    def update(self, **kwargs):
+        if not self._has_cache():
+            return super().update(**kwargs)
+        objs = self._get_cache_objs(self)
+        keys, keys_async = self._get_clear_cache_keys(objs, 'update')
+        ret = super().update(**kwargs)
+        if objs:
+            _keys, _keys_async = self._get_clear_cache_keys(
+                self._reload_cache_objs(objs), 'update')
+            self._clear_cache(keys + _keys, keys_async + _keys_async)
+        return ret
+
+    update.alters_data = True
+
+    def delete(self):
+        if not self._has_cache():
+            return super().delete()
+        objs = self._get_cache_objs(self)
+        keys, keys_async = self._get_clear_cache_keys(objs, 'delete')
+        ret = super().delete()
+        self._clear_cache(keys, keys_async)
+        return ret
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super().bulk_create(objs, *args, **kwargs)
+        if self._has_cache():
+            self._load_relate_values(objs)
+            self._clear_cache(*self._get_clear_cache_keys(objs, 'create'))
+        return objs
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        if not self._has_cache():
+            return super().bulk_update(objs, fields, *args, **kwargs)
+        objs = list(objs)
+        origins = []
+        model = self.model
+        if (issubclass(model, RestModelMixin) and model.cache_config and
+                model.cache_config.get('reload_data', False)) or \
+                (issubclass(model, CacheModelMixin) and
+                 model.objects_cache_fields.get('query')):
+            origins = self._reload_cache_objs(objs)
+        ret = super().bulk_update(objs, fields, *args, **kwargs)
+        self._load_relate_values(objs)
+        self._clear_cache(
+            *self._get_clear_cache_keys(objs + origins, 'update'))
+        return ret
+
+    bulk_update.alters_data = True
+
+
+RestManager = models.Manager.from_queryset(RestQuerySet)
 
 
 class RestModelMixin(models.Model):
     '''
     重置model的save和delete方法, 可以同步model的rest接口对应缓存
+    缓存在事务提交后清理, 同一事务或CacheInvalidation.batch内合并执行
     !async_actions,async需要celery支持
 
     cache_config = {
@@ -64,12 +205,47 @@ class RestModelMixin(models.Model):
                 ],
             }
         },
-        "reload_data": bool, # 是否载入原数据
+        "reload_data": bool, # 是否载入原数据, 优先使用载入时记录的字段值
     }
     '''
 
     cache_config = None
 
+    objects = RestManager()
+
+    @classmethod
+    def _get_cache_lookups(cls):
+        """
+        清理缓存需要的字段(可以是a__b), 有函数参数时返回None
+        """
+        lookups = set()
+        if not cls.cache_config:
+            return lookups
+        for name, val in cls.cache_config.get('default', {}).items():
+            if val.get('by_user_field'):
+                lookups.add(val['by_user_field'])
+            for action in val['actions']:
+                cfg = VIEWSET_CACHE_CONFIG.get(name.lower(), {}).get(action)
+                if cfg and cfg['detail']:
+                    lookups.add(cfg['detail_field'])
+        for val in cls.cache_config.get('custom', {}).values():
+            for arg in val.get('args', []):
+                if callable(arg):
+                    return None
+                if arg != '*':
+                    lookups.add(arg)
+        return lookups
+
+    @classmethod
+    def _get_cache_fields(cls):
+        """
+        清理缓存需要的本model字段, 有函数参数时返回None
+        """
+        lookups = cls._get_cache_lookups()
+        if lookups is None:
+            return None
+        return {lookup.split('__')[0] for lookup in lookups}
+
     def _get_skip_status(self, val, method):
         skip = False
         if method == 'create':
@@ -86,7 +262,13 @@ class RestModelMixin(models.Model):
     def _get_relate_field(self, ins, only_field_lst: list, index=0):
         """
         get relate field, example: foreign_key1__foreign_key2__user_id
+        批量操作时优先使用RestQuerySet预先查询的值
         """
+        if index == 0 and len(only_field_lst) > 1:
+            values = getattr(ins, '_cache_relate_values', None)
+            lookup = '__'.join(only_field_lst)
+            if values and lookup in values:
+                return values[lookup]
         if index < len(only_field_lst) - 1:
             n_ins = getattr(ins, only_field_lst[index])
             index += 1
@@ -99,23 +281,33 @@ class RestModelMixin(models.Model):
         一对多缓存删除
         """
         if self._get_skip_status(val, method):
-            return _empty_func
+            return [], []
         keys = []
         keys_async = []
+        cfgs = {
+            action: VIEWSET_CACHE_CONFIG.get(cls.lower(), {}).get(action)
+            for action in val['actions']
+        }
+        # 一次查询关联字段, 不载入关联对象
+        fields = []
+        for cfg in cfgs.values():
+            if cfg['detail'] and cfg['detail_field'] not in fields:
+                fields.append(cfg['detail_field'])
+            if cfg['by_user'] and val['by_user_field'] not in fields:
+                fields.append(val['by_user_field'])
         objs = getattr(ins, val['foreign_set']).all()
-        for action in val['actions']:
-            cfg = VIEWSET_CACHE_CONFIG.get(cls.lower(), {}).get(action)
-            for obj in objs:
+        if fields:
+            rows = set(objs.values_list(*fields))
+        else:
+            rows = {()} if objs.exists() else set()
+        for action, cfg in cfgs.items():
+            for row in rows:
                 detail_id = None
                 user_id = None
                 if cfg['detail']:
-                    only_field_lst = cfg['detail_field'].split("__")
-                    detail_id = str(
-                        self._get_relate_field(obj, only_field_lst))
+                    detail_id = str(row[fields.index(cfg['detail_field'])])
                 if cfg['by_user']:
-                    only_field_lst = val['by_user_field'].split("__")
-                    user_id = str(
-                        self._get_relate_field(obj, only_field_lst))
+                    user_id = str(row[fields.index(val['by_user_field'])])
 
                 key = RestCacheKey.get_rest_cache_key(
                     cls, action,
@@ -127,14 +319,14 @@ class RestModelMixin(models.Model):
                 else:
                     keys.append((key, is_pattern))
 
-        return keys, keys_async
+        return list(dict.fromkeys(keys)), list(dict.fromkeys(keys_async))
 
     def _custom_clear_cache(self, ins, key, val: dict, method='create'):
         """
         定制缓存删除
         """
         if self._get_skip_status(val, method):
-            return _empty_func
+            return [], []
         _args = []
         keys = []
         keys_async = []
@@ -163,7 +355,7 @@ class RestModelMixin(models.Model):
         默认缓存删除
         """
         if self._get_skip_status(val, method):
-            return _empty_func
+            return [], []
         keys = []
         keys_async = []
         for action in val['actions']:
@@ -193,69 +385,119 @@ class RestModelMixin(models.Model):
              update_fields=None):
         method = 'create' if self.pk is None else 'update'
         objs = [self]
+        reload_data = self.cache_config and \
+            self.cache_config.get('reload_data', False)
+        if reload_data and self.pk is not None:
+            origin = self._get_cache_origin()
+            if origin is None:
+                origin = self.__class__.objects.get(pk=self.pk)
+            objs.append(origin)
+
+        if reload_data:
+            # 先更新记录的字段值, 保存时写入缓存的对象与数据库一致
+            snapshot = getattr(self, '_cache_origin', None)
+            self._cache_origin = self._get_cache_snapshot()
+            try:
+                super().save(force_insert, force_update, using,
+                             update_fields)
+            except Exception:
+                self._cache_origin = snapshot
+                raise
+        else:
+            super().save(force_insert, force_update, using,
+                         update_fields)
+
         if self.cache_config:
-            if self.cache_config.get('reload_data', False) and self.id:
-                origin = self.__class__.objects.get(id=self.id)
-                objs.append(origin)
+            keys, keys_async = self._get_clear_cache_keys(objs, method)
+            CacheInvalidation.defer(keys, keys_async, self._state.db)
 
-        super().save(force_insert, force_update, using,
-                     update_fields)
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        ins = super().from_db(db, field_names, values)
+        if cls.cache_config and cls.cache_config.get('reload_data', False):
+            ins._cache_origin = ins._get_cache_snapshot()
+        return ins
 
-        if self.cache_config:
-            keys_async = []
-            for ins in objs:
-                for cls, val in self.cache_config.get(
-                        'default', {}).items():
-                    _keys, _keys_async = self._default_clear_cache(
-                        ins, cls, val, method)
-                    RestCacheKey.clear_action_cache(_keys)
-                    keys_async.extend(_keys_async)
-                for cls, val in self.cache_config.get(
-                        'foreign', {}).items():
-                    _keys, _keys_async = self._foreign_clear_cache(
-                        ins, cls, val, method)
-                    RestCacheKey.clear_action_cache(_keys)
-                    keys_async.extend(_keys_async)
-                for cls, val in self.cache_config.get(
-                        'custom', {}).items():
-                    _keys, _keys_async = self._custom_clear_cache(
-                        ins, cls, val, method)
-                    RestCacheKey.clear_action_cache(_keys)
-                    keys_async.extend(_keys_async)
-            if keys_async:
-                async_clear_cache_task.apply_async(args=[keys_async])
+    def _get_cache_snapshot(self):
+        """
+        载入时记录清理缓存需要的字段值, 保存时不用重新查询原数据
+        """
+        opts = self._meta
+        names = self._get_cache_fields()
+        if names is None:
+            fields = opts.concrete_fields
+        else:
+            fields = []
+            for name in names:
+                try:
+                    field = opts.pk if name == 'pk' else opts.get_field(name)
+                except FieldDoesNotExist:
+                    return None
+                if not field.concrete:
+                    return None
+                fields.append(field)
+            fields.append(opts.pk)
+        deferred = self.get_deferred_fields()
+        snapshot = {}
+        for field in fields:
+            if field.attname in deferred:
+                return None
+            snapshot[field.attname] = getattr(self, field.attname)
+        return snapshot
+
+    def _get_cache_origin(self):
+        """
+        通过载入时的字段值构造原数据, 字段未载入时返回None
+        """
+        snapshot = getattr(self, '_cache_origin', None)
+        if not snapshot:
+            return None
+        origin = self.__class__.from_db(
+            self._state.db, list(snapshot), list(snapshot.values()))
+        return origin
 
     def delete(self, using=None, keep_parents=False):
         keys = []
         keys_async = []
         if self.cache_config:
-            ins = self
+            keys, keys_async = self._get_clear_cache_keys([self], 'delete')
+        db = using or self._state.db
+        ret = super().delete(using, keep_parents)
+        if keys or keys_async:
+            CacheInvalidation.defer(keys, keys_async, db)
+        return ret
+
+    def _get_clear_cache_keys(self, objs, method):
+        """
+        汇总default, foreign, custom配置需要清理的key并去重
+        """
+        keys = {}
+        keys_async = {}
+        for ins in objs:
             for cls, val in self.cache_config.get('default', {}).items():
                 _keys, _keys_async = self._default_clear_cache(
-                    ins, cls, val, 'delete')
-                keys.extend(_keys)
-                keys_async.extend(_keys_async)
+                    ins, cls, val, method)
+                keys.update(dict.fromkeys(_keys))
+                keys_async.update(dict.fromkeys(_keys_async))
             for cls, val in self.cache_config.get('foreign', {}).items():
                 _keys, _keys_async = self._foreign_clear_cache(
-                    ins, cls, val, 'delete')
-                RestCacheKey.clear_action_cache(_keys)
-                keys_async.extend(_keys_async)
+                    ins, cls, val, method)
+                keys.update(dict.fromkeys(_keys))
+                keys_async.update(dict.fromkeys(_keys_async))
             for cls, val in self.cache_config.get('custom', {}).items():
                 _keys, _keys_async = self._custom_clear_cache(
-                    ins, cls, val, 'delete')
-                keys.extend(_keys)
-                keys_async.extend(_keys_async)
-        ret = super().delete(using, keep_parents)
-        if keys:
-            RestCacheKey.clear_action_cache(keys)
-        if keys_async:
-            async_clear_cache_task.apply_async(args=[keys_async])
-        return ret
+                    ins, cls, val, method)
+                keys.update(dict.fromkeys(_keys))
+                keys_async.update(dict.fromkeys(_keys_async))
+        return list(keys), list(keys_async)
 
     class Meta:
         abstract = True
 
 
+QUERY_CACHE_EMPTY = '-'
+
+
 class CacheModelMixin(models.Model):
     """
     Model缓存处理, 如果:
@@ -264,11 +506,16 @@ class CacheModelMixin(models.Model):
             objects_cache_fields = {
                 'object': ['id',],
                 'query': ['user_id',],
+                'order': '-pk', # query id列表排序, 默认'pk'
             }
             ....
 
         user.cache_get(id=15)
-        user.cache_query(id=15) # queryset max length 100
+        user.cache_get_many([15, 16]) # {15: user, 16: user}
+        user.cache_query(user_id=15)
+        user.cache_query(user_id=15, _offset=20, _limit=10)
+
+    save/delete时更新对象缓存, 并增量维护已缓存的query id列表
     """
 
     objects_cache_fields = {
@@ -276,21 +523,119 @@ class CacheModelMixin(models.Model):
         'query': [],
     }
 
+    objects = RestManager()
+
+    def _get_model_cache_keys(self, objs):
+        """
+        批量操作需要清理的对象和查询缓存key
+        """
+        keys = {}
+        for ins in objs:
+            try:
+                # bulk_create未返回id时没有对象缓存
+                if self.objects_cache_fields.get('object') and \
+                        ins.pk is not None:
+                    key, _ = self.__cache_key__(**ins.__cache_kwargs__())
+                    keys[(key, False)] = None
+                if self.objects_cache_fields.get('query'):
+                    key, _ = self.__cache_query_key__(
+                        **ins.__cache_query_kwargs__())
+                    keys[(key, False)] = None
+            except Exception:
+                logger.exception('clear cache error')
+        return list(keys)
+
+    # 只在缓存存在时加入id
+    query_cache_script = """
+        if redis.call('exists', KEYS[1]) == 1 then
+            redis.call('zadd', KEYS[1], ARGV[2], ARGV[1])
+        end
+    """
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        ins = super().from_db(db, field_names, values)
+        ins._cache_query_origin = ins._get_cache_query_origin()
+        return ins
+
+    def _get_cache_query_origin(self):
+        """
+        记录载入时的query字段值, 保存时移动id所在分组
+        """
+        if not self.objects_cache_fields.get('query'):
+            return None
+        deferred = self.get_deferred_fields()
+        for field in self.objects_cache_fields.get('query'):
+            if field in deferred:
+                return None
+        return self.__cache_query_kwargs__()
+
+    def _update_query_cache(self, origin, using=None):
+        """
+        增量维护query id缓存, 新分组未缓存时不写入, 事务提交后执行
+            origin: 保存前的query字段值, None时删除当前分组缓存
+        """
+        key, _ = self.__cache_query_key__(**self.__cache_query_kwargs__())
+        if origin is None:
+            CacheInvalidation.defer([(key, False)], using=using)
+            return
+        origin_key = None
+        if origin and origin != self.__cache_query_kwargs__():
+            origin_key, _ = self.__cache_query_key__(**origin)
+        CacheInvalidation.defer([], using=using, callbacks=[functools.partial(
+            self._execute_query_cache, key, str(self.pk),
+            self._cache_query_score(self), origin_key)])
+
+    @staticmethod
+    def _execute_object_cache(key, ts, data=None):
+        """
+        事务提交后写入对象缓存, data为None时删除;
+        与id列表的更新一起按保存顺序执行
+        """
+        try:
+            client = ProxyCache(key, ts).client
+            if data is None:
+                client.delete(key)
+            else:
+                client.set(key, data, ts)
+        except Exception:
+            logger.exception('set cache error')
+
+    @classmethod
+    def _execute_query_cache(cls, key, pk, score=None, origin_key=None):
+        """
+        score为None时从分组删除id, 否则从原分组移到已缓存的新分组
+        """
+        try:
+            client = RedisClient().get_conn()
+            if origin_key:
+                client.zrem(origin_key, pk)
+            if score is None:
+                client.zrem(key, pk)
+            else:
+                client.register_script(cls.query_cache_script)(
+                    keys=[key], args=[pk, score])
+        except Exception:
+            logger.exception('set cache error')
+
     def save(self, force_insert=False, force_update=False, using=None,
              update_fields=None):
+        adding = self._state.adding
+        origin = getattr(self, '_cache_query_origin', None)
         super().save(force_insert, force_update, using,
                      update_fields)
         try:
             if self.objects_cache_fields.get('object'):
-                kwargs = self.__cache_kwargs__()
-                ProxyCache(
-                    *self.__cache_key__(**kwargs), convert='object'
-                ).set(self)
+                # 保存时的快照, 事务提交后写入
+                key, ts = self.__cache_key__(**self.__cache_kwargs__())
+                CacheInvalidation.defer(
+                    [], using=self._state.db, callbacks=[functools.partial(
+                        self._execute_object_cache, key, ts,
+                        ProxyCache.dumps(self, 'model'))])
             if self.objects_cache_fields.get('query'):
-                q_kwargs = self.__cache_query_kwargs__()
-                ProxyCache(
-                    *self.__cache_query_key__(**q_kwargs), convert='object'
-                ).delete()
+                self._update_query_cache(
+                    {} if adding else origin, self._state.db)
+                self._cache_query_origin = self._get_cache_query_origin()
         except Exception:
             logger.exception('set cache error')
 
@@ -298,18 +643,20 @@ class CacheModelMixin(models.Model):
         try:
             kwargs = self.__cache_kwargs__()
             q_kwargs = self.__cache_query_kwargs__()
+            pk = str(self.pk)
         except Exception:
             logger.exception('set cache error')
+        db = using or self._state.db
         ret = super().delete(using, keep_parents)
         try:
             if self.objects_cache_fields.get('object'):
-                ProxyCache(
-                    *self.__cache_key__(**kwargs), convert='object'
-                ).delete()
+                key, ts = self.__cache_key__(**kwargs)
+                CacheInvalidation.defer([], using=db, callbacks=[
+                    functools.partial(self._execute_object_cache, key, ts)])
             if self.objects_cache_fields.get('query'):
-                ProxyCache(
-                    *self.__cache_query_key__(**q_kwargs), convert='object'
-                ).delete()
+                key, _ = self.__cache_query_key__(**q_kwargs)
+                CacheInvalidation.defer([], using=db, callbacks=[
+                    functools.partial(self._execute_query_cache, key, pk)])
         except Exception:
             logger.exception('set cache error')
         return ret
@@ -322,7 +669,7 @@ class CacheModelMixin(models.Model):
             if key not in cls.objects_cache_fields.get('object')
         }
         ins = ProxyCache(
-            *cls.__cache_key__(**kwargs), convert='object'
+            *cls.__cache_key__(**kwargs), convert='model'
         ).get_or_cache(cls.objects.get, **kwargs)
         if _validate:
             for key, val in n_kwargs.items():
@@ -331,36 +678,179 @@ class CacheModelMixin(models.Model):
         return ins
 
     @classmethod
-    def cache_query(cls, **kwargs):
+    def cache_get_many(cls, ids) -> dict:
         """
-        queryset cache
+        批量获取对象缓存, 一次mget, 未命中的一次id__in查询并写回
+            ids: objects_cache_fields['object']字段值, 只支持单个字段
+        return: {id: ins}, id按字段to_python转换('1' -> 1), 不存在的id不返回
+        """
+        fields = cls.objects_cache_fields.get('object')
+        if not fields or len(fields) != 1:
+            raise ValueError(
+                '{} cache_get_many need one object cache field'.format(
+                    cls.__name__))
+        field = fields[0]
+        to_python = (cls._meta.pk if field == 'pk'
+                     else cls._meta.get_field(field)).to_python
+        ids = list(dict.fromkeys(
+            to_python(_id) for _id in ids if _id))
+        keys = {_id: cls.__cache_key__(**{field: _id}) for _id in ids}
+        data = {}
+        try:
+            values = ProxyCache.get_many(
+                [key for key, _ in keys.values()], convert='model')
+        except Exception:
+            logger.exception('get cache error')
+            values = [None] * len(ids)
+        for _id, ins in zip(ids, values):
+            if ins is not None:
+                data[_id] = ins
+        if misses := [_id for _id in ids if _id not in data]:
+            cache_data = {}
+            ts = None
+            for ins in cls.objects.filter(**{
+                    '{}__in'.format(field): misses}):
+                _id = getattr(ins, field)
+                data[_id] = ins
+                key, ts = keys[_id]
+                cache_data[key] = ins
+            try:
+                ProxyCache.set_many(cache_data, ts, convert='model')
+            except Exception:
+                logger.exception('set cache error')
+        return data
+
+    @classmethod
+    def cache_query(cls, _offset=0, _limit=None, **kwargs):
+        """
+        queryset cache, 按query字段缓存有序id列表(sorted set),
+        通过cache_get_many获取对象
+            _offset, _limit: 分页
+            非query字段的过滤不使用id缓存, 查询数据库获取当前页id,
+            只加载当前页对象
         """
         n_kwargs = {
             key: val
             for key, val in kwargs.items()
             if key not in cls.objects_cache_fields.get('query')
         }
-        proxy = ProxyCache(
-            *cls.__cache_query_key__(**kwargs), convert='object'
-        )
-        if (queryset := proxy.get()) is None:
-            queryset = cls.objects.filter(**kwargs)[:100]
-            if queryset:
-                proxy.set(queryset)
-
         if n_kwargs:
-            filter_queryset = []
-            for ins in queryset:
-                flag = True
-                for key, val in kwargs.items():
-                    if getattr(ins, key) != val:
-                        flag = False
-                        break
-                if flag:
-                    filter_queryset.append(ins)
-            return filter_queryset
+            end = _offset + _limit if _limit is not None else None
+            ids = list(cls.objects.filter(**kwargs).order_by(
+                cls.objects_cache_fields.get('order', 'pk')
+            ).values_list('pk', flat=True)[_offset:end])
+        else:
+            key, ts = cls.__cache_query_key__(**kwargs)
+            ids = cls._cache_query_ids(key, ts, kwargs, _offset, _limit)
+        data = cls._cache_get_objects(ids)
+        return [data[_id] for _id in ids if _id in data]
+
+    @classmethod
+    def _cache_query_order(cls):
+        """
+        objects_cache_fields['order']: id列表排序字段, 默认'pk', 倒序'-pk'
+        字段值为数字或时间; 非数字主键(uuid, char)按id字符串排序
+        """
+        order = cls.objects_cache_fields.get('order', 'pk')
+        return order.lstrip('-'), order.startswith('-')
+
+    # 可以作为sorted set score的排序字段
+    cache_query_score_fields = (
+        models.IntegerField, models.FloatField, models.DecimalField,
+        models.DateField,
+    )
+
+    @classmethod
+    def _cache_query_score(cls, ins) -> float:
+        """
+        非数字主键的score都为0, sorted set按成员(id字符串)排序
+        """
+        field, _ = cls._cache_query_order()
+        val = getattr(ins, field)
+        if hasattr(val, 'timestamp'):
+            return val.timestamp()
+        if hasattr(val, 'toordinal'):
+            return float(val.toordinal())
+        if isinstance(val, (int, float, decimal.Decimal)):
+            return float(val)
+        return 0.0
+
+    @classmethod
+    def check(cls, **kwargs):
+        errors = super().check(**kwargs)
+        if not cls.objects_cache_fields.get('query'):
+            return errors
+        name, _ = cls._cache_query_order()
+        try:
+            field = cls._meta.pk if name == 'pk' \
+                else cls._meta.get_field(name)
+        except FieldDoesNotExist:
+            field = None
+        if field is None or not (
+                field.primary_key or
+                isinstance(field, cls.cache_query_score_fields)):
+            errors.append(checks.Error(
+                "objects_cache_fields['order'] must be the primary key or "
+                "a numeric/date field, got '{}'.".format(name),
+                obj=cls,
+                id='qx_rest.E001',
+            ))
+        return errors
+
+    @classmethod
+    def _cache_query_ids(cls, key, ts, kwargs, offset=0, limit=None):
+        """
+        获取缓存id列表, 未缓存时查询query字段对应的全部id
+        sorted set包含一个占位成员QUERY_CACHE_EMPTY(score -inf),
+        用于缓存空结果
+        """
+        field, reverse = cls._cache_query_order()
+        # 正序时占位成员在第一位
+        start = offset if reverse else offset + 1
+        end = start + limit - 1 if limit is not None else -1
+        client = RedisClient().get_conn()
+        pipe = client.pipeline(transaction=False)
+        pipe.exists(key)
+        if reverse:
+            pipe.zrevrange(key, start, end)
         else:
-            return list(queryset)
+            pipe.zrange(key, start, end)
+        exists, ids = pipe.execute()
+        if exists:
+            pk = cls._meta.pk
+            return [
+                pk.to_python(_id) for _id in ids
+                if _id != QUERY_CACHE_EMPTY
+            ]
+
+        q_kwargs = {
+            key: val
+            for key, val in kwargs.items()
+            if key in cls.objects_cache_fields.get('query')
+        }
+        queryset = cls.objects.filter(**q_kwargs).only('pk', field)
+        # 与sorted set一致: score相同时按id字符串排序
+        objs = sorted(
+            queryset, key=lambda ins: (cls._cache_query_score(ins),
+                                       str(ins.pk)),
+            reverse=reverse)
+        mapping = {QUERY_CACHE_EMPTY: '-inf'}
+        mapping.update({
+            str(ins.pk): cls._cache_query_score(ins) for ins in objs
+        })
+        pipe = client.pipeline(transaction=False)
+        pipe.delete(key)
+        pipe.zadd(key, mapping)
+        pipe.expire(key, ts)
+        pipe.execute()
+        end = offset + limit if limit is not None else None
+        return [ins.pk for ins in objs[offset:end]]
+
+    @classmethod
+    def _cache_get_objects(cls, ids) -> dict:
+        if cls.objects_cache_fields.get('object') in (['id'], ['pk']):
+            return cls.cache_get_many(ids)
+        return cls.objects.in_bulk(ids)
 
     @classmethod
     def __cache_key__(cls, **kwargs):
@@ -383,7 +873,7 @@ class CacheModelMixin(models.Model):
 
     @classmethod
     def __cache_query_key__(cls, **kwargs):
-        key = 'qx_base:q_model:object:{}:'.format(
+        key = 'qx_base:q_model:ids:{}:'.format(
             cls.__name__).lower()
         args = []
         for field in sorted(cls.objects_cache_fields.get('query')):
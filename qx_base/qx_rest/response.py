@@ -1,6 +1,7 @@
+import json
 import logging
 from django.http import JsonResponse
-from ..qx_core.storage.caches import ApiJSONEncoder
+from ..qx_core.storage.caches import ApiJSONEncoder, RawJSON
 
 
 logger = logging.getLogger(__name__)
@@ -33,8 +34,22 @@ class ApiNotFoundResponse(JsonResponse):
         super().__init__(data=results, status=404)
 
 
+# '{"code": 200, "msg": ["success"], "data": '
+API_RESPONSE_PREFIX = json.dumps({
+    "code": 200,
+    "msg": ["success"],
+    "data": None,
+})[:-len('null}')].encode()
+
+
 class ApiResponse(JsonResponse):
     def __init__(self, data: dict, encoder=ApiJSONEncoder):
+        if isinstance(data, RawJSON):
+            # 缓存的已编码数据直接拼接
+            super(JsonResponse, self).__init__(
+                content=b''.join([API_RESPONSE_PREFIX, data, b'}']),
+                content_type='application/json', status=200)
+            return
         results = {
             "code": 200,
             "msg": ["success"],
@@ -1,10 +1,12 @@
 import jwt
+import copy
+import asyncio
+import hashlib
 import logging
 from urllib.parse import parse_qs
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 from django.conf import settings
-from django.db import close_old_connections
 from django.contrib.auth.models import AnonymousUser
 from channels.db import database_sync_to_async
 from channels.auth import AuthMiddlewareStack
@@ -17,8 +19,9 @@ from ..qx_rest.exceptions import (
     AuthenticationExpired,
     UserDisabled,
 )
-from ..qx_core.storage.caches import ProxyCache
-from ..qx_core.storage.redis import OriginAioRedisClient
+from ..qx_core.storage import RedisClient, LocalCache
+from ..qx_core.storage.caches import ProxyCache, AsyncProxyCache
+from ..qx_core.tools import AioSingleton
 from .tools import UserLastAccessTime
 
 
@@ -27,6 +30,8 @@ logger = logging.getLogger(__name__)
 
 AUTH_TOKEN_CACHE_KEY = "user:userinstance:{}"
 AUTH_TOKEN_CACHE_TIME = 60 * 60 * 24 * 30
+AUTH_LOCAL_TOKEN_KEY = "user:token:{}"
+AUTH_LOCAL_ACCESS_KEY = "user:accesstime:{}"
 
 
 def get_authorization_header(request, header_name="HTTP_MYAUTHORIZATION"):
@@ -76,6 +81,88 @@ class UserJWT():
         return api_settings.JWT_DECODE_HANDLER(token)
 
 
+class LocalAuthCache():
+    """
+    进程内认证缓存, 重复的token跳过验签和redis读取
+    ---
+    token: sha256(token) -> (user_id, timestamp), token内容不变, 每次只检查过期
+    user: AUTH_TOKEN_CACHE_KEY -> user, 用户修改/禁用时通过redis广播失效
+    accesstime: 同一用户最近访问时间的写入间隔
+
+    settings:
+        AUTH_LOCAL_CACHE_SIZE: 最大key数量, 默认10000
+        AUTH_LOCAL_CACHE_TIMEOUT: 缓存时间(秒), 默认30, 0关闭
+        AUTH_ACCESS_TIME_INTERVAL: 最近访问时间写入间隔(秒), 默认60
+    """
+
+    timeout = getattr(settings, 'AUTH_LOCAL_CACHE_TIMEOUT', 30)
+    access_interval = getattr(settings, 'AUTH_ACCESS_TIME_INTERVAL', 60)
+    cache = LocalCache(
+        maxsize=getattr(settings, 'AUTH_LOCAL_CACHE_SIZE', 10000),
+        timeout=timeout)
+
+    @staticmethod
+    def token_key(token) -> str:
+        if isinstance(token, str):
+            token = token.encode()
+        return AUTH_LOCAL_TOKEN_KEY.format(hashlib.sha256(token).hexdigest())
+
+    @classmethod
+    def decode(cls, token) -> tuple:
+        """
+        return: (user_id, timestamp)
+        """
+        key = cls.token_key(token)
+        if (data := cls.cache.get(key)) is not None:
+            return data
+        userinfo = UserJWT.decode(token)
+        data = (userinfo.get("user_id"), userinfo.get("timestamp"))
+        if cls.timeout and data[0]:
+            cls.cache.set(key, data)
+        return data
+
+    @classmethod
+    def get_user(cls, user_id):
+        """
+        返回副本, 请求中修改user不影响缓存
+        """
+        if user := cls.cache.get(AUTH_TOKEN_CACHE_KEY.format(user_id)):
+            return copy.copy(user)
+        return None
+
+    @classmethod
+    def set_user(cls, user):
+        if cls.timeout and user.is_active:
+            cls.cache.set(
+                AUTH_TOKEN_CACHE_KEY.format(user.id), copy.copy(user))
+
+    @classmethod
+    def need_update_access(cls, user_id) -> bool:
+        if not cls.access_interval:
+            return True
+        key = AUTH_LOCAL_ACCESS_KEY.format(user_id)
+        if cls.cache.get(key):
+            return False
+        cls.cache.set(key, True, cls.access_interval)
+        return True
+
+    @staticmethod
+    def invalidate_user(user_id):
+        """
+        删除redis中的用户快照, 并通知所有进程删除一级缓存
+        """
+        LocalAuthCache.invalidate_users([user_id])
+
+    @staticmethod
+    def invalidate_users(user_ids):
+        keys = [AUTH_TOKEN_CACHE_KEY.format(user_id) for user_id in user_ids]
+        if not keys:
+            return
+        RedisClient().get_conn().delete(*keys)
+        for key in keys:
+            LocalCache.invalidate(key)
+
+
 class JwtAuthentication(BaseAuthentication):
 
     def authenticate(self, request):
@@ -86,7 +173,8 @@ class JwtAuthentication(BaseAuthentication):
             return (request._resource_user, token)
         return self.authenticate_credentials(token, request=request)
 
-    def _verify_expire(self, timestamp):
+    @staticmethod
+    def _verify_expire(timestamp):
         created = timezone.datetime.fromtimestamp(timestamp, tz=timezone.utc)
         if (timezone.now() - timezone.timedelta(
                 days=settings.QX_BASE_SETTINGS.get('JWT_EXPIRED_DAYS', 90)
@@ -96,17 +184,20 @@ class JwtAuthentication(BaseAuthentication):
     def authenticate_credentials(self, key, request=None):
         UserModel = get_user_model()
         try:
-            userinfo = UserJWT.decode(key)
-            if not userinfo.get("user_id"):
+            user_id, timestamp = LocalAuthCache.decode(key)
+            if not user_id:
                 raise exceptions.AuthenticationFailed("认证失败")
-            self._verify_expire(userinfo['timestamp'])
-            user_id = userinfo['user_id']
-            proxy = ProxyCache(
-                AUTH_TOKEN_CACHE_KEY, AUTH_TOKEN_CACHE_TIME,
-                args=[user_id], convert='object')
-            user = proxy.get()
+            self._verify_expire(timestamp)
+            user = LocalAuthCache.get_user(user_id)
+            if user is None:
+                proxy = ProxyCache(
+                    AUTH_TOKEN_CACHE_KEY, AUTH_TOKEN_CACHE_TIME,
+                    args=[user_id], convert='model')
+                user = proxy.get()
+                if user:
+                    LocalAuthCache.set_user(user)
             if user:
-                if request:
+                if request and LocalAuthCache.need_update_access(user_id):
                     # 设置用户最近访问时间
                     try:
                         UserLastAccessTime().update_access_time(
@@ -114,11 +205,12 @@ class JwtAuthentication(BaseAuthentication):
                     except Exception:
                         logger.exception("UserLastAccessTime")
                 return user, key
-            user = UserModel.objects.get(id=userinfo['user_id'])
+            user = UserModel.objects.get(id=user_id)
             if not user.is_active:
                 raise UserDisabled()
             if user:
                 proxy.set(user)
+                LocalAuthCache.set_user(user)
             return user, key
         except (jwt.DecodeError, TypeError, UnicodeDecodeError,
                 jwt.InvalidAlgorithmError, KeyError):
@@ -130,51 +222,144 @@ class JwtAuthentication(BaseAuthentication):
         return settings.JWT_TOKEN_KEYWORD
 
 
-class AioJWTAuthMiddleware:
-    def __init__(self, app):
-        self.app = app
+_background_tasks = set()
 
-    async def __call__(self, scope, receive, send):
-        close_old_connections()
-        try:
-            if(jwt_token_list := parse_qs(
-                    scope["query_string"].decode("utf8")).get('token', None)):
-                jwt_token = jwt_token_list[0]
-                userinfo = UserJWT.decode(jwt_token)
 
-                if not userinfo.get("user_id"):
-                    raise KeyError
-                user_id = userinfo['user_id']
+def run_in_background(coro):
+    """
+    不等待执行结果, 保留task引用直到完成, 异常只记录日志
+    """
+    task = asyncio.get_running_loop().create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_done)
+    return task
 
-                client = await OriginAioRedisClient().get_conn()
-                key = AUTH_TOKEN_CACHE_KEY.format(user_id)
-                _data = client.get(key)
-                user = ProxyCache.loads(_data, convert='object')
 
-                if user:
-                    scope['user'] = user
-                else:
-                    user = await self.get_user(user_id)
-                    if user:
-                        if not user.is_active:
-                            user = AnonymousUser()
-                    else:
-                        user = AnonymousUser()
-                    scope['user'] = user
-            else:
-                scope['user'] = AnonymousUser()
-        except (jwt.DecodeError, TypeError, UnicodeDecodeError,
-                jwt.InvalidAlgorithmError, KeyError):
-            scope['user'] = AnonymousUser()
-        return await self.app(scope, receive, send)
+def _background_done(task):
+    _background_tasks.discard(task)
+    if not task.cancelled() and (ex := task.exception()):
+        logger.error("background task: {}".format(ex), exc_info=ex)
 
+
+class UserBatchLoader(metaclass=AioSingleton):
+    """
+    合并同一轮事件循环中的用户查询, 一次id__in查询并写回缓存
+    ---
+    每个event loop一个实例
+    """
+
+    def __init__(self):
+        self.pending = {}
+
+    async def load(self, user_id):
+        """
+        return: user or None
+        """
+        if (future := self.pending.get(user_id)) is None:
+            loop = asyncio.get_running_loop()
+            if not self.pending:
+                loop.call_soon(lambda: run_in_background(self.dispatch()))
+            future = loop.create_future()
+            self.pending[user_id] = future
+        return await asyncio.shield(future)
+
+    async def dispatch(self):
+        pending, self.pending = self.pending, {}
+        try:
+            users = await self.load_users(list(pending))
+        except Exception as ex:
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(ex)
+            return
+        for user_id, future in pending.items():
+            if not future.done():
+                future.set_result(users.get(user_id))
+        await AsyncProxyCache.set_many({
+            AUTH_TOKEN_CACHE_KEY.format(user.id): user
+            for user in users.values() if user.is_active
+        }, AUTH_TOKEN_CACHE_TIME, convert='model')
+
+    @staticmethod
     @database_sync_to_async
-    def get_user(self, user_id):
-        UserModel = get_user_model()
+    def load_users(ids) -> dict:
+        return get_user_model().objects.in_bulk(ids)
+
+
+class AsyncJwtAuthentication():
+    """
+    JwtAuthentication的asyncio版本, 用于ASGI http和websocket
+    ---
+    用户快照从redis读取, 未命中时通过UserBatchLoader批量查询,
+    最近访问时间在后台写入redis, 不阻塞event loop
+
+    example:
+
+        user = await AsyncJwtAuthentication().authenticate(token)
+    """
+
+    async def authenticate(self, token, update_access=True):
+        """
+        return: user or None(token错误, 过期, 用户不存在或已禁用)
+        """
         try:
-            return UserModel.objects.get(id=user_id)
-        except UserModel.DoesNotExist:
+            user_id, timestamp = LocalAuthCache.decode(token)
+            if not user_id:
+                return None
+            JwtAuthentication._verify_expire(timestamp)
+        except (jwt.DecodeError, TypeError, UnicodeDecodeError,
+                jwt.InvalidAlgorithmError, KeyError, ValueError,
+                AuthenticationExpired):
             return None
+        if (user := LocalAuthCache.get_user(user_id)) is None:
+            user = await AsyncProxyCache(
+                AUTH_TOKEN_CACHE_KEY, AUTH_TOKEN_CACHE_TIME,
+                args=[user_id], convert='model').get()
+            if user is None:
+                user = await UserBatchLoader().load(user_id)
+                if user is None or not user.is_active:
+                    return None
+            LocalAuthCache.set_user(user)
+        if update_access and LocalAuthCache.need_update_access(user_id):
+            # 设置用户最近访问时间
+            run_in_background(
+                UserLastAccessTime().async_update_access_time(
+                    user_id, user_id))
+        return user
+
+    @staticmethod
+    def get_token(scope, header_name=b"myauthorization") -> str:
+        """
+        websocket使用query参数token, http使用MyAuthorization header
+        """
+        if token_list := parse_qs(
+                scope.get("query_string", b"").decode("utf8")).get('token'):
+            return token_list[0]
+        for name, value in scope.get("headers", []):
+            if name != header_name:
+                continue
+            auth = value.split()
+            if len(auth) != 2 or auth[0].lower() != \
+                    settings.JWT_TOKEN_KEYWORD.lower().encode():
+                return None
+            try:
+                return auth[1].decode()
+            except UnicodeError:
+                return None
+        return None
+
+
+class AioJWTAuthMiddleware:
+    def __init__(self, app):
+        self.app = app
+        self.auth = AsyncJwtAuthentication()
+
+    async def __call__(self, scope, receive, send):
+        user = None
+        if token := self.auth.get_token(scope):
+            user = await self.auth.authenticate(token)
+        scope['user'] = user or AnonymousUser()
+        return await self.app(scope, receive, send)
 
 
 def AioJWTAuthMiddlewareStack(app):
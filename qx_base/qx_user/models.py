@@ -1,5 +1,5 @@
 import time
-from django.db import models
+from django.db import models, transaction
 from django.conf import settings
 from django.utils import timezone
 from django.contrib.auth.models import (
@@ -8,10 +8,37 @@ from django.contrib.auth.models import (
 )
 from ..qx_core.models import AbstractBaseModel
 from ..qx_rest.models import RestModel
-from .auth import UserJWT
+from .auth import UserJWT, LocalAuthCache
 
 
-class UserManager(BaseUserManager):
+class UserQuerySet(models.QuerySet):
+    """
+    批量update/delete后清理认证缓存
+    """
+
+    def _invalidate_auth_cache(self):
+        """
+        执行前获取用户id, 事务提交后清理
+        """
+        user_ids = list(self.values_list('pk', flat=True))
+        transaction.on_commit(
+            lambda: LocalAuthCache.invalidate_users(user_ids), self.db)
+
+    def update(self, **kwargs):
+        self._invalidate_auth_cache()
+        return super().update(**kwargs)
+
+    update.alters_data = True
+
+    def delete(self):
+        self._invalidate_auth_cache()
+        return super().delete()
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+
+class UserManager(BaseUserManager.from_queryset(UserQuerySet)):
     """
     User Manager
     """
@@ -123,6 +150,24 @@ class QxUser(PermissionsMixin, AbstractBaseModel):
     def clear_cache(self):
         self.user.userinfo.clear_cache()
 
+    def save(self, force_insert=False, force_update=False, using=None,
+             update_fields=None):
+        adding = self._state.adding
+        super().save(force_insert=force_insert, force_update=force_update,
+                     using=using, update_fields=update_fields)
+        if not adding:
+            # 用户修改/禁用后, 清理认证缓存
+            user_id = self.id
+            transaction.on_commit(
+                lambda: LocalAuthCache.invalidate_user(user_id), using)
+
+    def delete(self, using=None, keep_parents=False):
+        user_id = self.id
+        data = super().delete(using=using, keep_parents=keep_parents)
+        transaction.on_commit(
+            lambda: LocalAuthCache.invalidate_user(user_id), using)
+        return data
+
     @classmethod
     def query_user(cls, account, mobile, email):
         if account:
@@ -6,7 +6,9 @@ import random
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 from django.conf import settings
-from ..qx_core.storage import RedisClient, RedisExpiredHash
+from ..qx_core.storage import (
+    RedisClient, AioRedisClient, RedisExpiredHash,
+)
 
 
 try:
@@ -52,6 +54,12 @@ class UserLastAccessTime(AccessTimeMixin):
         access_time = int(time.time())
         self.client.zadd(key, {filter_id: access_time})
 
+    async def async_update_access_time(self, filter_id, page_params=0):
+        page = page_params % self.total_page
+        key, ts = self.format_key(page)
+        access_time = int(time.time())
+        await AioRedisClient().get_conn().zadd(key, {filter_id: access_time})
+
     def _save_data_to_db(self, key, model, filter_field):
         for item in self.client.zrevrange(key, 0, -1, withscores=True):
             object_id = item[0]
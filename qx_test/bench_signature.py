@@ -0,0 +1,43 @@
+"""
+签名算法验签性能对比
+
+    $ python -m qx_test.bench_signature [number]
+"""
+import os
+import sys
+import timeit
+import django
+
+
+def main(number=2000):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'qx_test.settings')
+    django.setup()
+    from django.conf import settings
+    from Crypto.PublicKey import ECC
+    from qx_base.qx_core.signature import SignatureKey
+    from qx_base.qx_core.tools import param_sort
+
+    ed_key = ECC.generate(curve='ed25519')
+    keys = [
+        SignatureKey('rsa', 'rsa', settings.SIGNATURE_PUBLIC_KEY,
+                     settings.SIGNATURE_PRIVATE_KEY),
+        SignatureKey('hmac', 'hmac-sha256', 'bench-secret'),
+        SignatureKey('ed25519', 'ed25519',
+                     ed_key.public_key().export_key(format='PEM'),
+                     ed_key.export_key(format='PEM')),
+    ]
+    data = param_sort({
+        'id': 1, 'name': 'test', 'content': 'x' * 200,
+    }).encode()
+    print("{:<12} {:>12} {:>12}".format('scheme', 'verify/s', 'us/op'))
+    for key in keys:
+        sign = key.sign(data)
+        assert key.verify(sign, data)
+        seconds = timeit.timeit(
+            lambda: key.verify(sign, data), number=number)
+        print("{:<12} {:>12.0f} {:>12.1f}".format(
+            key.scheme, number / seconds, seconds / number * 1e6))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -1,6 +1,11 @@
+import time
+import shutil
+import subprocess
+import redis
 import pytest
 from qx_test.user.models import User, UserInfo
-from qx_base.qx_core.storage import RedisClient
+from qx_base.qx_core.storage import RedisClient, RedisPool
+from qx_base.qx_core.tools import Singleton
 
 
 @pytest.fixture(scope='session', autouse=True)
@@ -10,6 +15,15 @@ def redis_flushall():
     client.flushall()
 
 
+@pytest.fixture()
+def redis_clear():
+    """
+    清理其他用例的缓存(transaction用例数据库id会重复)
+    """
+    client = RedisClient().get_conn()
+    client.flushall()
+
+
 @pytest.fixture()
 def user_data_init(db):
     for i in range(10):
@@ -42,3 +56,89 @@ def signin_request(rf, user_data_init):
             content_type='application/json')
         return request
     return _func
+
+
+def _start_redis(tmp_path, port, *args):
+    proc = subprocess.Popen(
+        ['redis-server', '--port', str(port), '--save', '',
+         '--dir', str(tmp_path), *args],
+        stdout=subprocess.DEVNULL)
+    client = redis.Redis(port=port)
+    for _ in range(50):
+        try:
+            client.ping()
+            break
+        except redis.ConnectionError:
+            time.sleep(0.1)
+    return proc
+
+
+@pytest.fixture(scope='session')
+def redis_nodes(tmp_path_factory):
+    """
+    本地多实例: 两个分片节点, 6391有一个从库6393
+    """
+    if not shutil.which('redis-server'):
+        pytest.skip('redis-server not found')
+    tmp_path = tmp_path_factory.mktemp('redis')
+    procs = [
+        _start_redis(tmp_path, 6391),
+        _start_redis(tmp_path, 6392),
+        _start_redis(tmp_path, 6393, '--replicaof', '127.0.0.1', '6391'),
+    ]
+    yield [
+        {'host': '127.0.0.1', 'port': 6391,
+         'replicas': [{'host': '127.0.0.1', 'port': 6393}]},
+        {'host': '127.0.0.1', 'port': 6392},
+    ]
+    for proc in procs:
+        proc.terminate()
+        proc.wait()
+
+
+@pytest.fixture(scope='session')
+def redis_cluster_nodes(tmp_path_factory):
+    """
+    本地三个主节点的redis cluster
+    """
+    if not shutil.which('redis-server') or not shutil.which('redis-cli'):
+        pytest.skip('redis-server not found')
+    tmp_path = tmp_path_factory.mktemp('redis_cluster')
+    ports = [7391, 7392, 7393]
+    procs = [
+        _start_redis(tmp_path, port, '--cluster-enabled', 'yes',
+                     '--cluster-config-file', 'nodes-{}.conf'.format(port))
+        for port in ports
+    ]
+    subprocess.run(
+        ['redis-cli', '--cluster', 'create', '--cluster-yes'] +
+        ['127.0.0.1:{}'.format(port) for port in ports],
+        stdout=subprocess.DEVNULL, check=True)
+    client = redis.Redis(port=ports[0], decode_responses=True)
+    for _ in range(50):
+        if 'cluster_state:ok' in client.execute_command('CLUSTER INFO'):
+            break
+        time.sleep(0.1)
+    yield [{'host': '127.0.0.1', 'port': port} for port in ports]
+    for proc in procs:
+        proc.terminate()
+        proc.wait()
+
+
+@pytest.fixture()
+def redis_mode(settings):
+    """
+    切换REDIS_MODE/REDIS_NODES, 结束后恢复默认连接池
+    """
+    origin = Singleton._instances.pop(RedisPool, None)
+
+    def _func(mode, nodes, read_from_replicas=False):
+        settings.REDIS_MODE = mode
+        settings.REDIS_NODES = nodes
+        settings.REDIS_READ_FROM_REPLICAS = read_from_replicas
+        Singleton._instances.pop(RedisPool, None)
+        return RedisPool()
+    yield _func
+    Singleton._instances.pop(RedisPool, None)
+    if origin is not None:
+        Singleton._instances[RedisPool] = origin
@@ -1,5 +1,28 @@
+import ast
+import gc
+import json
+import time
+import asyncio
+import uuid
+import weakref
+import pickle
+import decimal
+import datetime
+import threading
+import redis
 import pytest
+from django.conf import settings
 from qx_test.user.models import Post
+from qx_base.qx_core.storage import (
+    ProxyCache, OriginRedisClient, RedisClient, StatsBlockingConnectionPool,
+    AsyncProxyCache, AioRedisClient,
+)
+from qx_base.qx_core.storage.local import LocalCache, LocalCacheSubscriber
+from qx_base.qx_core.storage.routing import AioShardedRedis
+from qx_base.qx_rest.caches import CacheInvalidation
+from qx_base.qx_core.signature import (
+    ApiSignature, SignatureKey, load_rsa_scheme,
+)
 
 
 class TestModelCountMixin:
@@ -47,3 +70,623 @@ class TestModelCountMixin:
         Post.add_field_count(post.id, 1)
         num = Post.load_field_count(post.id)
         assert num == 5
+
+
+class TestLocalCache:
+
+    def test_lru(self):
+        cache = LocalCache(maxsize=2, timeout=60, broadcast=False)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+        cache.set('c', 3)
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        cache.set('d', 4, timeout=-1)
+        assert cache.get('d') is None
+
+    def test_invalidate(self):
+        cache = LocalCache(maxsize=10, timeout=60)
+        cache.set('viewset:test:list:1:aaa', 1)
+        cache.set('viewset:test:list:12:aaa', 2)
+        cache.set('viewset:test:retrieve:1', 3)
+        LocalCache.invalidate('viewset:test:list:1:', is_pattern=True)
+        assert cache.get('viewset:test:list:1:aaa') is None
+        assert cache.get('viewset:test:list:12:aaa') == 2
+        # 其他进程的广播
+        LocalCacheSubscriber.on_message({
+            'data': json.dumps(['viewset:test:retrieve:1', False])})
+        assert cache.get('viewset:test:retrieve:1') is None
+
+
+class TestProxyCacheLock:
+
+    def test_wait_other_rebuild(self):
+        proxy = ProxyCache('qx_test:lock:wait', 60)
+        proxy.delete()
+        lock = proxy.get_lock(10)
+        assert lock.acquire(blocking=False)
+
+        def _rebuild():
+            time.sleep(0.2)
+            proxy.set({'val': 'other'})
+            lock.release()
+
+        thread = threading.Thread(target=_rebuild)
+        thread.start()
+        data = proxy.get_or_lock(lambda: {'val': 'self'})
+        thread.join()
+        assert data == {'val': 'other'}
+
+    def test_soft_timeout(self):
+        proxy = ProxyCache('qx_test:lock:soft', 60)
+        proxy.set({'val': 'old'})
+        data = proxy.get_or_lock(lambda: {'val': 'new'}, soft_ts=30)
+        assert data == {'val': 'old'}
+        # 模拟缓存已存在40秒
+        proxy.client.expire(proxy.key, 20)
+        lock = proxy.get_lock(10)
+        assert lock.acquire(blocking=False)
+        data = proxy.get_or_lock(lambda: {'val': 'new'}, soft_ts=30)
+        assert data == {'val': 'old'}
+        lock.release()
+
+        # 后台刷新, 当前请求立即返回旧数据
+        started = threading.Event()
+        finish = threading.Event()
+
+        def _slow():
+            started.set()
+            finish.wait(5)
+            return {'val': 'new'}
+        data = proxy.get_or_lock(_slow, soft_ts=30)
+        assert data == {'val': 'old'}
+        assert started.wait(5)
+        assert proxy.get() == {'val': 'old'}
+        finish.set()
+        self.wait_for(lambda: proxy.get() == {'val': 'new'})
+        self.wait_for(lambda: lock.acquire(blocking=False))
+        lock.release()
+
+    def test_soft_timeout_error(self, caplog):
+        proxy = ProxyCache('qx_test:lock:soft_error', 60)
+        proxy.set({'val': 'old'})
+        proxy.client.expire(proxy.key, 20)
+
+        def _error():
+            raise ValueError
+        # 刷新失败时保留旧数据, 释放锁
+        assert proxy.get_or_lock(_error, soft_ts=30) == {'val': 'old'}
+        lock = proxy.get_lock(10)
+        self.wait_for(lambda: lock.acquire(blocking=False))
+        lock.release()
+        assert proxy.get() == {'val': 'old'}
+        assert 'refresh cache error' in caplog.text
+
+    @staticmethod
+    def wait_for(func, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not func():
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+
+class TestProxyCacheCodec:
+
+    def test_legacy(self):
+        data = {'a': [1, 2]}
+        assert ProxyCache.loads(
+            json.dumps(data).encode(), 'json') == data
+        assert ProxyCache.loads(pickle.dumps(data), 'object') == data
+        assert ProxyCache.loads(
+            str(pickle.dumps(data)).encode(), 'pickle') == data
+        assert ProxyCache.loads(ProxyCache.dumps(data, 'pickle'),
+                                'pickle') == data
+
+    def test_legacy_format(self, settings):
+        data = {'a': [1, 2]}
+        # 旧进程可以读取新进程写入的数据
+        assert json.loads(ProxyCache.dumps(data, 'json').decode()) == data
+        assert pickle.loads(ProxyCache.dumps(data, 'object')) == data
+        assert pickle.loads(ast.literal_eval(
+            ProxyCache.dumps(data, 'pickle').decode())) == data
+        settings.PROXY_CACHE_LEGACY_FORMAT = False
+        for convert in ['json', 'object', 'pickle']:
+            raw = ProxyCache.dumps(data, convert)
+            assert raw[0] <= 0x1f
+            assert ProxyCache.loads(raw, convert) == data
+
+    def test_msgpack(self):
+        data = {
+            1: 'a',
+            'dt': datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc),
+            'date': datetime.date(2020, 1, 1),
+            'dec': decimal.Decimal('1.10'),
+            'uuid': uuid.uuid4(),
+        }
+        proxy = ProxyCache('qx_test:codec:msgpack', 60, convert='msgpack')
+        proxy.set(data)
+        assert proxy.get() == data
+
+    def test_compress(self, settings):
+        settings.PROXY_CACHE_LEGACY_FORMAT = False
+        settings.PROXY_CACHE_COMPRESS = 'zlib'
+        settings.PROXY_CACHE_COMPRESS_MIN_SIZE = 100
+        data = [{'name': 'test'} for _ in range(100)]
+        proxy = ProxyCache('qx_test:codec:compress', 60)
+        proxy.set(data)
+        raw = OriginRedisClient().get_conn().get(proxy.key)
+        assert len(raw) < len(json.dumps(data))
+        assert proxy.get() == data
+        raw = ProxyCache.loads(ProxyCache.dumps(data, 'raw'), 'raw')
+        assert json.loads(raw) == data
+        settings.PROXY_CACHE_COMPRESS = None
+        assert proxy.get() == data
+
+
+class TestCacheTag:
+
+    def test_expired_members(self):
+        client = RedisClient().get_conn()
+        tag_key = RedisClient.tag_key('qx_test_trim')
+        client.delete(tag_key)
+        ProxyCache('qx_test:trim:old', 60, tags=['qx_test_trim']).set(1)
+        # 过期的成员在下次写入时删除
+        client.zadd(tag_key, {'qx_test:trim:old': time.time() - 1})
+        ProxyCache('qx_test:trim:new', 60, tags=['qx_test_trim']).set(1)
+        assert client.zrange(tag_key, 0, -1) == ['qx_test:trim:new']
+        assert 0 < client.ttl(tag_key) <= 60
+        RedisClient().clear_by_tag('qx_test_trim')
+        assert not client.exists('qx_test:trim:new')
+
+    def test_legacy_keys(self, mocker, settings):
+        import qx_test.user.views  # noqa
+        client = RedisClient().get_conn()
+        tag = 'viewset:babyviewset:list'
+        client.delete('qx_base:legacy_cleared:{}'.format(tag))
+        CacheInvalidation._legacy_cleared.pop(tag, None)
+        # tag集合之前写入的key
+        client.set('{}:1:legacy'.format(tag), 1)
+        clear = mocker.spy(RedisClient, 'clear_by_pattern')
+        CacheInvalidation([('{}:1*'.format(tag), True)]).execute()
+        assert not client.exists('{}:1:legacy'.format(tag))
+        assert clear.call_args[0][1] == '{}*'.format(tag)
+        assert 0 < client.ttl('qx_base:legacy_cleared:{}'.format(tag)) <= \
+            10 * 24 * 60 * 60
+        # 同一action的其他tag(如每个用户)不再scan
+        CacheInvalidation._legacy_cleared.pop(tag, None)
+        for user_id in range(2, 7):
+            CacheInvalidation([
+                ('{}:{}*'.format(tag, user_id), True)]).execute()
+        assert clear.call_count == 1
+        assert all(key.count(':') == 2
+                   for key in CacheInvalidation._legacy_cleared)
+        settings.REST_CACHE_LEGACY_CLEAR = False
+        client.delete('qx_base:legacy_cleared:{}'.format(tag))
+        CacheInvalidation._legacy_cleared.pop(tag, None)
+        CacheInvalidation([('{}*'.format(tag), True)]).execute()
+        assert clear.call_count == 1
+
+
+class TestRedisPool:
+
+    def test_shared_pool(self):
+        client = RedisClient().get_conn()
+        origin = OriginRedisClient().get_conn()
+        assert RedisClient().pool is OriginRedisClient().pool
+        client.set('qx_test:pool', 'val')
+        assert client.get('qx_test:pool') == 'val'
+        assert origin.get('qx_test:pool') == b'val'
+        pipe = origin.pipeline()
+        pipe.get('qx_test:pool')
+        pipe.mget(['qx_test:pool'])
+        assert pipe.execute() == [b'val', [b'val']]
+        assert client.pipeline().get('qx_test:pool').execute() == ['val']
+
+        stats = RedisClient().pool_stats()
+        assert stats['created'] >= 1
+        assert stats['in_use'] <= stats['created']
+        assert stats['wait_count'] >= 5
+
+    def test_blocking_pool(self):
+        pool = StatsBlockingConnectionPool(
+            max_connections=1, timeout=0.1,
+            host=settings.REDIS_HOST, port=settings.REDIS_PORT)
+        conn = pool.get_connection('GET')
+        assert pool.stats()['in_use'] == 1
+        with pytest.raises(redis.ConnectionError):
+            pool.get_connection('GET')
+        assert pool.stats()['timeout_count'] == 1
+        pool.release(conn)
+        assert pool.stats()['in_use'] == 0
+        pool.disconnect()
+
+
+class TestRedisRouting:
+
+    def check_storage(self, client):
+        keys = ['qx_test:shard:{}'.format(i) for i in range(50)]
+        for key in keys:
+            client.set(key, key)
+        assert client.mget(keys) == keys
+        pipe = client.pipeline(transaction=False)
+        pipe.get(keys[0])
+        pipe.ttl(keys[1])
+        assert pipe.execute() == [keys[0], -1]
+        assert client.unlink(*keys[:10]) == 10
+        assert client.exists(*keys) == 40
+
+        proxy = ProxyCache('qx_test:shard:tag', 60, tags=['qx_test'])
+        proxy.set({'a': 1})
+        assert proxy.get() == {'a': 1}
+        RedisClient().clear_by_tag('qx_test')
+        assert proxy.get() is None
+
+        proxy = ProxyCache('qx_test:shard:tag', 60, tags=['qx_test'])
+        proxy.set({'a': 1})
+        client.set('qx_test:shard:inv', 1)
+        plan = CacheInvalidation()
+        plan.keys['qx_test:shard:inv'] = None
+        plan.tags[RedisClient.tag_key('qx_test')] = None
+        plan.versions['qx_test:shard:version'] = 60
+        plan.execute()
+        assert proxy.get() is None
+        assert not client.exists('qx_test:shard:inv')
+        assert int(client.get('qx_test:shard:version')) > 0
+
+        lock = ProxyCache('qx_test:shard:lock', 60).get_lock(10)
+        assert lock.acquire(blocking=False)
+        lock.release()
+
+        RedisClient().clear_by_pattern('qx_test:shard:')
+        assert client.exists(*keys) == 0
+
+    def test_sharded(self, redis_nodes, redis_mode):
+        pool = redis_mode('sharded', redis_nodes)
+        assert RedisClient().multi_node
+        client = RedisClient().get_conn()
+        self.check_storage(client)
+
+        keys = ['qx_test:shard:{}'.format(i) for i in range(50)]
+        for key in keys:
+            client.set(key, key)
+        pipe = client.pipeline(transaction=False)
+        pipe.get(keys[0])
+        pipe.mget(keys[:10])
+        pipe.unlink(*keys[:5])
+        assert pipe.execute() == [keys[0], keys[:10], 5]
+        for node in redis_nodes:
+            assert redis.Redis(port=node['port']).dbsize() > 0
+        assert set(RedisClient().all_pool_stats()) == {
+            '127.0.0.1:6391', '127.0.0.1:6392', '127.0.0.1:6393'}
+        assert client.get_node_index('a{qx}b') == \
+            client.get_node_index('c{qx}d')
+        assert pool.multi_node
+
+        # scan依次遍历每个节点
+        cur, found = 0, []
+        while True:
+            cur, data = client.scan(cur, 'qx_test:shard:*', 10)
+            found.extend(data)
+            if cur == 0:
+                break
+        assert sorted(found) == sorted(keys[5:])
+        assert sorted(client.scan_iter('qx_test:shard:*')) == \
+            sorted(keys[5:])
+        client.flushall()
+
+    def test_async_sharded(self, redis_nodes, redis_mode):
+        redis_mode('sharded', redis_nodes)
+
+        async def _run():
+            client = AioRedisClient().get_conn()
+            assert isinstance(client, AioShardedRedis)
+            keys = ['qx_test:shard:{}'.format(i) for i in range(50)]
+            pipe = client.pipeline(transaction=False)
+            for key in keys:
+                pipe.set(key, key)
+            await pipe.execute()
+            assert await client.mget(keys) == keys
+            assert await client.unlink(*keys[:10]) == 10
+            assert await client.exists(*keys) == 40
+            assert sorted([
+                key async for key in client.scan_iter('qx_test:shard:*')
+            ]) == sorted(keys[10:])
+            script = client.register_script(
+                "return redis.call('GET', KEYS[1])")
+            assert await script(keys=[keys[10]]) == keys[10]
+
+            proxy = AsyncProxyCache(
+                'qx_test:shard:tag', 60, tags=['qx_test_aio'])
+            await proxy.set({'a': 1})
+            assert ProxyCache('qx_test:shard:tag', 60).get() == {'a': 1}
+            await AioRedisClient().clear_by_tag('qx_test_aio')
+            assert await proxy.get() is None
+
+            await AioRedisClient().clear_by_pattern('qx_test:shard:')
+            assert await client.exists(*keys) == 0
+        asyncio.run(_run())
+
+    def test_replica(self, redis_nodes, redis_mode):
+        redis_mode('sharded', redis_nodes[:1], read_from_replicas=True)
+        assert not RedisClient().multi_node
+        client = OriginRedisClient().get_conn()
+        read_client = client.get_client('qx_test:replica', read=True)
+        assert read_client.connection_pool.connection_kwargs['port'] == 6393
+        client.set('qx_test:replica', 'val')
+        client.get_client('qx_test:replica').wait(1, 1000)
+        assert client.get('qx_test:replica') == b'val'
+        client.delete('qx_test:replica')
+
+    def test_cluster(self, redis_cluster_nodes, redis_mode):
+        redis_mode('cluster', redis_cluster_nodes)
+        client = RedisClient().get_conn()
+        self.check_storage(client)
+        assert OriginRedisClient().get_conn().get('qx_test:shard:1') is None
+        client.set('qx_test:shard:1', 1)
+        assert OriginRedisClient().get_conn().get('qx_test:shard:1') == b'1'
+        client.delete('qx_test:shard:1')
+
+
+class TestAsyncStorage:
+
+    def test_singleton(self):
+        async def _get():
+            assert AioRedisClient() is AioRedisClient()
+            return AioRedisClient()
+        assert asyncio.run(_get()) is not asyncio.run(_get())
+
+    def test_loop_close(self, mocker):
+        from qx_base.qx_core.tools import AioSingleton
+        from qx_base.qx_core.storage.redis import AioRedisPool
+        aclose = mocker.spy(AioRedisPool, 'aclose')
+
+        async def _get():
+            client = AioRedisClient().get_conn()
+            await client.ping()
+            return weakref.ref(asyncio.get_running_loop()), \
+                weakref.ref(client.connection_pool)
+        refs = [asyncio.run(_get()) for _ in range(5)]
+        gc.collect()
+        # loop关闭时断开连接并删除实例, loop和连接池可以回收
+        assert aclose.call_count == 5
+        assert all(loop() is None and pool() is None for loop, pool in refs)
+        assert not any(loop.is_closed()
+                       for loop in AioSingleton._instances)
+
+    def test_proxy_cache(self):
+        async def _run():
+            proxy = AsyncProxyCache(
+                'qx_test:aio:{}', 60, args=[1], tags=['qx_test_aio'])
+            await proxy.delete()
+            calls = []
+
+            async def _load():
+                calls.append(1)
+                return {'a': 1}
+            assert await proxy.get_or_cache(_load) == {'a': 1}
+            assert await proxy.get_or_cache(_load) == {'a': 1}
+            assert len(calls) == 1
+            assert ProxyCache('qx_test:aio:1', 60).get() == {'a': 1}
+
+            await AioRedisClient().clear_by_tag('qx_test_aio')
+            assert await proxy.get() is None
+
+            await AsyncProxyCache.set_many(
+                {'qx_test:aio:2': [1], 'qx_test:aio:3': [2]}, 60)
+            assert await AsyncProxyCache.get_many(
+                ['qx_test:aio:2', 'qx_test:aio:3', 'qx_test:aio:4']) == \
+                [[1], [2], None]
+            await AioRedisClient().clear_by_pattern('qx_test:aio:')
+            assert await AsyncProxyCache.get_many(['qx_test:aio:2']) == \
+                [None]
+        asyncio.run(_run())
+
+
+class TestApiSignature:
+
+    def test_key_cache(self):
+        ApiSignature.reload()
+        sign = ApiSignature().signature('a=1&b=2')
+        assert ApiSignature().verify(sign, 'a=1&b=2')
+        assert not ApiSignature().verify(sign, 'a=1&b=3')
+        # 密钥只解析一次
+        assert load_rsa_scheme.cache_info().currsize == 2
+        ApiSignature().verify(sign, 'a=1&b=2')
+        assert load_rsa_scheme.cache_info().currsize == 2
+
+        # 轮换后旧密钥失效
+        from Crypto.PublicKey import RSA
+        key = RSA.generate(1024)
+        ApiSignature.reload(key.publickey().export_key().decode(),
+                            key.export_key().decode())
+        try:
+            assert not ApiSignature().verify(sign, 'a=1&b=2')
+            new_sign = ApiSignature().signature('a=1&b=2')
+            assert ApiSignature().verify(new_sign, 'a=1&b=2')
+        finally:
+            ApiSignature.reload()
+        assert ApiSignature().verify(sign, 'a=1&b=2')
+
+    def test_schemes(self, settings):
+        from Crypto.PublicKey import ECC
+        ed_key = ECC.generate(curve='ed25519')
+        settings.SIGNATURE_KEYS = {
+            'hmac1': {'scheme': 'hmac-sha256', 'key': 'secret1'},
+            'hmac2': {'scheme': 'hmac-sha256', 'key': 'secret2'},
+            'ed1': {
+                'scheme': 'ed25519',
+                'key': ed_key.public_key().export_key(format='PEM'),
+                'private_key': ed_key.export_key(format='PEM'),
+            },
+        }
+        ApiSignature.reload()
+        try:
+            api = ApiSignature()
+            for key_id, scheme in [('hmac1', 'hmac-sha256'),
+                                   ('hmac2', 'hmac-sha256'),
+                                   ('ed1', 'ed25519')]:
+                sign = api.signature('a=1', key_id)
+                assert api.verify(sign, 'a=1', key_id=key_id)
+                assert not api.verify(sign, 'a=2', key_id=key_id)
+                # 只指定算法时尝试所有密钥
+                assert api.verify(sign, 'a=1', scheme=scheme)
+                # 没有指定时使用默认rsa密钥
+                assert not api.verify(sign, 'a=1')
+            sign = api.signature('a=1', 'hmac1')
+            assert not api.verify(sign, 'a=1', key_id='hmac2')
+            assert not api.verify(sign, 'a=1', key_id='hmac1',
+                                  scheme='ed25519')
+            assert not api.verify(sign, 'a=1', key_id='unknown')
+            assert api.verify(api.signature('a=1'), 'a=1')
+            key = SignatureKey('k', 'hmac-sha256', 's')
+            assert key.verify(key.sign(b'a=1'), b'a=1')
+        finally:
+            del settings.SIGNATURE_KEYS
+            ApiSignature.reload()
+
+    def test_middleware(self, rf, settings):
+        from django.contrib.auth.models import AnonymousUser
+        from qx_base.qx_core.middleware import SignatureCheckMiddleware
+        from qx_base.qx_core.tools import param_sort, iter_param_sort
+
+        data = {'b': 'x y&', 'a': 1, 'c': 1.5, 'd': None, 'e': True,
+                'f': [1], 'g': {'a': 1}, '中': '文'}
+        assert b''.join(iter_param_sort(data)).decode() == param_sort(data)
+        assert b''.join(iter_param_sort(data, ['a'])).decode() == \
+            param_sort(data, ['a'])
+        assert not b''.join(iter_param_sort({}))
+
+        settings.IGNORE_CHECK_SIGN_PATH = ['/api/ignore', '/api/public/*']
+        settings.SIGN_BODY_MAX_SIZE = 100
+        middleware = SignatureCheckMiddleware(lambda request: None)
+
+        def check(request):
+            request.user = AnonymousUser()
+            return middleware.process_request(request)
+
+        api = ApiSignature()
+        sign = api.signature(param_sort('b=2&a=1'))
+        assert check(rf.get('/api/test/?b=2&a=1', HTTP_SIGN=sign)) is None
+        assert check(rf.get('/api/test/?b=2&a=3', HTTP_SIGN=sign))
+        assert check(rf.get('/api/test/?b=2&a=3')).status_code == 400
+        assert check(rf.get('/api/ignore')) is None
+        assert check(rf.get('/api/public/a/b')) is None
+        assert check(rf.get('/other/')) is None
+
+        body = json.dumps({'b': 2, 'a': '1', 'c': [1]})
+        sign = api.signature(param_sort(body, _json=True))
+        assert check(rf.post('/api/test/', body, HTTP_SIGN=sign,
+                             content_type='application/json')) is None
+        response = check(rf.post(
+            '/api/test/', json.dumps({'a': 'x' * 200}), HTTP_SIGN=sign,
+            content_type='application/json'))
+        assert json.loads(response.content)['msg'] == ['body too large']
+        response = check(rf.post('/api/test/', '{', HTTP_SIGN=sign,
+                                 content_type='application/json'))
+        assert json.loads(response.content)['msg'] == ['param error']
+
+    def test_replay(self, rf, settings):
+        from django.contrib.auth.models import AnonymousUser
+        from qx_base.qx_core.middleware import SignatureCheckMiddleware
+        from qx_base.qx_core.tools import param_sort
+
+        settings.SIGN_REPLAY_CHECK = True
+        middleware = SignatureCheckMiddleware(lambda request: None)
+        nonce = uuid.uuid4().hex
+        timestamp = str(int(time.time()))
+
+        def check(query, timestamp=timestamp, nonce=nonce, sign=None):
+            sign = sign or ApiSignature().signature(param_sort(
+                '{}&_timestamp={}&_nonce={}'.format(query, timestamp, nonce)))
+            request = rf.get('/api/test/?{}'.format(query), HTTP_SIGN=sign,
+                             HTTP_SIGN_TIMESTAMP=timestamp,
+                             HTTP_SIGN_NONCE=nonce)
+            request.user = AnonymousUser()
+            return middleware.process_request(request)
+
+        assert check('a=1') is None
+        # 重放
+        assert check('a=1')
+        assert check('a=1', nonce=uuid.uuid4().hex) is None
+        # 过期的timestamp
+        assert check('a=1', timestamp=str(int(time.time()) - 3600),
+                     nonce=uuid.uuid4().hex)
+        # nonce不在签名中
+        sign = ApiSignature().signature(param_sort('a=1'))
+        assert check('a=1', nonce=uuid.uuid4().hex, sign=sign)
+
+
+class TestNonceCache:
+
+    def test_add(self, mocker):
+        from qx_base.qx_core.storage.local import NonceCache
+        commands = mocker.spy(redis.Redis, 'execute_command')
+        pipelines = mocker.spy(redis.client.Pipeline, 'execute')
+
+        def round_trips():
+            names = [call[0][1] for call in commands.call_args_list]
+            names += ['PIPELINE'] * pipelines.call_count
+            commands.reset_mock()
+            pipelines.reset_mock()
+            return names
+
+        cache = NonceCache('test', expired=60)
+        now = int(time.time())
+        nonce = uuid.uuid4().hex
+        # 时间段第一次写入: SADD和EXPIRE一次往返
+        assert cache.add(nonce, now)
+        assert round_trips() == ['PIPELINE']
+        # 之后每次只有一个SADD
+        assert not cache.add(nonce, now)
+        assert cache.add(uuid.uuid4().hex, now)
+        assert round_trips() == ['SADD', 'SADD']
+        # 其他进程记录的nonce
+        other = NonceCache('test', expired=60)
+        assert not other.add(nonce, now)
+        assert other.add(uuid.uuid4().hex, now)
+        client = RedisClient().get_conn()
+        assert 0 < client.ttl(cache.get_key_name(now // 60)) <= 180
+        # 只保留当前前后时间段
+        cache.add(uuid.uuid4().hex, now - 600)
+        cache.add(uuid.uuid4().hex, now + 60)
+        assert now // 60 - 10 not in cache._buckets
+        assert len(cache._buckets) <= 3
+
+
+class TestErrorLogMiddleware:
+
+    def test_body_capture(self, rf, settings, caplog):
+        from django.http import JsonResponse
+        from qx_base.qx_core.middleware import ErrorLogMiddleware
+
+        settings.ERROR_LOG_BODY_MAX_SIZE = 10
+
+        def view(request):
+            data = json.loads(request.read())
+            return JsonResponse(data, status=data['status'])
+
+        middleware = ErrorLogMiddleware(view)
+        body = json.dumps({'status': 400, 'data': 'x' * 100})
+        request = rf.post('/api/test/', body,
+                          content_type='application/json')
+        response = middleware(request)
+        assert response.status_code == 400
+        # 请求自己的stream只保留前10字节, 不在middleware实例上保存
+        assert middleware.get_body(request) == body[:10].encode()
+        assert not hasattr(middleware, '_initial_http_body')
+
+        request = rf.post('/api/test/', json.dumps({'status': 500}),
+                          content_type='application/json')
+        response = middleware(request)
+        assert json.loads(response.content)['code'] == 5000
+        for _ in range(50):
+            if len([r for r in caplog.records
+                    if r.getMessage().startswith('ErrorLog')]) >= 2:
+                break
+            time.sleep(0.05)
+        records = [r for r in caplog.records
+                   if r.getMessage().startswith('ErrorLog')]
+        assert len(records) == 2
+        assert records[0].name == 'qx_base.qx_core.middleware'
+        assert repr(body[:10].encode()) in records[0].getMessage()
@@ -0,0 +1,475 @@
+import pickle
+import pytest
+from django.db import transaction
+from qx_base.qx_rest.caches import (
+    RestCacheKey, RestCacheMeta, VIEWSET_CACHE_CONFIG, CacheInvalidation,
+)
+from qx_base.qx_core.storage import ProxyCache, RedisClient
+from qx_base.qx_core.storage.codecs import ModelCodec
+from qx_base.qx_core.models import load_set_queryset_object
+from qx_test.user.models import Baby, TGroup, GPermission, Label
+from qx_test.user.views import BabyViewset  # noqa
+
+
+class TestRestCacheKey:
+
+    def test_versioned(self):
+        cfg = RestCacheMeta.get_default_detail_action(False)
+        cfg.update({'by_user': True, 'versioned': True, 'timeout': 60})
+        VIEWSET_CACHE_CONFIG['versionviewset'] = {'list': cfg}
+
+        key = RestCacheKey.get_rest_cache_key(
+            'VersionViewSet', 'list', user_id=1, code='abc', cfg=cfg)
+        ProxyCache(key, 60).set({'results': [1]})
+        user2_key = RestCacheKey.get_rest_cache_key(
+            'VersionViewSet', 'list', user_id=2, code='abc', cfg=cfg)
+
+        # model清理缓存时使用的key
+        clear_key = RestCacheKey.get_rest_cache_key(
+            'VersionViewSet', 'list', user_id=1, code='', cfg=cfg)
+        RestCacheKey.clear_action_cache([(clear_key, True)])
+        new_key = RestCacheKey.get_rest_cache_key(
+            'VersionViewSet', 'list', user_id=1, code='abc', cfg=cfg)
+        assert new_key != key
+        assert ProxyCache(new_key, 60).get() is None
+        assert RestCacheKey.get_rest_cache_key(
+            'VersionViewSet', 'list', user_id=2, code='abc',
+            cfg=cfg) == user2_key
+
+        RestCacheKey.clear_cache_keys('VersionViewSet', 'list')
+        assert RestCacheKey.get_rest_cache_key(
+            'VersionViewSet', 'list', user_id=2, code='abc',
+            cfg=cfg) != user2_key
+
+
+class TestCacheInvalidation:
+
+    def test_execute(self):
+        cfg = RestCacheMeta.get_default_detail_action(False)
+        VIEWSET_CACHE_CONFIG['planviewset'] = {'list': cfg}
+        tag_proxy = ProxyCache(
+            'viewset:planviewset:list:abc', 60,
+            tags=['viewset:planviewset:list'])
+        tag_proxy.set({'a': 1})
+        ProxyCache('qx_test:plan:1', 60).set({'a': 1})
+        ProxyCache('qx_test:plan:pattern:1', 60).set({'a': 1})
+
+        plan = CacheInvalidation()
+        plan.add([
+            ('qx_test:plan:1', False),
+            ('qx_test:plan:1', False),
+            ('viewset:planviewset:list', True),
+            ('qx_test:plan:pattern:', True),
+        ])
+        assert len(plan.keys) == 1
+        assert len(plan.tags) == 1
+        assert len(plan.patterns) == 1
+        plan.execute()
+        assert not plan
+        assert tag_proxy.get() is None
+        assert ProxyCache('qx_test:plan:1', 60).get() is None
+        assert ProxyCache('qx_test:plan:pattern:1', 60).get() is None
+
+
+class TestDeferInvalidation:
+
+    @pytest.mark.django_db(transaction=True)
+    def test_on_commit(self, redis_clear):
+        baby = Baby.objects.create(name='test1', type="test", user_id=1)
+        proxy = ProxyCache(
+            'viewset:babyviewset:retrieve:{}'.format(baby.id), 60)
+        proxy.set({'name': 'test1'})
+        with transaction.atomic():
+            baby.name = 'test2'
+            baby.save()
+            assert proxy.get() is not None
+        assert proxy.get() is None
+
+    @pytest.mark.django_db(transaction=True)
+    def test_batch(self, redis_clear):
+        babys = [
+            Baby.objects.create(name='test1', type="test", user_id=1)
+            for _ in range(3)
+        ]
+        proxy = ProxyCache(
+            'viewset:babyviewset:retrieve:{}'.format(babys[0].id), 60)
+        proxy.set({'name': 'test1'})
+        with CacheInvalidation.batch() as pending:
+            for baby in babys:
+                baby.save()
+            assert proxy.get() is not None
+            assert len(pending.plan.keys) == 6
+        assert proxy.get() is None
+        assert not pending.plan
+
+    @pytest.mark.django_db(transaction=True)
+    def test_rollback(self, redis_clear):
+        baby1 = Baby.objects.create(name='test1', type="test", user_id=1)
+        baby2 = Baby.objects.create(name='test1', type="test", user_id=1)
+        proxy1 = ProxyCache(
+            'viewset:babyviewset:retrieve:{}'.format(baby1.id), 60)
+        proxy2 = ProxyCache(
+            'viewset:babyviewset:retrieve:{}'.format(baby2.id), 60)
+        proxy1.set({'name': 'test1'})
+        proxy2.set({'name': 'test1'})
+        try:
+            with transaction.atomic():
+                baby1.name = 'test2'
+                baby1.save()
+                raise ValueError
+        except ValueError:
+            pass
+        # 回滚的清理不会在下一个事务提交时执行
+        with transaction.atomic():
+            baby2.name = 'test2'
+            baby2.save()
+            assert proxy2.get() is not None
+        assert proxy1.get() is not None
+        assert proxy2.get() is None
+        pending = CacheInvalidation.get_pending()
+        assert not pending.transactions and not pending.plan
+
+    @pytest.mark.django_db(transaction=True)
+    def test_savepoint_rollback(self, redis_clear, mocker):
+        baby1 = Baby.objects.create(name='test1', type="test", user_id=1)
+        baby2 = Baby.objects.create(name='test1', type="test", user_id=1)
+        proxy1 = ProxyCache(
+            'viewset:babyviewset:retrieve:{}'.format(baby1.id), 60)
+        proxy2 = ProxyCache(
+            'viewset:babyviewset:retrieve:{}'.format(baby2.id), 60)
+        proxy1.set({'name': 'test1'})
+        proxy2.set({'name': 'test1'})
+        flush = mocker.spy(CacheInvalidation, 'flush')
+        with transaction.atomic():
+            baby2.name = 'test2'
+            baby2.save()
+            try:
+                with transaction.atomic():
+                    baby1.name = 'test2'
+                    baby1.save()
+                    raise ValueError
+            except ValueError:
+                pass
+            baby2.save()
+        # 同一事务合并执行, 回滚的savepoint不清理
+        assert flush.call_count == 1
+        assert proxy1.get() is not None
+        assert proxy2.get() is None
+        assert not CacheInvalidation.get_pending().transactions
+
+    def test_middleware_sync_only(self):
+        from qx_base.qx_core.middleware import CacheInvalidationMiddleware
+        assert not CacheInvalidationMiddleware.async_capable
+
+
+class TestRestQuerySet:
+
+    @pytest.mark.django_db
+    def test_no_cache(self, django_assert_num_queries):
+        from qx_test.user.models import Post
+        Post.objects.create(name='test1')
+        # 没有缓存配置时不查询数据
+        with django_assert_num_queries(1):
+            Post.objects.filter(name='test1').update(name='test2')
+        posts = list(Post.objects.all())
+        with django_assert_num_queries(1):
+            Post.objects.bulk_update(posts, ['name'])
+
+    @pytest.mark.django_db
+    def test_relate_lookup(self, user_data_init, monkeypatch, mocker,
+                           django_assert_num_queries):
+        from qx_test.user.models import UserInfo
+        monkeypatch.setattr(UserInfo, 'cache_config', {
+            "custom": {
+                "qx_test:userinfo:{}": {"args": ['user__account']},
+            },
+        })
+        defer = mocker.patch.object(CacheInvalidation, 'defer')
+        # 关联字段每个lookup一次查询, 与行数无关
+        with django_assert_num_queries(5):
+            UserInfo.objects.filter(age__lt=5).update(name='test')
+        keys = [key for key, _ in defer.call_args[0][0]]
+        assert sorted(set(keys)) == [
+            'qx_test:userinfo:1886666888{}'.format(i) for i in range(5)]
+
+    @pytest.mark.django_db(transaction=True)
+    def test_bulk(self, redis_clear):
+        babys = Baby.objects.bulk_create([
+            Baby(name='test1', type="test", user_id=1)
+            for _ in range(3)
+        ])
+        babys = list(Baby.objects.all())
+        proxies = [
+            ProxyCache(
+                'viewset:babyviewset:retrieve:{}'.format(baby.id), 60)
+            for baby in babys
+        ]
+        for proxy in proxies:
+            proxy.set({'name': 'test1'})
+        assert Baby.cache_get(id=babys[0].id).name == 'test1'
+
+        Baby.objects.filter(id__in=[babys[0].id, babys[1].id]).update(
+            name='test2')
+        assert proxies[0].get() is None
+        assert proxies[1].get() is None
+        assert proxies[2].get() is not None
+        assert Baby.cache_get(id=babys[0].id).name == 'test2'
+
+        babys[2].name = 'test3'
+        Baby.objects.bulk_update([babys[2]], ['name'])
+        assert proxies[2].get() is None
+        assert Baby.cache_get(id=babys[2].id).name == 'test3'
+
+        proxies[0].set({'name': 'test2'})
+        Baby.objects.filter(id=babys[0].id).delete()
+        assert proxies[0].get() is None
+        try:
+            Baby.cache_get(id=babys[0].id)
+        except Baby.DoesNotExist:
+            assert True
+        else:
+            assert False
+
+
+class TestForeignClearCache:
+
+    @pytest.mark.django_db
+    def test_values_list(self, django_assert_num_queries):
+        group = TGroup.objects.create(name='1')
+        perms = [GPermission.objects.create(name=str(i)) for i in range(5)]
+        group.perms.add(*perms)
+        val = {
+            'actions': ['list', 'retrieve'],
+            'by_user_field': 'tgroup__id',
+            'foreign_set': 'perms',
+        }
+        with django_assert_num_queries(1):
+            keys, keys_async = Baby()._foreign_clear_cache(
+                group, 'BabyViewset', val, 'update')
+        assert not keys_async
+        assert ("viewset:babyviewset:list:{}".format(group.id),
+                True) in keys
+        assert len(keys) == 6
+        for perm in perms:
+            assert ("viewset:babyviewset:retrieve:{}".format(perm.id),
+                    False) in keys
+
+
+class TestReloadData:
+
+    @pytest.mark.django_db
+    def test_snapshot(self, mocker, monkeypatch,
+                      django_assert_num_queries):
+        cache_config = dict(Baby.cache_config, reload_data=True)
+        monkeypatch.setattr(Baby, 'cache_config', cache_config)
+        baby = Baby.objects.create(name='test1', type="test", user_id=1)
+        baby = Baby.objects.get(id=baby.id)
+        assert baby._cache_origin['user_id'] == 1
+
+        spy = mocker.spy(CacheInvalidation, 'defer')
+        baby.user_id = 2
+        with django_assert_num_queries(1):
+            baby.save(update_fields=['user_id'])
+        keys_async = spy.call_args[0][1]
+        assert ("viewset:babyviewset:list:1", True) in keys_async
+        assert ("viewset:babyviewset:list:2", True) in keys_async
+        assert baby._cache_origin['user_id'] == 2
+
+
+class TestModelCodec:
+
+    @pytest.mark.django_db
+    def test_snapshot(self, django_assert_num_queries, monkeypatch,
+                      settings):
+        babys = [
+            Baby.objects.create(name='test{}'.format(i), type="test",
+                                user_id=1)
+            for i in range(3)
+        ]
+        # 滚动发布期间写入旧进程可以读取的pickle
+        assert pickle.loads(ProxyCache.dumps(babys[0], 'model')).id == \
+            babys[0].id
+        data = ProxyCache.dumps(Baby.objects.all(), 'model')
+        assert [baby.id for baby in pickle.loads(data)] == \
+            [baby.id for baby in babys]
+        assert len(ProxyCache.loads(data, 'model')) == 3
+
+        settings.PROXY_CACHE_LEGACY_FORMAT = False
+        data = ProxyCache.dumps(babys[0], 'model')
+        with django_assert_num_queries(0):
+            baby = ProxyCache.loads(data, 'model')
+        assert baby.id == babys[0].id
+        assert baby.name == 'test0'
+        assert not baby._state.adding
+
+        data = ProxyCache.dumps(Baby.objects.only('id', 'name'), 'model')
+        objs = ProxyCache.loads(data, 'model')
+        assert [baby.name for baby in objs] == ['test0', 'test1', 'test2']
+        assert 'user_id' in objs[0].get_deferred_fields()
+
+        monkeypatch.setattr(
+            ModelCodec, '_schema_hashes', {Baby: 'changed'})
+        assert ProxyCache.loads(data, 'model') is None
+
+
+class TestCacheGetMany:
+
+    @pytest.mark.django_db
+    def test_get_many(self, redis_clear, django_assert_num_queries):
+        babys = [
+            Baby.objects.create(name='test{}'.format(i), type="test",
+                                user_id=1)
+            for i in range(3)
+        ]
+        ids = [baby.id for baby in babys]
+        Baby.cache_get(id=ids[0])
+        with django_assert_num_queries(1):
+            data = Baby.cache_get_many(ids + [ids[0], 0, 99999])
+        assert sorted(data) == ids
+        assert data[ids[1]].name == 'test1'
+        with django_assert_num_queries(0):
+            data = Baby.cache_get_many(ids)
+        assert sorted(data) == ids
+        # 字符串id转换后命中同一缓存
+        with django_assert_num_queries(0):
+            data = Baby.cache_get_many([str(_id) for _id in ids])
+        assert sorted(data) == ids
+
+        with django_assert_num_queries(0):
+            queryset = load_set_queryset_object(
+                [Baby(object_id=ids[2])], Baby, {'object_id': 'obj'})
+        assert queryset[0].obj.name == 'test2'
+
+    @pytest.mark.django_db(transaction=True)
+    def test_rollback(self, redis_clear):
+        baby = Baby.objects.create(name='test1', type="test", user_id=1)
+        proxy = ProxyCache(*Baby.__cache_key__(id=baby.id), convert='model')
+        assert proxy.get().name == 'test1'
+        # 回滚的修改不写入对象缓存
+        try:
+            with transaction.atomic():
+                baby.name = 'test2'
+                baby.save()
+                raise ValueError
+        except ValueError:
+            pass
+        assert proxy.get().name == 'test1'
+        with transaction.atomic():
+            baby.save()
+            assert proxy.get().name == 'test1'
+        assert proxy.get().name == 'test2'
+        # 同一事务中保存后删除, 按顺序执行
+        with transaction.atomic():
+            baby.save()
+            baby.delete()
+        assert proxy.get() is None
+
+
+class TestCacheQuery:
+
+    @pytest.mark.django_db
+    def test_paginate(self, redis_clear, django_assert_num_queries,
+                      monkeypatch, mocker):
+        babys = Baby.objects.bulk_create([
+            Baby(name='test{}'.format(i % 2), type="test", user_id=1)
+            for i in range(120)
+        ])
+        ids = list(Baby.objects.order_by('id').values_list('id', flat=True))
+        with django_assert_num_queries(2):
+            queryset = Baby.cache_query(user_id=1, _offset=10, _limit=5)
+        assert [ins.id for ins in queryset] == ids[10:15]
+        with django_assert_num_queries(0):
+            queryset = Baby.cache_query(user_id=1, _offset=10, _limit=5)
+        assert [ins.id for ins in queryset] == ids[10:15]
+        assert len(Baby.cache_query(user_id=1)) == 120
+        # 非query字段过滤: 数据库查询当前页id, 只加载当前页对象
+        get_many = mocker.spy(ProxyCache, 'get_many')
+        with django_assert_num_queries(1):
+            queryset = Baby.cache_query(user_id=1, name='test1', _limit=3)
+        assert [ins.id for ins in queryset] == ids[1:6:2]
+        assert len(get_many.call_args[0][0]) == 3
+        queryset = Baby.cache_query(
+            user_id=1, name='test0', _offset=2, _limit=2)
+        assert [ins.id for ins in queryset] == ids[4:8:2]
+        assert Baby.cache_query(user_id=2) == []
+        with django_assert_num_queries(0):
+            assert Baby.cache_query(user_id=2) == []
+
+        monkeypatch.setitem(Baby.objects_cache_fields, 'order', '-pk')
+        RedisClient().get_conn().flushall()
+        queryset = Baby.cache_query(user_id=1, _offset=1, _limit=2)
+        assert [ins.id for ins in queryset] == ids[::-1][1:3]
+        queryset = Baby.cache_query(user_id=1, _offset=1, _limit=2)
+        assert [ins.id for ins in queryset] == ids[::-1][1:3]
+        assert len(babys) == 120
+
+    @pytest.mark.django_db(transaction=True)
+    def test_char_pk(self, redis_clear, django_assert_num_queries):
+        # 非数字主键按id字符串排序
+        Label.objects.bulk_create([
+            Label(name=name, user_id=1) for name in ['b', 'c', 'a']])
+        assert [ins.pk for ins in Label.cache_query(user_id=1)] == \
+            ['a', 'b', 'c']
+        label = Label(name='ab', user_id=1)
+        label.save()
+        with django_assert_num_queries(0):
+            queryset = Label.cache_query(user_id=1, _offset=1, _limit=2)
+        assert [ins.pk for ins in queryset] == ['ab', 'b']
+        assert Label.cache_get_many(['a', 'x']) == {
+            'a': Label.objects.get(name='a')}
+
+    def test_order_check(self, monkeypatch):
+        def errors():
+            return [error.id for error in Baby.check()
+                    if error.id.startswith('qx_rest')]
+        assert not errors()
+        monkeypatch.setitem(Baby.objects_cache_fields, 'order', 'name')
+        assert errors() == ['qx_rest.E001']
+        monkeypatch.setitem(Baby.objects_cache_fields, 'order', '-created')
+        assert not errors()
+
+    @pytest.mark.django_db(transaction=True)
+    def test_incremental(self, redis_clear, django_assert_num_queries):
+        baby1 = Baby.objects.create(name='test1', type="test", user_id=1)
+        assert Baby.cache_query(user_id=2) == []
+        assert len(Baby.cache_query(user_id=1)) == 1
+
+        baby2 = Baby.objects.create(name='test2', type="test", user_id=1)
+        with django_assert_num_queries(0):
+            queryset = Baby.cache_query(user_id=1)
+        assert [ins.id for ins in queryset] == [baby1.id, baby2.id]
+
+        baby1 = Baby.objects.get(id=baby1.id)
+        baby1.user_id = 2
+        baby1.save()
+        with django_assert_num_queries(0):
+            assert [ins.id for ins in Baby.cache_query(user_id=1)] == \
+                [baby2.id]
+            queryset = Baby.cache_query(user_id=2)
+        assert [ins.id for ins in queryset] == [baby1.id]
+        assert queryset[0].user_id == 2
+
+        # 回滚时不修改id列表
+        try:
+            with transaction.atomic():
+                baby = Baby.objects.get(id=baby2.id)
+                baby.user_id = 2
+                baby.save()
+                Baby.objects.get(id=baby1.id).delete()
+                raise ValueError
+        except ValueError:
+            pass
+        assert [ins.id for ins in Baby.cache_query(user_id=1)] == \
+            [baby2.id]
+        assert [ins.id for ins in Baby.cache_query(user_id=2)] == \
+            [baby1.id]
+
+        key, _ = Baby.__cache_query_key__(user_id=1)
+        client = RedisClient().get_conn()
+        with transaction.atomic():
+            pk = str(baby2.id)
+            baby2.delete()
+            assert client.zscore(key, pk) is not None
+        assert client.zscore(key, pk) is None
+        with django_assert_num_queries(0):
+            assert Baby.cache_query(user_id=1) == []
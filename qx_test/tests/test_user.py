@@ -1,8 +1,15 @@
 import pytest
 import json
+import asyncio
 import django
 from qx_base.qx_user.viewsets import UserViewSet, UserInfoViewSet
 from qx_base.qx_user.tools import CodeMsg
+from qx_base.qx_user.auth import (
+    AsyncJwtAuthentication, AioJWTAuthMiddleware, UserBatchLoader,
+    JwtAuthentication, LocalAuthCache, UserJWT, AUTH_TOKEN_CACHE_KEY,
+)
+from qx_base.qx_rest.exceptions import UserDisabled
+from qx_base.qx_core.storage import RedisClient
 from qx_test.user.models import User, Baby, TGroup, GPermission
 from qx_test.user.views import TGroupViewset, BabyViewset
 
@@ -284,7 +291,7 @@ class TestBabyView:
         self.url = "/api/tests"
         self.viewset = BabyViewset
 
-    @pytest.mark.django_db
+    @pytest.mark.django_db(transaction=True)
     def test_cache(self, rf, user_data_init, signin_request, mocker):
 
         user1 = User.objects.get(account='18866668881')
@@ -315,3 +322,114 @@ class TestBabyView:
             {'get': 'list'})(request)
         data = json.loads(response.content)
         assert len(data['data']['results']) == 2
+
+        # encoded缓存命中, 返回相同内容
+        content = response.content
+        response = self.viewset.as_view(
+            {'get': 'list'})(request)
+        assert response.content == content
+        assert json.loads(response.content)['code'] == 200
+
+        # 通过tag集合清理查询参数缓存
+        tag = "viewset:babyviewset:list:{}".format(request.user.id)
+        client = RedisClient().get_conn()
+        assert client.zcard(RedisClient.tag_key(tag))
+        Baby.objects.create(name='test3', type="user",
+                            object_id=user1.id, user_id=request.user.id,)
+        assert not client.exists(RedisClient.tag_key(tag))
+        response = self.viewset.as_view(
+            {'get': 'list'})(request)
+        data = json.loads(response.content)
+        assert len(data['data']['results']) == 3
+
+
+class TestAsyncJwtAuthentication:
+
+    @pytest.mark.django_db(transaction=True)
+    def test_authenticate(self, user_data_init, mocker):
+        users = list(User.objects.order_by('id')[:3])
+        tokens = [user.get_new_token() for user in users]
+        client = RedisClient().get_conn()
+        client.delete(*[
+            AUTH_TOKEN_CACHE_KEY.format(user.id) for user in users])
+        LocalAuthCache.cache.clear()
+        load_users = mocker.spy(UserBatchLoader, 'load_users')
+        auth = AsyncJwtAuthentication()
+
+        async def _run():
+            # 未命中缓存的用户合并为一次查询
+            data = await asyncio.gather(*[
+                auth.authenticate(token) for token in tokens + tokens])
+            assert [user.id for user in data] == \
+                [user.id for user in users + users]
+            assert load_users.call_count == 1
+            # 已写回缓存, 不再查询
+            user = await auth.authenticate(tokens[0])
+            assert user.id == users[0].id
+            assert load_users.call_count == 1
+            assert await auth.authenticate('error token') is None
+
+            # middleware: websocket使用query参数, http使用header
+            scopes = []
+
+            async def app(scope, receive, send):
+                scopes.append(scope)
+
+            middleware = AioJWTAuthMiddleware(app)
+            await middleware({
+                'type': 'websocket',
+                'query_string': 'token={}'.format(tokens[1]).encode(),
+            }, None, None)
+            await middleware({
+                'type': 'http', 'query_string': b'',
+                'headers': [(b'myauthorization',
+                             'token {}'.format(tokens[2]).encode())],
+            }, None, None)
+            await middleware({'type': 'http', 'query_string': b''},
+                             None, None)
+            assert scopes[0]['user'].id == users[1].id
+            assert scopes[1]['user'].id == users[2].id
+            assert not scopes[2]['user'].is_authenticated
+            await asyncio.sleep(0.1)
+        asyncio.run(_run())
+        assert client.zscore(
+            "qx_user:id:{}:lastaccesstime".format(users[0].id),
+            users[0].id)
+
+        # 批量禁用的用户
+        User.objects.filter(id=users[0].id).update(is_active=False)
+        assert asyncio.run(auth.authenticate(tokens[0])) is None
+
+
+class TestLocalAuthCache:
+
+    @pytest.mark.django_db(transaction=True)
+    def test_authenticate(self, user_data_init, mocker):
+        user = User.objects.get(mobile="18866668888")
+        token = user.get_new_token()
+        LocalAuthCache.cache.clear()
+        decode = mocker.spy(UserJWT, 'decode')
+        auth = JwtAuthentication()
+        data = auth.authenticate_credentials(token)
+        assert data[0].id == user.id
+        # 重复的token不再验签和读取redis
+        client = RedisClient().get_conn()
+        client.delete(AUTH_TOKEN_CACHE_KEY.format(user.id))
+        cached = auth.authenticate_credentials(token)[0]
+        assert cached.id == user.id
+        assert cached is not data[0]
+        assert decode.call_count == 1
+
+        # 用户禁用后广播失效
+        user.is_active = False
+        user.save()
+        assert LocalAuthCache.get_user(user.id) is None
+        with pytest.raises(UserDisabled):
+            auth.authenticate_credentials(token)
+        assert asyncio.run(
+            AsyncJwtAuthentication().authenticate(token)) is None
+        assert decode.call_count == 1
+
+        # 通过queryset批量修改同样清理
+        User.objects.filter(id=user.id).update(is_active=True)
+        assert auth.authenticate_credentials(token)[0].id == user.id
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-18 16:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Label',
+            fields=[
+                ('name', models.CharField(max_length=10, primary_key=True, serialize=False, verbose_name='名称')),
+                ('user_id', models.IntegerField(default=0, verbose_name='用户')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+    ]
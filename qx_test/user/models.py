@@ -111,3 +111,18 @@ class GPermission(models.Model):
         verbose_name="名称", max_length=50)
     groups = models.ManyToManyField(
         "user.TGroup", verbose_name="组")
+
+
+class Label(CacheModelMixin):
+    """
+    非数字主键的缓存查询
+    """
+    name = models.CharField(
+        verbose_name="名称", max_length=10, primary_key=True)
+    user_id = models.IntegerField(
+        verbose_name="用户", default=0)
+
+    objects_cache_fields = {
+        'object': ['pk', ],
+        'query': ['user_id', ],
+    }
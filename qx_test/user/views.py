@@ -39,6 +39,9 @@ class BabyViewset(viewsets.GenericViewSet,
         'list': {
             'is_paginate': False,
             'by_user': True,
+            'encoded': True,
         },
-        'retrieve': {}
+        'retrieve': {
+            'local_timeout': 5,
+        }
     }
@@ -14,12 +14,19 @@ setup(
         'Django >= 2.2',
         'djangorestframework >= 3.10',
         'djangorestframework-jwt >= 1.11.0',
-        'PyCryptodome >= 3.9',
-        'redis >= 3.3',
+        'PyCryptodome >= 3.15',
+        'redis >= 4.6',
         'psycopg2 >= 2.8.3',
         'channels >= 3.0.3',
         'channels-redis >= 3.2.0',
     ],
+    extras_require={
+        'orjson': ['orjson >= 3.0'],
+        'msgpack': ['msgpack >= 1.0'],
+        'zstd': ['zstandard >= 0.15'],
+        'lz4': ['lz4 >= 3.0'],
+        'ed25519': ['cryptography >= 3.0'],
+    },
     python_requires='>=3.8',
     platforms='any',
 )